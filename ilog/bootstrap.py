@@ -133,36 +133,362 @@ class BaseUsageOptions(usage.Options):
         self.parent.postOptions()
         self.executeCommand()
 
+    def parse_day(self, key):
+        from datetime import datetime
+        if not self.opts[key]:
+            return None
+        try:
+            return datetime.strptime(self.opts[key], '%Y-%m-%d')
+        except ValueError:
+            raise SysExit("Invalid date for --%s: %s", key, self.opts[key])
+
 class RunServerOptions(BaseUsageOptions):
     "Run Server"
     longdesc = __doc__
 
     optParameters = [
         ["port", "p", 58846, "Port to bind to", int],
+        ["workers", "w", 0, "Serve from this many worker processes", int],
+        ["listen-fd", None, None, "Serve on this inherited socket, used by "
+                                  "the workers", int],
+        ["ready-fd", None, None, "Say we're serving on this inherited pipe",
+         int],
+        ["worker-index", None, None, "The worker's number", int],
     ]
 
     def opt_port(self, port):
         self.opts['port'] = int(port)
 
+    def warm_caches(self):
+        from ilog.database import db
+        from ilog.utils.completion import CompletionIndexes
+        from ilog.utils.mentions import MentionMatcher
+
+        session = db.session()
+        try:
+            app.completion = CompletionIndexes()
+            app.completion.load(session)
+            app.mentions = MentionMatcher()
+            app.mentions.load(session)
+        finally:
+            session.close()
+
+    def run_supervisor(self):
+        from ilog.web.workers import (Supervisor, inherit_socket,
+                                      install_handoff, notify_ready)
+        sock = None
+        if self.opts['listen-fd'] is not None:
+            sock = inherit_socket(self.opts['listen-fd'])
+        supervisor = Supervisor(self.opts['port'], self.opts['workers'],
+                                ['--config', self.parent.opts['config']])
+        failures = []
+        def failed(failure):
+            # Not telling a server handing off to us we're ready keeps it
+            # serving
+            failures.append(failure)
+            reactor.stop()
+        supervisor.start(sock).addCallbacks(
+            lambda _: notify_ready(self.opts['ready-fd']), failed
+        )
+        install_handoff(supervisor.socket)
+        reactor.run()
+        if failures:
+            raise SysExit("A worker failed to start: %s",
+                          failures[0].getErrorMessage())
+
     def executeCommand(self):
+        if self.opts['workers'] > 0 and self.opts['worker-index'] is None:
+            return self.run_supervisor()
+
         import warnings
         # Shut up "twisted.web.error.NoResource is deprecated since Twisted 9.0.
         warnings.filterwarnings('ignore', category=DeprecationWarning,
                                 module=r'nevow\.static')
-#        from screener.views.main import build_site
-#        site = build_site()
+        from ilog.web import build_site, crawlers
+        from ilog.web.workers import (adopt_socket, drain_on_shutdown,
+                                      install_handoff, notify_ready)
+        from ilog.web.live import LiveHub
+        from ilog.web.snapshots import SnapshotStore
+        from ilog.web.charts import ChartStore
+        from ilog.utils.cache import FragmentCache
+        from ilog.utils import templates
+        crawlers.set_trusted_proxies(app.config.web.trusted_proxies)
+        templates.registry.debug = app.config.web.debug_templates
+        templates.registry.load_all()
+        templates.registry.start()
+        self.warm_caches()
+        site = build_site()
+        app.live = LiveHub()
+        app.live.start()
+        app.snapshots = SnapshotStore(
+            usefull_path(str(app.config.web.snapshots_dir))
+        )
+        if self.opts['worker-index'] in (None, 0):
+            # Only one of the workers writes the snapshots
+            app.snapshots.start()
+        app.fragments = FragmentCache(
+            app.config.web.fragment_cache_size * 1024 * 1024
+        )
+        app.fragments.start()
+        app.charts = ChartStore(usefull_path(str(app.config.web.charts_dir)))
+        if self.opts['worker-index'] in (None, 0):
+            # Only one of the workers removes the unused charts
+            app.charts.start()
         # Warnings can now be reset
         warnings.resetwarnings()
-        reactor.listenTCP(self.opts['port'], site)
+        if self.opts['listen-fd'] is not None:
+            port = adopt_socket(self.opts['listen-fd'], site)
+        else:
+            port = reactor.listenTCP(self.opts['port'], site)
+        drain_on_shutdown(port, site)
+        if self.opts['worker-index'] is None:
+            # Workers are handed off by their supervisor
+            install_handoff(port.socket)
+        # Caches are warm by now
+        reactor.callWhenRunning(notify_ready, self.opts['ready-fd'])
         reactor.run()
 
+class BackfillURLsOptions(BaseUsageOptions):
+    "Index the URLs of already logged events"
+    longdesc = __doc__
+
+    optParameters = [
+        ["start-id", None, 0, "Resume after this event id", int],
+        ["batch-size", None, 1000, "Events per transaction", int],
+    ]
+
+    def executeCommand(self):
+        from ilog.utils.links import backfill
+        indexed = backfill(app.database_engine, self.opts['start-id'],
+                           self.opts['batch-size'])
+        print "Indexed %d URLs" % indexed
+
+class BackfillMentionsOptions(BaseUsageOptions):
+    "Index the nick mentions of already logged events"
+    longdesc = __doc__
+
+    optParameters = [
+        ["start-id", None, 0, "Resume after this event id", int],
+        ["batch-size", None, 1000, "Events per transaction", int],
+    ]
+
+    def executeCommand(self):
+        from ilog.utils.mentions import backfill
+        indexed = backfill(app.database_engine, self.opts['start-id'],
+                           self.opts['batch-size'])
+        print "Indexed %d mentions" % indexed
+
+class BackfillFoldedOptions(BaseUsageOptions):
+    "Fold the nicks and messages of already logged events for searching"
+    longdesc = __doc__
+
+    optParameters = [
+        ["batch-size", None, 1000, "Events per transaction", int],
+    ]
+
+    def executeCommand(self):
+        from ilog.search import backfill
+        folded = backfill(app.database_engine, self.opts['batch-size'])
+        print "Folded %d events" % folded
+
+class NumberEventsOptions(BaseUsageOptions):
+    "Number already logged events within their channel's days"
+    longdesc = __doc__
+
+    optParameters = [
+        ["batch-size", None, 1000, "Events per transaction", int],
+    ]
+
+    def executeCommand(self):
+        from ilog.utils import days
+        numbered = days.backfill(app.database_engine,
+                                 self.opts['batch-size'])
+        print "Numbered the events of %d channel days." % numbered
+
+class RollupActivityOptions(BaseUsageOptions):
+    "Rebuild the hourly activity rollups of already logged events"
+    longdesc = __doc__
+
+    optParameters = [
+        ["batch-size", None, 1000, "Events read at a time", int],
+    ]
+
+    def executeCommand(self):
+        from ilog.utils import activity
+        hours = activity.backfill(app.database_engine,
+                                  self.opts['batch-size'])
+        print "Rolled up %d channel hours." % hours
+
+class StaticExportOptions(BaseUsageOptions):
+    "Write the archive's closed days as static pages"
+    longdesc = __doc__
+
+    optParameters = [
+        ["output", "o", None, "Directory to write the pages to"],
+        ["processes", "j", None, "Days rendered in parallel, defaults to "
+                                 "the number of CPUs", int],
+    ]
+    optFlags = [
+        ["force", "f", "Render everything again"],
+    ]
+
+    def postOptions(self):
+        if not self.opts['output']:
+            raise usage.UsageError("--output is needed")
+        BaseUsageOptions.postOptions(self)
+
+    def executeCommand(self):
+        from ilog.static import StaticExport
+        export = StaticExport(usefull_path(self.opts['output']),
+                              self.opts['processes'], self.opts['force'])
+        rendered, written = export.run()
+        print "Rendered %d days and wrote %d index pages." % (rendered,
+                                                              written)
+
+class ExportOptions(BaseUsageOptions):
+    "Export a channel's history"
+    longdesc = __doc__
+
+    optParameters = [
+        ["network", "n", None, "The channel's network"],
+        ["channel", "C", None, "The channel name, including its prefix"],
+        ["format", "f", "text", "One of text, jsonl or csv"],
+        ["from", None, None, "First day to export, YYYY-MM-DD"],
+        ["to", None, None, "Last day to export, YYYY-MM-DD"],
+        ["output", "o", "-", "Output file, - for stdout"],
+    ]
+    optFlags = [
+        ["gzip", "z", "Gzip compress the output"],
+    ]
+
+    def postOptions(self):
+        from ilog.export import FORMATS
+        if not self.opts['network'] or not self.opts['channel']:
+            raise usage.UsageError("Both --network and --channel are needed")
+        if self.opts['format'] not in FORMATS:
+            raise usage.UsageError("Unknown format %r" % self.opts['format'])
+        BaseUsageOptions.postOptions(self)
+
+    def executeCommand(self):
+        import sys
+        from datetime import timedelta
+        from ilog.database import db
+        from ilog.export import find_channel, iter_export
+
+        session = db.session()
+        try:
+            channel = find_channel(session,
+                                   self.opts['network'].decode('utf-8'),
+                                   self.opts['channel'].decode('utf-8'))
+        finally:
+            session.close()
+        if channel is None:
+            raise SysExit("No such channel %s on %s", self.opts['channel'],
+                          self.opts['network'])
+
+        start, end = self.parse_day('from'), self.parse_day('to')
+        if end is not None:
+            end += timedelta(days=1)
+        if self.opts['output'] == '-':
+            output = sys.stdout
+        else:
+            output = open(usefull_path(self.opts['output']), 'wb')
+        try:
+            for chunk in iter_export(channel.id, self.opts['format'], start,
+                                     end, self.opts['gzip']):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+
+class SearchOptions(BaseUsageOptions):
+    "Search the logs for the given terms"
+    longdesc = __doc__
+
+    optParameters = [
+        ["network", "n", None, "The channel's network"],
+        ["channel", "C", None, "Only search this channel, including its "
+                               "prefix"],
+        ["nick", "N", None, "Only search this nick's events"],
+        ["from", None, None, "First day to search, YYYY-MM-DD"],
+        ["to", None, None, "Last day to search, YYYY-MM-DD"],
+        ["limit", "l", 50, "How many events to show", int],
+    ]
+    optFlags = [
+        ["explain", "e", "Show the search plan, with its SQL, instead of "
+                         "running it"],
+    ]
+
+    def parseArgs(self, *terms):
+        self.terms = [term.decode('utf-8') for term in terms]
+
+    def postOptions(self):
+        if self.opts['channel'] and not self.opts['network']:
+            raise usage.UsageError("--channel needs --network")
+        BaseUsageOptions.postOptions(self)
+
+    def executeCommand(self):
+        from datetime import timedelta
+        from ilog.database import db
+        from ilog.export import find_channel
+        from ilog.search import SearchRequest, plan
+        from ilog.utils.records import EventRecord, resolve_nicks
+
+        start, end = self.parse_day('from'), self.parse_day('to')
+        if end is not None:
+            end += timedelta(days=1)
+        session = db.session()
+        try:
+            channel_ids = None
+            if self.opts['channel']:
+                channel = find_channel(session,
+                                       self.opts['network'].decode('utf-8'),
+                                       self.opts['channel'].decode('utf-8'))
+                if channel is None:
+                    raise SysExit("No such channel %s on %s",
+                                  self.opts['channel'], self.opts['network'])
+                channel_ids = [channel.id]
+            nick = self.opts['nick'] and self.opts['nick'].decode('utf-8')
+            request = SearchRequest(self.terms, nick, channel_ids, start, end,
+                                    limit=self.opts['limit'])
+            search_plan = plan(session, request)
+            if self.opts['explain']:
+                print search_plan.explain(session).encode('utf-8')
+                return
+            records = resolve_nicks(session, [
+                EventRecord(row.id, row.stamp, row.type, row.identity_id,
+                            row.message)
+                for row in search_plan.execute(session)
+            ])
+        finally:
+            session.close()
+        for record in records:
+            print (u'%d [%s] <%s> %s' % (record.id, record.stamp,
+                                         record.nick or u'',
+                                         record.message or u'')
+                  ).encode('utf-8')
+
 class ServiceOptions(BaseUsageOptions):
     optParameters = [
         ("config", "c", "~/.ilog", "Configuration directory"),
     ]
 
     subCommands = [
-        ["serve", None, RunServerOptions, RunServerOptions.__doc__]
+        ["serve", None, RunServerOptions, RunServerOptions.__doc__],
+        ["backfill-urls", None, BackfillURLsOptions,
+         BackfillURLsOptions.__doc__],
+        ["backfill-mentions", None, BackfillMentionsOptions,
+         BackfillMentionsOptions.__doc__],
+        ["backfill-folded", None, BackfillFoldedOptions,
+         BackfillFoldedOptions.__doc__],
+        ["number-events", None, NumberEventsOptions,
+         NumberEventsOptions.__doc__],
+        ["rollup-activity", None, RollupActivityOptions,
+         RollupActivityOptions.__doc__],
+        ["export", None, ExportOptions, ExportOptions.__doc__],
+        ["search", None, SearchOptions, SearchOptions.__doc__],
+        ["static-export", None, StaticExportOptions,
+         StaticExportOptions.__doc__]
     ]
 
     defaultSubCommand = "serve"
@@ -184,7 +510,8 @@ class ServiceOptions(BaseUsageOptions):
 
     def _setup_database(self):
 
-        from ilog.database import db, DeclarativeBase, User, orm
+        from ilog.database import (db, DeclarativeBase, User, commit_hooks,
+                                   orm, upgrade_database)
         from sqlalchemy.exceptions import OperationalError, ProgrammingError
 
         def create_database_engine():
@@ -277,7 +604,7 @@ class ServiceOptions(BaseUsageOptions):
             SysExit("Something wen't wrong connecting to the database: %s",
                     error.message)
         app.config.database.session = db.session = orm.sessionmaker(
-            app.database_engine
+            app.database_engine, extension=[commit_hooks]
         )
         DeclarativeBase.metadata.bind = app.database_engine
 
@@ -291,7 +618,9 @@ class ServiceOptions(BaseUsageOptions):
         if not app.database_engine.has_table(User.__tablename__):
             # Database was not created yet
             print "Creating database"
-            db.metadata.create_all(app.database_engine)
+        # Also brings a database created by an older version up to date,
+        # adding the tables, columns and indexes it's missing
+        upgrade_database(app.database_engine)
 
         try:
             session = db.session()
@@ -33,6 +33,25 @@ DEFAULT_CONFIG = {
         'cookie_name': String(label="Cookie Name:", default='ilog_cookie',
                               description="The name of the cookie that will "
                               "be sent to the user."),
+        'snapshots_dir': String(label="Snapshots Directory:",
+                                default="%(here)s/snapshots",
+                                description="Where the pre-rendered logs of "
+                                "past days are stored."),
+        'charts_dir': String(label="Charts Directory:",
+                             default="%(here)s/charts",
+                             description="Where the rendered activity charts "
+                             "are stored."),
+        'trusted_proxies': String(label="Trusted Proxies:", default='',
+                                  description="Comma separated addresses of "
+                                  "the reverse proxies whose X-Forwarded-For "
+                                  "header tells the client's address."),
+        'fragment_cache_size': Integer(label="Fragment Cache Size:",
+                                       default=64,
+                                       description="Megabytes of rendered "
+                                       "log pages to keep in memory."),
+        'debug_templates': Boolean(label="Debug Templates:", default=False,
+                                   description="Parse templates again when "
+                                   "they change on disk."),
     },
     'rpxnow': {
         'api_key': String(label="Api Key:", description="RPXNow.com API key"),
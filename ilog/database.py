@@ -5,6 +5,13 @@
     This module is a layer on top of SQLAlchemy to provide asynchronous
     access to the database and has the used tables/models used in ILog.
 
+    :func:`upgrade_database` runs on every start and brings a database
+    created by an older version up to the current models: it creates the
+    missing tables and adds the missing nullable columns and indexes.  What's
+    built from the events, like the URL or mention indexes or the folded
+    text searches match on, is then filled for the already logged events by
+    the ``backfill-*`` commands.
+
     :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
     :license: BSD, see LICENSE for more details.
 """
@@ -12,6 +19,7 @@
 import os
 import sys
 import logging
+import weakref
 import functools
 from os import remove, removedirs
 from os.path import basename, dirname, join, splitext
@@ -24,17 +32,17 @@ from datetime import datetime
 import sqlalchemy
 from sqlalchemy import and_, or_
 from sqlalchemy import orm
-from sqlalchemy.exceptions import SQLAlchemyError
+from sqlalchemy.exceptions import IntegrityError, SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import (EXT_CONTINUE, MapperExtension, dynamic_loader,
-                            deferred)
+from sqlalchemy.orm import (EXT_CONTINUE, MapperExtension, SessionExtension,
+                            dynamic_loader, deferred)
 
 from nevow import inevow, context, rend
 from twisted.internet import defer, threads
 
 from ilog import application as app
 from ilog.utils.crypto import gen_pwhash, check_pwhash
-from ilog.utils.text import gen_slug
+from ilog.utils.text import fold, fold_token, gen_slug
 
 log = logging.getLogger(__name__)
 
@@ -87,6 +95,112 @@ def sqla_session(f):
 def sqla_session_inline_callbacks(f):
     return sqla_session(defer.inlineCallbacks(f))
 
+def with_text(query):
+    """Have `query` load the large text columns of its entities, which are
+    deferred, in the same statement.  For the views showing the text; the
+    others don't fetch it at all, or on access, one query per instance."""
+    return query.options(orm.undefer_group(TEXT_GROUP))
+
+def insert_if_absent(connection, table, **values):
+    """Insert a row in `table` unless one with the same unique key exists,
+    returning the insert's result or ``None``.  The insert runs within a
+    savepoint, so losing the race against a concurrent one doesn't abort
+    the transaction, the ingest of the event being indexed."""
+    savepoint = connection.begin_nested()
+    try:
+        result = connection.execute(table.insert(), **values)
+    except IntegrityError:
+        savepoint.rollback()
+        return None
+    savepoint.commit()
+    return result
+
+def column_spec(column, dialect):
+    if hasattr(column.type, 'compile'):
+        return column.type.compile(dialect=dialect)
+    # SQLAlchemy 0.5
+    return column.type.dialect_impl(dialect).get_col_spec()
+
+def add_missing_columns(engine, table):
+    """Add the nullable columns added to `table` since it was created."""
+    existing = db.Table(table.name, db.MetaData(), autoload=True,
+                        autoload_with=engine)
+    preparer = engine.dialect.identifier_preparer
+    for column in table.columns:
+        if column.name in existing.columns:
+            continue
+        if not column.nullable:
+            log.warning("Can't add the not nullable column %s.%s, the "
+                        "table has to be migrated by hand", table.name,
+                        column.name)
+            continue
+        log.info("Adding column %s.%s", table.name, column.name)
+        engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+            preparer.format_table(table), preparer.format_column(column),
+            column_spec(column, engine.dialect)))
+
+#: Indexes older versions created that were since replaced, by table name
+OBSOLETE_INDEXES = {
+    'events': ['ix_events_channel_seq'],
+}
+
+def existing_indexes(engine, table):
+    """Return the names of the indexes `table` has on the database, or
+    ``None`` when SQLAlchemy can't tell."""
+    try:
+        from sqlalchemy.engine.reflection import Inspector
+    except ImportError:
+        # SQLAlchemy 0.5 can't list them
+        return None
+    return set(index['name'] for index in
+               Inspector.from_engine(engine).get_indexes(table.name))
+
+def drop_obsolete_indexes(engine, table, existing):
+    """Drop the indexes on `table` superseded since it was created."""
+    for name in OBSOLETE_INDEXES.get(table.name, ()):
+        if existing is not None and name not in existing:
+            continue
+        # Built on a copy of the table, not to add it to the models; the
+        # dialect renders the DROP INDEX, MySQL's needs the table
+        copy = table.tometadata(db.MetaData())
+        try:
+            db.Index(name, *copy.primary_key.columns).drop(engine)
+        except SQLAlchemyError, error:
+            if existing is not None:
+                raise
+            log.debug("Not dropping index %s: %s", name, error)
+        else:
+            log.info("Dropped index %s", name)
+
+def add_missing_indexes(engine, table, existing=None):
+    """Create the indexes added to `table` since it was created."""
+    # On SQLAlchemy 0.5 `existing` is None, creating an existing index fails
+    for index in table.indexes:
+        if existing is not None and index.name in existing:
+            continue
+        try:
+            index.create(engine)
+        except SQLAlchemyError, error:
+            if existing is not None:
+                raise
+            log.debug("Not creating index %s: %s", index.name, error)
+        else:
+            log.info("Created index %s", index.name)
+
+def upgrade_database(engine):
+    """Create the tables missing from the database, all of them on a new
+    one, and add the columns and indexes missing from the existing tables,
+    dropping the indexes they replace.  Does nothing on an up to date
+    database."""
+    existing = [table for table in metadata.tables.itervalues()
+                if engine.has_table(table.name)]
+    metadata.create_all(engine, checkfirst=True)
+    for table in existing:
+        add_missing_columns(engine, table)
+        indexes = existing_indexes(engine, table)
+        drop_obsolete_indexes(engine, table, indexes)
+        add_missing_indexes(engine, table, indexes)
+
 def get_engine():
     """Return the active database engine (the database engine of the active
     application).  If no application is enabled this has an undefined behavior.
@@ -118,9 +232,156 @@ db.DeclarativeBase = DeclarativeBase = declarative_base()
 db.metadata = metadata = DeclarativeBase.metadata
 db.sqla_session = sqla_session
 db.sqla_session_inline_callbacks = sqla_session_inline_callbacks
+db.with_text = with_text
+db.insert_if_absent = insert_if_absent
+
+#: The deferred group of the large text columns, see :func:`with_text`
+TEXT_GROUP = 'text'
 
 log = logging.getLogger(__name__)
 
+class CommitHooksExtension(SessionExtension):
+    """Runs the in-memory updates for what a session inserted once, and
+    only if, its transaction is committed, see :func:`after_commit`."""
+
+    def __init__(self):
+        self.pending = weakref.WeakKeyDictionary()
+
+    def add(self, session, callback, args):
+        self.pending.setdefault(session, []).append((callback, args))
+
+    def after_commit(self, session):
+        for callback, args in self.pending.pop(session, ()):
+            try:
+                callback(*args)
+            except Exception, error:
+                log.exception(error)
+
+    def after_rollback(self, session):
+        self.pending.pop(session, None)
+
+commit_hooks = CommitHooksExtension()
+
+def after_commit(instance, callback, *args):
+    """Call `callback` with `args` once the transaction which inserted
+    `instance` is committed.  Pass values rather than the instance, its
+    attributes are expired by then."""
+    session = orm.object_session(instance)
+    if session is None:
+        callback(*args)
+    else:
+        commit_hooks.add(session, callback, args)
+
+class CompletionIndexExtension(MapperExtension):
+    """Keeps :attr:`application.completion` current as rows are ingested."""
+
+    def after_insert(self, mapper, connection, instance):
+        completion = getattr(app, 'completion', None)
+        if completion is None:
+            return EXT_CONTINUE
+        if isinstance(instance, Event):
+            after_commit(instance, completion.add_event, instance.channel_id,
+                         instance.identity_id, instance.stamp)
+        elif isinstance(instance, Identity):
+            after_commit(instance, completion.add_identity, instance.id,
+                         instance.network_name, instance.nick)
+        elif isinstance(instance, Channel):
+            after_commit(instance, completion.add_channel, instance.id,
+                         instance.network_name,
+                         (instance.prefix or u'') + instance.name)
+        return EXT_CONTINUE
+
+completion_extension = CompletionIndexExtension()
+
+class MentionIndexExtension(MapperExtension):
+    """Records which known channel members each ingested event mentions."""
+
+    def after_insert(self, mapper, connection, instance):
+        from ilog.utils.mentions import get_matcher, store_mentions
+        matcher = get_matcher(connection)
+        if isinstance(instance, Identity):
+            after_commit(instance, matcher.add_identity, instance.id,
+                         instance.nick)
+        elif isinstance(instance, Event):
+            store_mentions(connection, matcher, instance.id,
+                           instance.channel_id, instance.identity_id,
+                           instance.message)
+            after_commit(instance, matcher.add_member, instance.channel_id,
+                         instance.identity_id)
+        return EXT_CONTINUE
+
+mention_extension = MentionIndexExtension()
+
+class ChannelDayExtension(MapperExtension):
+    """Numbers each ingested event within its channel's day."""
+
+    def before_insert(self, mapper, connection, instance):
+        from ilog.utils.days import next_sequence, utc_day
+        if instance.stamp is not None and instance.channel_id is not None:
+            instance.seq = next_sequence(connection, instance.channel_id,
+                                         utc_day(instance.stamp))
+        return EXT_CONTINUE
+
+    def after_insert(self, mapper, connection, instance):
+        from ilog.utils.days import record_event, utc_day
+        if instance.seq is not None:
+            record_event(connection, instance.channel_id,
+                         utc_day(instance.stamp), instance.seq, instance.id)
+        return EXT_CONTINUE
+
+class ActivityExtension(MapperExtension):
+    """Counts each ingested event in the hourly activity rollups."""
+
+    def after_insert(self, mapper, connection, instance):
+        from ilog.utils.activity import record_event
+        if instance.stamp is not None and instance.channel_id is not None:
+            record_event(connection, instance.channel_id,
+                         instance.identity_id, instance.stamp)
+        return EXT_CONTINUE
+
+class ChangeLogExtension(MapperExtension):
+    """Records updated channels and identities for the sync API."""
+
+    def after_update(self, mapper, connection, instance):
+        if isinstance(instance, Channel):
+            kind = u'channel'
+        else:
+            kind = u'identity'
+        connection.execute(Change.__table__.insert(), kind=kind,
+                           object_id=instance.id)
+        return EXT_CONTINUE
+
+change_log_extension = ChangeLogExtension()
+
+class FoldExtension(MapperExtension):
+    """Stores the folded text searches match on, see
+    :func:`ilog.utils.text.fold`."""
+
+    def before_insert(self, mapper, connection, instance):
+        if isinstance(instance, Event):
+            instance.folded = instance.message and fold(instance.message) \
+                                                                    or None
+        elif isinstance(instance, Identity):
+            instance.nick_key = instance.nick and fold_token(instance.nick) \
+                                                                    or None
+        return EXT_CONTINUE
+
+    def before_update(self, mapper, connection, instance):
+        if isinstance(instance, Identity):
+            return self.before_insert(mapper, connection, instance)
+        return EXT_CONTINUE
+
+fold_extension = FoldExtension()
+
+class LinkIndexExtension(MapperExtension):
+    """Stores the URLs pasted on each ingested event."""
+
+    def after_insert(self, mapper, connection, instance):
+        from ilog.utils.links import store_event_urls
+        store_event_urls(connection, instance.id, instance.channel_id,
+                         instance.message)
+        return EXT_CONTINUE
+
 class User(DeclarativeBase):
     __tablename__ = 'users'
 
@@ -222,10 +483,14 @@ class NetworkParticipation(DeclarativeBase):
 class Identity(DeclarativeBase):
     __tablename__  = 'identities'
     __table_args__ = (db.UniqueConstraint('network_name', 'nick'), {})
+    __mapper_args__ = {'extension': [fold_extension, completion_extension,
+                                     mention_extension, change_log_extension]}
 
     id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
     network_name   = db.Column(db.ForeignKey('networks.name'))
     nick           = db.Column(db.String(64))
+    # The folded nick searches match on
+    nick_key       = db.Column(db.String(64), index=True)
     realname       = db.Column(db.String(128))
     ident          = db.Column(db.String(64))
     user_id        = db.Column(db.ForeignKey('users.username'), default=None)
@@ -234,6 +499,8 @@ class Identity(DeclarativeBase):
 class Channel(DeclarativeBase):
     __tablename__  = 'channels'
     __table_args__ = (db.UniqueConstraint('network_name', 'name', 'prefix'), {})
+    __mapper_args__ = {'extension': [completion_extension,
+                                     change_log_extension]}
 
     id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
     name           = db.Column(db.String, index=True)
@@ -242,7 +509,7 @@ class Channel(DeclarativeBase):
     key            = db.Column(db.String, nullable=True)
 
     # Topic Related
-    topic         = db.Column(db.String)
+    topic         = deferred(db.Column(db.String), group=TEXT_GROUP)
     changed_on    = db.Column('topic_changed_on', db.DateTime(timezone=True))
     changed_by_id = db.Column('topic_changed_by_identity_id',
                               db.ForeignKey('identities.id'))
@@ -250,13 +517,101 @@ class Channel(DeclarativeBase):
 
 class Event(DeclarativeBase):
     __tablename__  = 'events'
+    __mapper_args__ = {'extension': [fold_extension, ChannelDayExtension(),
+                                     ActivityExtension(),
+                                     completion_extension, mention_extension,
+                                     LinkIndexExtension()]}
+
     id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
     channel_id     = db.Column(db.ForeignKey('channels.id'), index=True)
     stamp          = db.Column(db.DateTime(timezone=True))
     type           = db.Column(db.String(10))
     identity_id    = db.Column(db.ForeignKey('identities.id'), index=True)
-    message        = db.Column(db.String)
+    message        = deferred(db.Column(db.String), group=TEXT_GROUP)
+    # The folded message searches match on
+    folded         = deferred(db.Column(db.String))
+    # Position within the channel's (UTC) day, see ilog.utils.days
+    seq            = db.Column(db.Integer)
+
+# Lets searches and day views range scan a channel's events by date
+db.Index('ix_events_channel_stamp', Event.__table__.c.channel_id,
+         Event.__table__.c.stamp)
+# Finds the event at a position of a channel's day, the stamp narrowing it
+# down to the day within the index
+db.Index('ix_events_channel_seq_stamp', Event.__table__.c.channel_id,
+         Event.__table__.c.seq, Event.__table__.c.stamp)
+
 
+class ChannelDay(DeclarativeBase):
+    __tablename__  = 'channel_days'
+
+    channel_id     = db.Column(db.ForeignKey('channels.id'), primary_key=True)
+    day            = db.Column(db.Date, primary_key=True)
+    events         = db.Column(db.Integer, nullable=False, default=0)
+    first_event_id = db.Column(db.Integer)
+    last_event_id  = db.Column(db.Integer)
+
+# Lists the channels' days by month for the sitemaps
+db.Index('ix_channel_days_day', ChannelDay.__table__.c.day)
+# Finds the days which got events since the snapshots were last written
+db.Index('ix_channel_days_last_event', ChannelDay.__table__.c.last_event_id)
+
+
+class ChannelHour(DeclarativeBase):
+    __tablename__  = 'channel_hours'
+
+    channel_id     = db.Column(db.ForeignKey('channels.id'), primary_key=True)
+    # The hour's start, UTC
+    hour           = db.Column(db.DateTime, primary_key=True)
+    events         = db.Column(db.Integer, nullable=False, default=0)
+
+
+class NickHour(DeclarativeBase):
+    __tablename__  = 'nick_hours'
+
+    identity_id    = db.Column(db.ForeignKey('identities.id'), primary_key=True)
+    channel_id     = db.Column(db.ForeignKey('channels.id'), primary_key=True)
+    hour           = db.Column(db.DateTime, primary_key=True)
+    events         = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Mention(DeclarativeBase):
+    __tablename__  = 'mentions'
+
+    # The primary key's (identity_id, event_id) ordering is what turns a
+    # mentions timeline into an index range scan.
+    identity_id    = db.Column(db.ForeignKey('identities.id'), primary_key=True)
+    event_id       = db.Column(db.ForeignKey('events.id'), primary_key=True)
+
+
+class URL(DeclarativeBase):
+    __tablename__  = 'urls'
+
+    id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    url            = db.Column(db.String, unique=True, nullable=False)
+
+
+class EventURL(DeclarativeBase):
+    __tablename__  = 'event_urls'
+
+    # (url_id, event_id) answers "who posted this URL", the index below
+    # answers "links in #channel".
+    url_id         = db.Column(db.ForeignKey('urls.id'), primary_key=True)
+    event_id       = db.Column(db.ForeignKey('events.id'), primary_key=True)
+    channel_id     = db.Column(db.ForeignKey('channels.id'), nullable=False)
+
+db.Index('ix_event_urls_channel_event', EventURL.__table__.c.channel_id,
+         EventURL.__table__.c.event_id)
+
+
+class Change(DeclarativeBase):
+    __tablename__  = 'changes'
+
+    # New channels and identities are found by their ids, only updates to
+    # them are logged here
+    id             = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    kind           = db.Column(db.String(10), nullable=False)
+    object_id      = db.Column(db.Integer, nullable=False)
 
 
 class Session(DeclarativeBase):
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.export
+    ~~~~~~~~~~~
+
+    Streaming exports of a channel's history as plain text, JSON Lines or
+    CSV.
+
+    Rows are read in batches by id, each in a session of its own, encoded
+    incrementally and, optionally, gzip compressed on the fly, so memory use
+    doesn't depend on how much is exported and no database connection is
+    held while a slow client takes the output.  :func:`iter_export` is a
+    blocking iterator of output chunks used by both the ``export`` command
+    and the web exports.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import csv
+import zlib
+import logging
+from cStringIO import StringIO
+
+from ilog.database import db, Event, Identity
+from ilog.utils.text import split_channel_name
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+log = logging.getLogger(__name__)
+
+TEXT, JSONL, CSV = 'text', 'jsonl', 'csv'
+FORMATS = {
+    TEXT: ('text/plain; charset=utf-8', 'txt'),
+    JSONL: ('application/x-ndjson; charset=utf-8', 'jsonl'),
+    CSV: ('text/csv; charset=utf-8', 'csv'),
+}
+FETCH_SIZE = 1000
+CHUNK_SIZE = 64 * 1024
+CSV_COLUMNS = ('id', 'stamp', 'type', 'nick', 'message')
+MESSAGE_TYPES = (None, u'msg', u'privmsg', u'message')
+STAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def find_channel(session, network_name, channel_name):
+    from ilog.database import Channel
+    prefix, name = split_channel_name(channel_name)
+    return session.query(Channel).filter_by(network_name=network_name,
+                                            prefix=prefix or None,
+                                            name=name).first()
+
+
+def export_rows(session, channel_id, start=None, end=None, after_id=0,
+                limit=FETCH_SIZE):
+    query = session.query(Event.id, Event.stamp, Event.type, Identity.nick,
+                          Event.message)\
+                   .outerjoin((Identity, Identity.id == Event.identity_id))\
+                   .filter(Event.channel_id == channel_id)\
+                   .filter(Event.id > after_id)
+    if start is not None:
+        query = query.filter(Event.stamp >= start)
+    if end is not None:
+        query = query.filter(Event.stamp < end)
+    return query.order_by(Event.id).limit(limit).all()
+
+
+def iter_rows(channel_id, start=None, end=None):
+    """Blocking iterator over the rows to export, each batch being read in
+    a session of its own."""
+    after_id = 0
+    while True:
+        session = db.session()
+        try:
+            rows = export_rows(session, channel_id, start, end, after_id)
+        finally:
+            session.close()
+        for row in rows:
+            yield row
+        if len(rows) < FETCH_SIZE:
+            break
+        after_id = rows[-1][0]
+
+
+def _encode(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _isoformat(stamp):
+    return stamp is not None and stamp.isoformat() or None
+
+
+def text_line(stamp, type, nick, message):
+    """A plain text log line, as days are rendered and exported as text,
+    `stamp` being already formatted."""
+    if type in MESSAGE_TYPES:
+        line = u'[%s] <%s> %s\n'
+    else:
+        line = u'[%s] * %s %s\n'
+    return line % (stamp or u'', nick or u'', message or u'')
+
+
+def encode_text(rows):
+    for event_id, stamp, type, nick, message in rows:
+        stamp = stamp is not None and stamp.strftime(STAMP_FORMAT) or u''
+        yield text_line(stamp, type, nick, message).encode('utf-8')
+
+
+def encode_jsonl(rows):
+    for event_id, stamp, type, nick, message in rows:
+        yield json.dumps({'id': event_id, 'stamp': _isoformat(stamp),
+                          'type': type, 'nick': nick, 'message': message},
+                         separators=(',', ':')) + '\n'
+
+
+def encode_csv(rows):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_COLUMNS)
+    for event_id, stamp, type, nick, message in rows:
+        writer.writerow((event_id, _encode(_isoformat(stamp)), _encode(type),
+                         _encode(nick), _encode(message)))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+ENCODERS = {TEXT: encode_text, JSONL: encode_jsonl, CSV: encode_csv}
+
+
+def coalesce(pieces, size=CHUNK_SIZE):
+    """Join small pieces into chunks of about `size` bytes."""
+    chunk, length = [], 0
+    for piece in pieces:
+        chunk.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(chunk)
+            chunk, length = [], 0
+    if chunk:
+        yield ''.join(chunk)
+
+
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def iter_export(channel_id, format=TEXT, start=None, end=None,
+                compress=False):
+    """Blocking iterator over the export's output chunks."""
+    chunks = coalesce(ENCODERS[format](iter_rows(channel_id, start, end)))
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return chunks
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.search
+    ~~~~~~~~~~~
+
+    Search query planner.
+
+    A :class:`SearchRequest` is turned into a :class:`Plan` by :func:`plan`
+    which first prunes the requested channels to the ones that hold data on
+    the requested date range, clamping the range to each channel's first and
+    last event, and then picks the cheapest of the available access paths.
+
+    Access paths estimate their cost with a bounded count, an index range
+    probe which stops after :data:`ESTIMATE_CAP` rows, so planning never
+    costs more than a few index lookups.  Date ranges are estimated from the
+    channels' days totals instead, see :mod:`ilog.utils.counts`, which is
+    cheaper still.  Use :meth:`Plan.explain` to see what was chosen and why,
+    and :attr:`Plan.total` for a rough number of results to paginate with.
+    The ``search`` command shows it with ``--explain``.
+
+    Search terms and nicks are folded with :func:`~ilog.utils.text.fold`
+    and matched, by the database, against the folded messages and nicks
+    stored at ingest, ``events.folded`` and ``identities.nick_key``.  Events
+    logged before those existed are folded by the ``backfill-folded``
+    command.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from ilog.database import db, Event, EventURL, Identity, Mention
+from ilog.utils.counts import estimate_events
+from ilog.utils.text import fold, fold_token
+
+log = logging.getLogger(__name__)
+
+ESTIMATE_CAP = 10000
+#: The columns searches return, the folded message is only matched on
+RESULT_COLUMNS = [column for column in Event.__table__.c
+                  if column.name != 'folded']
+
+
+class SearchRequest(object):
+
+    def __init__(self, terms=(), nick=None, channel_ids=None, start=None,
+                 end=None, types=None, mentions_of=None, with_links=False,
+                 before=None, limit=50):
+        self.terms = [fold(term) for term in terms if term]
+        self.nick = nick
+        self.channel_ids = channel_ids and list(channel_ids) or None
+        self.start = start
+        self.end = end
+        self.types = types and list(types) or None
+        self.mentions_of = mentions_of
+        self.with_links = with_links
+        self.before = before
+        self.limit = limit
+
+    def __repr__(self):
+        return '<%s terms=%r nick=%r channels=%r range=%s..%s types=%r>' % (
+            self.__class__.__name__, self.terms, self.nick, self.channel_ids,
+            self.start, self.end, self.types)
+
+
+def contains(column, term):
+    """``LIKE`` clause matching `term` anywhere on `column`."""
+    term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return column.like(u'%' + term + u'%', escape='\\')
+
+
+class AccessPath(object):
+    """An index the planner may drive the search from."""
+    name = None
+
+    def applies(self, request):
+        raise NotImplementedError
+
+    def driving_clause(self, plan):
+        """Clause restricting ``events`` through this path's index"""
+        raise NotImplementedError
+
+    def estimate(self, session, plan):
+        query = db.select([Event.id], self.driving_clause(plan),
+                          limit=ESTIMATE_CAP).alias('bounded')
+        return session.execute(
+            db.select([db.func.count(query.c.id)])
+        ).scalar()
+
+    def describe(self, plan):
+        return self.name
+
+
+class MentionPath(AccessPath):
+    name = 'mentions'
+
+    def applies(self, request):
+        return request.mentions_of is not None
+
+    def driving_clause(self, plan):
+        return Event.id.in_(db.select([Mention.event_id],
+                            Mention.identity_id == plan.request.mentions_of))
+
+    def describe(self, plan):
+        return 'mentions index on identity %s' % plan.request.mentions_of
+
+
+class LinkPath(AccessPath):
+    name = 'links'
+
+    def applies(self, request):
+        return request.with_links
+
+    def driving_clause(self, plan):
+        clause = db.select([EventURL.event_id])
+        if plan.channel_ranges is not None:
+            clause = clause.where(
+                EventURL.channel_id.in_(plan.channel_ranges.keys())
+            )
+        return Event.id.in_(clause)
+
+    def describe(self, plan):
+        return 'event_urls index on (channel_id, event_id)'
+
+
+class IdentityPath(AccessPath):
+    name = 'identity'
+
+    def applies(self, request):
+        return request.nick is not None
+
+    def driving_clause(self, plan):
+        return Event.identity_id.in_(plan.identity_ids or [-1])
+
+    def describe(self, plan):
+        return 'events index on identity_id (%d identities for %r)' % (
+            len(plan.identity_ids), plan.request.nick)
+
+
+class ChannelRangePath(AccessPath):
+    name = 'channel-range'
+
+    def applies(self, request):
+        return True
+
+    def driving_clause(self, plan):
+        if plan.channel_ranges is None:
+            return plan.date_clause(Event.stamp, plan.request.start,
+                                    plan.request.end)
+        return db.or_(*[
+            db.and_(Event.channel_id == channel_id,
+                    plan.date_clause(Event.stamp, start, end))
+            for channel_id, (start, end) in plan.channel_ranges.iteritems()
+        ])
+
+    def estimate(self, session, plan):
+        if plan.channel_ranges is None:
+            total = estimate_events(session, None, plan.request.start,
+                                    plan.request.end)
+        else:
+            total = 0
+            for channel_id, (start, end) in plan.channel_ranges.iteritems():
+                days = estimate_events(session, [channel_id], start, end)
+                if days is None:
+                    total = None
+                    break
+                total += days
+        if total is None:
+            # The days weren't numbered yet
+            return AccessPath.estimate(self, session, plan)
+        return min(total, ESTIMATE_CAP)
+
+    def describe(self, plan):
+        if plan.channel_ranges is None:
+            return 'events scan on stamp'
+        return 'events index on (channel_id, stamp), %d segments' % (
+            len(plan.channel_ranges))
+
+
+#: The available access paths, by order of preference when the estimates
+#: tie.  Further indexes register themselves by appending to this list.
+ACCESS_PATHS = [MentionPath(), LinkPath(), IdentityPath(), ChannelRangePath()]
+
+
+class Plan(object):
+
+    def __init__(self, request):
+        self.request = request
+        self.path = None
+        self.estimates = []
+        self.identity_ids = []
+        self.channel_ranges = None
+        self.pruned = []
+
+    @property
+    def empty(self):
+        return self.channel_ranges is not None and not self.channel_ranges
+
+    @property
+    def total(self):
+        """Rough number of results, the chosen path's estimate.  It's capped
+        at :data:`ESTIMATE_CAP` and neither the terms nor the filters which
+        don't drive the plan are accounted for."""
+        if self.empty or not self.estimates:
+            return 0
+        return min(estimate for estimate, path in self.estimates)
+
+    def date_clause(self, column, start, end):
+        clauses = []
+        if start is not None:
+            clauses.append(column >= start)
+        if end is not None:
+            clauses.append(column < end)
+        return db.and_(*clauses)
+
+    def filter_clauses(self, before=None):
+        request = self.request
+        clauses = [path.driving_clause(self) for estimate, path in
+                   self.estimates if path is not self.path]
+        for term in request.terms:
+            clauses.append(contains(Event.folded, term))
+        if request.types:
+            clauses.append(Event.type.in_(request.types))
+        if before is not None:
+            clauses.append(Event.id < before)
+        return clauses
+
+    def query(self, columns=None, before=None, limit=None):
+        if before is None:
+            before = self.request.before
+        return db.select(
+            columns or RESULT_COLUMNS,
+            db.and_(self.path.driving_clause(self),
+                    *self.filter_clauses(before)),
+            order_by=[Event.id.desc()], limit=limit or self.request.limit
+        )
+
+    def execute(self, session):
+        if self.empty:
+            return []
+        return session.execute(self.query()).fetchall()
+
+    def explain(self, session=None):
+        request = self.request
+        lines = ['Search plan for %r' % request]
+        if self.empty:
+            lines.append('  no channel holds data in range, nothing to run')
+        else:
+            lines.append('  access path: %s' % self.path.describe(self))
+        for estimate, path in self.estimates:
+            lines.append('    %-14s est. %s%d rows%s' % (
+                path.name, estimate >= ESTIMATE_CAP and '>=' or '', estimate,
+                path is self.path and '  <- chosen' or ''))
+        if request.channel_ids:
+            lines.append('  channels: %d requested, %d pruned' % (
+                len(request.channel_ids), len(self.pruned)))
+            for channel_id, (start, end) in \
+                                    sorted(self.channel_ranges.iteritems()):
+                lines.append('    channel %s: %s .. %s' % (channel_id,
+                                                           start, end))
+            for channel_id in self.pruned:
+                lines.append('    channel %s: pruned' % channel_id)
+        if not self.empty:
+            lines.append('  approx. total: %s%d' % (
+                self.total >= ESTIMATE_CAP and '>=' or '<=', self.total))
+        if request.terms:
+            lines.append('  terms: %s (folded, matched on events.folded)' %
+                         ', '.join(request.terms))
+        if request.types:
+            lines.append('  types: %s' % ', '.join(request.types))
+        if session is not None and not self.empty:
+            lines.append('  SQL:')
+            lines.extend('    ' + line
+                         for line in str(self.query()).splitlines())
+        return '\n'.join(lines)
+
+
+def prune_channels(session, plan):
+    """Clamp the request's date range to each channel's data and drop the
+    channels which have nothing on it."""
+    request = plan.request
+    plan.channel_ranges = {}
+    for channel_id in request.channel_ids:
+        first, last = session.execute(
+            db.select([db.func.min(Event.stamp), db.func.max(Event.stamp)],
+                      Event.channel_id == channel_id)
+        ).fetchone()
+        if first is None or (request.end is not None and first >= request.end)\
+                or (request.start is not None and last < request.start):
+            plan.pruned.append(channel_id)
+            continue
+        start = request.start is not None and max(first, request.start) \
+                                                                    or first
+        end = request.end
+        if end is None or end > last:
+            end = None  # open ended, new events may arrive meanwhile
+        plan.channel_ranges[channel_id] = (start, end)
+
+
+def plan(session, request):
+    search_plan = Plan(request)
+    if request.nick is not None:
+        search_plan.identity_ids = [
+            identity_id for (identity_id,) in session.execute(
+                db.select([Identity.id],
+                          Identity.nick_key == fold_token(request.nick)))
+        ]
+    if request.channel_ids:
+        prune_channels(session, search_plan)
+        if search_plan.empty:
+            return search_plan
+
+    for path in ACCESS_PATHS:
+        if path.applies(request):
+            search_plan.estimates.append(
+                (path.estimate(session, search_plan), path)
+            )
+    search_plan.path = min(search_plan.estimates,
+                           key=lambda (estimate, path): estimate)[1]
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug(search_plan.explain())
+    return search_plan
+
+
+def search(session, request):
+    return plan(session, request).execute(session)
+
+
+def backfill(engine, batch_size=1000):
+    """Fold the nicks and messages logged before they were folded at
+    ingest, `batch_size` events per transaction.  Only what's not folded yet
+    is looked at, so it's safe to re-run or to interrupt."""
+    identities, events = Identity.__table__, Event.__table__
+    connection = engine.connect()
+    try:
+        rows = connection.execute(db.select(
+            [identities.c.id, identities.c.nick],
+            db.and_(identities.c.nick_key == None,
+                    identities.c.nick != None))).fetchall()
+        if rows:
+            connection.execute(
+                identities.update(identities.c.id == db.bindparam('key'),
+                                  values={identities.c.nick_key:
+                                          db.bindparam('value')}),
+                [{'key': identity_id, 'value': fold_token(nick)}
+                 for identity_id, nick in rows])
+    finally:
+        connection.close()
+
+    last_id, folded = 0, 0
+    while True:
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.message],
+                db.and_(events.c.id > last_id, events.c.folded == None,
+                        events.c.message != None),
+                order_by=[events.c.id], limit=batch_size
+            )).fetchall()
+            if rows:
+                connection.execute(
+                    events.update(events.c.id == db.bindparam('key'),
+                                  values={events.c.folded:
+                                          db.bindparam('value')}),
+                    [{'key': event_id, 'value': fold(message)}
+                     for event_id, message in rows])
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        folded += len(rows)
+        log.info("Folded events up to %d, %d so far", last_id, folded)
+    return folded
@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.static
+    ~~~~~~~~~~~
+
+    Static copy of the archive, for serving from a plain file server.
+
+    Every closed channel day is written as ``<network>/<channel>/<day>.html``
+    and ``.txt``, with an ``index.html`` listing at each level.  Days are
+    rendered by a pool of processes.
+
+    The manifest, :data:`MANIFEST` at the output's root, keeps a hash of
+    each day's state, its :class:`~ilog.database.ChannelDay` row and the
+    day template, and of each index page's content.  On later runs only the
+    days whose state changed are rendered again, and only the index pages
+    whose content changed are written, so the files' modification times
+    stay meaningful to the file server and to mirroring tools.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import logging
+import multiprocessing
+from hashlib import sha1
+from os.path import dirname, exists, isdir, join
+from urllib import quote
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from ilog import application as app
+from ilog.database import db, Channel, ChannelDay, Network
+from ilog.utils import templates
+from ilog.web import caching
+from ilog.web.browser import (DAY_FORMAT, HTML, TEXT, DayLog, ListingPage,
+                              TEXT_SUFFIX)
+
+log = logging.getLogger(__name__)
+
+MANIFEST = '.ilog-static.json'
+HTML_SUFFIX = '.html'
+INDEX = 'index.html'
+#: Save the manifest every so many rendered days, to resume from there
+SAVE_EVERY = 500
+
+
+class StaticDayLog(DayLog):
+    link_suffix = HTML_SUFFIX
+
+
+class StaticListingPage(ListingPage):
+
+    def __init__(self, title, items):
+        ListingPage.__init__(self)
+        self.title = title
+        self.items = items
+
+    def data_items(self, ctx, data):
+        return self.items
+
+
+def disk_name(name):
+    """A network or channel name as a file name."""
+    return name.replace(u'/', u'%2F').encode('utf-8')
+
+
+def href(name):
+    return quote(name, safe='') + '/'
+
+
+def write_file(path, data):
+    if not isdir(dirname(path)):
+        os.makedirs(dirname(path))
+    output = open(path + '.tmp', 'wb')
+    try:
+        output.write(data)
+    finally:
+        output.close()
+    os.rename(path + '.tmp', path)
+
+
+def render_listing(title, items):
+    """Render an index page, without a request or a reactor, which works
+    as the listing's data is at hand."""
+    result = []
+    StaticListingPage(title, items).renderString().addBoth(result.append)
+    if hasattr(result[0], 'raiseException'):
+        result[0].raiseException()
+    return result[0]
+
+
+def template_hash():
+    fileobj = open(templates.get(DayLog.template_name).path, 'rb')
+    try:
+        return sha1(fileobj.read()).hexdigest()
+    finally:
+        fileobj.close()
+
+
+def day_state(template, channel_id, day, events, last_event_id):
+    return sha1('%s:%s:%s:%s:%s' % (template, channel_id, day.isoformat(),
+                                    events, last_event_id)).hexdigest()
+
+
+class Manifest(object):
+
+    def __init__(self, directory):
+        self.path = join(directory, MANIFEST)
+        self.days, self.pages = {}, {}
+        if exists(self.path):
+            data = json.load(open(self.path))
+            self.days, self.pages = data['days'], data['pages']
+
+    def save(self):
+        write_file(self.path, json.dumps({'days': self.days,
+                                          'pages': self.pages}))
+
+
+def init_worker():
+    # The connections inherited from the parent process can't be shared
+    app.database_engine.dispose()
+
+
+def render_day((channel_id, day, directory, key, state)):
+    """Write a day's pages, runs on a pool process."""
+    session = db.session()
+    try:
+        day_log = StaticDayLog(session.query(Channel).get(channel_id), day)
+        name = day.strftime(DAY_FORMAT)
+        files = {HTML: join(directory, name + HTML_SUFFIX),
+                 TEXT: join(directory, name + TEXT_SUFFIX)}
+        outputs = {}
+        try:
+            for format, path in files.iteritems():
+                outputs[format] = open(path + '.tmp', 'wb')
+                outputs[format].write(day_log.parts(format)[0])
+            for rows in day_log.iter_chunks(session):
+                for format, output in outputs.iteritems():
+                    output.write(day_log.render(rows, format))
+            for format, output in outputs.iteritems():
+                output.write(day_log.parts(format)[1])
+        finally:
+            for output in outputs.itervalues():
+                output.close()
+        for path in files.itervalues():
+            os.rename(path + '.tmp', path)
+    finally:
+        session.close()
+    return key, state
+
+
+class StaticExport(object):
+
+    def __init__(self, directory, processes=None, force=False):
+        self.directory = directory
+        self.processes = processes or multiprocessing.cpu_count()
+        self.force = force
+        self.manifest = Manifest(directory)
+        self.written = 0
+
+    def read(self):
+        """Return the networks, their channels and the closed days."""
+        session = db.session()
+        try:
+            networks = [name for (name,) in session.query(Network.name)
+                                                   .order_by(Network.name)]
+            channels = session.query(Channel.id, Channel.network_name,
+                                     Channel.prefix, Channel.name)\
+                              .order_by(Channel.name).all()
+            days = {}
+            for channel_id, day, events, last_event_id in session.query(
+                        ChannelDay.channel_id, ChannelDay.day,
+                        ChannelDay.events, ChannelDay.last_event_id)\
+                    .order_by(ChannelDay.day.desc()):
+                if caching.is_closed_day(day):
+                    days.setdefault(channel_id, []).append(
+                        (day, events, last_event_id))
+        finally:
+            session.close()
+        return networks, channels, days
+
+    def channel_directory(self, network_name, prefix, name):
+        return join(self.directory, disk_name(network_name),
+                    disk_name((prefix or u'') + name))
+
+    def write_page(self, relative, data):
+        """Write an index page, unless its content didn't change."""
+        if isinstance(data, unicode):
+            data = data.encode('utf-8')
+        digest = sha1(data).hexdigest()
+        path = join(self.directory, relative)
+        # As it's read back from the manifest
+        key = relative.decode('utf-8')
+        if not self.force and self.manifest.pages.get(key) == digest \
+                                                            and exists(path):
+            return
+        write_file(path, data)
+        self.manifest.pages[key] = digest
+        self.written += 1
+
+    def pending_days(self, channels, days):
+        template = template_hash()
+        tasks = []
+        for channel_id, network_name, prefix, name in channels:
+            directory = self.channel_directory(network_name, prefix, name)
+            for day, events, last_event_id in days.get(channel_id, ()):
+                key = '%d/%s' % (channel_id, day.isoformat())
+                state = day_state(template, channel_id, day, events,
+                                  last_event_id)
+                if not self.force and self.manifest.days.get(key) == state \
+                        and exists(join(directory, day.strftime(DAY_FORMAT) +
+                                        HTML_SUFFIX)):
+                    continue
+                tasks.append((channel_id, day, directory, key, state))
+        return tasks
+
+    def render_days(self, tasks):
+        for directory in set(task[2] for task in tasks):
+            if not isdir(directory):
+                os.makedirs(directory)
+        pool = multiprocessing.Pool(self.processes, init_worker)
+        try:
+            rendered = 0
+            for key, state in pool.imap_unordered(render_day, tasks,
+                                                  chunksize=4):
+                self.manifest.days[key] = state
+                rendered += 1
+                if rendered % SAVE_EVERY == 0:
+                    self.manifest.save()
+                    log.info("Rendered %d of %d days", rendered, len(tasks))
+            pool.close()
+        except:
+            pool.terminate()
+            self.manifest.save()
+            raise
+        finally:
+            pool.join()
+        return rendered
+
+    def render_indexes(self, networks, channels, days):
+        self.write_page(INDEX, render_listing(u'Networks', [
+            (href(disk_name(name)), name) for name in networks
+        ]))
+        for network_name in networks:
+            network_channels = [channel for channel in channels
+                                if channel[1] == network_name]
+            self.write_page(join(disk_name(network_name), INDEX),
+                            render_listing(network_name, [
+                (href(disk_name((prefix or u'') + name)),
+                 (prefix or u'') + name)
+                for channel_id, network, prefix, name in network_channels
+            ]))
+            for channel_id, network, prefix, name in network_channels:
+                title = u'%s%s on %s' % (prefix or u'', name, network_name)
+                self.write_page(
+                    join(disk_name(network_name),
+                         disk_name((prefix or u'') + name), INDEX),
+                    render_listing(title, [
+                        (day.strftime(DAY_FORMAT) + HTML_SUFFIX,
+                         u'%s (%d events)' % (day, events))
+                        for day, events, last_event_id
+                        in days.get(channel_id, ())
+                    ])
+                )
+
+    def run(self):
+        networks, channels, days = self.read()
+        tasks = self.pending_days(channels, days)
+        log.info("%d days to render", len(tasks))
+        rendered = tasks and self.render_days(tasks) or 0
+        self.render_indexes(networks, channels, days)
+        self.manifest.save()
+        return rendered, self.written
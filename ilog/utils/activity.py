@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.activity
+    ~~~~~~~~~~~~~~~~~~~
+
+    Hourly activity rollups.
+
+    As events are ingested, :class:`~ilog.database.ChannelHour` counts them
+    per channel and UTC hour and :class:`~ilog.database.NickHour` per nick,
+    channel and hour.  Activity charts read only those, and the
+    :class:`~ilog.database.ChannelDay` totals, never the events.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import date, timedelta
+
+from ilog.utils.tz import (DAY_SECONDS, EPOCH, day_bounds, local_epochs,
+                           utc_naive)
+
+log = logging.getLogger(__name__)
+
+#: 1970-01-01 was a Thursday
+EPOCH_WEEKDAY = 3
+
+
+def utc_hour(stamp):
+    return utc_naive(stamp).replace(minute=0, second=0, microsecond=0)
+
+
+def increment(connection, table, keys, events=1):
+    from ilog.database import db
+
+    where = db.and_(*[table.c[name] == value
+                      for name, value in keys.iteritems()])
+    update = table.update(where, values={
+        table.c.events: table.c.events + events
+    })
+    if not connection.execute(update).rowcount:
+        if db.insert_if_absent(connection, table, events=events,
+                               **keys) is None:
+            # A concurrent ingest started the hour meanwhile
+            connection.execute(update)
+
+
+def record_event(connection, channel_id, identity_id, stamp):
+    from ilog.database import ChannelHour, NickHour
+
+    hour = utc_hour(stamp)
+    increment(connection, ChannelHour.__table__,
+              {'channel_id': channel_id, 'hour': hour})
+    if identity_id is not None:
+        increment(connection, NickHour.__table__,
+                  {'identity_id': identity_id, 'channel_id': channel_id,
+                   'hour': hour})
+
+
+def backfill(engine, batch_size=1000):
+    """Rebuild the rollups from the already logged events.  The logger must
+    not be running meanwhile."""
+    from ilog.database import db, ChannelHour, Event, NickHour
+
+    events = Event.__table__
+    channel_hours, nick_hours = {}, {}
+    last_id = 0
+    connection = engine.connect()
+    try:
+        while True:
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.channel_id, events.c.identity_id,
+                 events.c.stamp],
+                events.c.id > last_id, order_by=[events.c.id],
+                limit=batch_size
+            )).fetchall()
+            if not rows:
+                break
+            for event_id, channel_id, identity_id, stamp in rows:
+                if stamp is None or channel_id is None:
+                    continue
+                hour = utc_hour(stamp)
+                key = (channel_id, hour)
+                channel_hours[key] = channel_hours.get(key, 0) + 1
+                if identity_id is not None:
+                    key = (identity_id, channel_id, hour)
+                    nick_hours[key] = nick_hours.get(key, 0) + 1
+            last_id = rows[-1][0]
+            log.info("Rolled up events up to %d", last_id)
+
+        transaction = connection.begin()
+        try:
+            connection.execute(ChannelHour.__table__.delete())
+            connection.execute(NickHour.__table__.delete())
+            if channel_hours:
+                connection.execute(ChannelHour.__table__.insert(), [
+                    {'channel_id': channel_id, 'hour': hour, 'events': total}
+                    for (channel_id, hour), total in channel_hours.iteritems()
+                ])
+            if nick_hours:
+                connection.execute(NickHour.__table__.insert(), [
+                    {'identity_id': identity_id, 'channel_id': channel_id,
+                     'hour': hour, 'events': total}
+                    for (identity_id, channel_id, hour), total
+                    in nick_hours.iteritems()
+                ])
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+    finally:
+        connection.close()
+    return len(channel_hours)
+
+
+def year_bounds(year, zone=None):
+    return (day_bounds(date(year, 1, 1), zone)[0],
+            day_bounds(date(year + 1, 1, 1), zone)[0])
+
+
+def channel_years(connection, channel_id):
+    """Return the first and last years a channel has events on, in any
+    timezone, or ``None`` when it has none."""
+    from ilog.database import db, ChannelDay
+
+    table = ChannelDay.__table__
+    first, last = connection.execute(db.select(
+        [db.func.min(table.c.day), db.func.max(table.c.day)],
+        table.c.channel_id == channel_id
+    )).fetchone()
+    if first is None:
+        return None
+    # A UTC day is the day before or after in some timezones
+    return ((first - timedelta(days=1)).year,
+            (last + timedelta(days=1)).year)
+
+
+def find_identities(connection, network_name, nick):
+    from ilog.database import db, Identity
+
+    identities = Identity.__table__
+    return [identity_id for (identity_id,) in connection.execute(db.select(
+        [identities.c.id], db.and_(identities.c.network_name == network_name,
+                                   identities.c.nick == nick)
+    ))]
+
+
+def hourly_counts(connection, channel_id, start, end, identity_ids=None):
+    """Return ``(hour, events)`` for the hours between `start` and `end`
+    with events, of the whole channel or of the given identities only."""
+    from ilog.database import db, ChannelHour, NickHour
+
+    if identity_ids is None:
+        table = ChannelHour.__table__
+        query = db.select([table.c.hour, table.c.events],
+                          table.c.channel_id == channel_id)
+    else:
+        table = NickHour.__table__
+        query = db.select([table.c.hour, db.func.sum(table.c.events)],
+                          db.and_(table.c.channel_id == channel_id,
+                                  table.c.identity_id.in_(identity_ids or
+                                                          [-1])))\
+                  .group_by(table.c.hour)
+    query = query.where(db.and_(table.c.hour >= start, table.c.hour < end))
+    return [(hour, int(events)) for hour, events in
+            connection.execute(query.order_by(table.c.hour))]
+
+
+def daily_counts(connection, channel_id, year, zone=None, identity_ids=None):
+    """Return the events of each of `year`'s days, in `zone`."""
+    from ilog.database import db, ChannelDay
+
+    if zone is None and identity_ids is None:
+        # The channel days already are
+        table = ChannelDay.__table__
+        return dict(connection.execute(db.select(
+            [table.c.day, table.c.events],
+            db.and_(table.c.channel_id == channel_id,
+                    table.c.day >= date(year, 1, 1),
+                    table.c.day < date(year + 1, 1, 1))
+        )).fetchall())
+    start, end = year_bounds(year, zone)
+    rows = hourly_counts(connection, channel_id, start, end, identity_ids)
+    counts = {}
+    for seconds, (hour, events) in zip(local_epochs([hour for hour, events
+                                                     in rows], zone), rows):
+        day = (EPOCH + timedelta(days=seconds // DAY_SECONDS)).date()
+        counts[day] = counts.get(day, 0) + events
+    return counts
+
+
+def weekly_counts(connection, channel_id, year, zone=None,
+                  identity_ids=None):
+    """Return the events of `year` by weekday, ``0`` being Monday, and hour
+    of the day, in `zone`."""
+    start, end = year_bounds(year, zone)
+    rows = hourly_counts(connection, channel_id, start, end, identity_ids)
+    counts = {}
+    for seconds, (hour, events) in zip(local_epochs([hour for hour, events
+                                                     in rows], zone), rows):
+        days, seconds = divmod(seconds, DAY_SECONDS)
+        key = ((days + EPOCH_WEEKDAY) % 7, seconds // 3600)
+        counts[key] = counts.get(key, 0) + events
+    return counts
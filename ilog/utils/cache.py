@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.cache
+    ~~~~~~~~~~~~~~~~
+
+    A least recently used cache bounded by the bytes it holds rather than by
+    its number of entries.
+
+    Values are produced through :meth:`FragmentCache.get_or_create` which
+    makes sure a missing value is only produced once no matter how many
+    requests ask for it meanwhile, they all wait on the same result.
+
+    The cache is meant to be used from the reactor thread only.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import logging
+
+from twisted.internet import defer, task
+
+log = logging.getLogger(__name__)
+
+#: Bytes accounted to each entry besides its value's length
+ENTRY_OVERHEAD = 256
+REPORT_INTERVAL = 15 * 60
+
+# Positions in an entry, entries are also the links of the LRU list
+PREV, NEXT, KEY, VALUE, SIZE, EXPIRES = range(6)
+
+
+class FragmentCache(object):
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.entries = {}
+        # The LRU list's sentinel, root[NEXT] is the least recently used
+        self.root = root = []
+        root[:] = [root, root, None, None, 0, None]
+        self.bytes = 0
+        self.hits = self.misses = 0
+        self.pending = {}
+        self.reporter = task.LoopingCall(self.report)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def start(self):
+        self.reporter.start(REPORT_INTERVAL, now=False)
+
+    def stop(self):
+        if self.reporter.running:
+            self.reporter.stop()
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+
+    def _link(self, entry):
+        # Make it the most recently used
+        root = self.root
+        entry[PREV], entry[NEXT] = root[PREV], root
+        root[PREV][NEXT] = root[PREV] = entry
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        if entry[EXPIRES] is not None and entry[EXPIRES] <= time.time():
+            self.remove(key)
+            self.misses += 1
+            return default
+        self._unlink(entry)
+        self._link(entry)
+        self.hits += 1
+        return entry[VALUE]
+
+    def put(self, key, value, size=None, ttl=None):
+        """Store `value`, which, unless its `size` is given, must be a string.
+        Entries with a `ttl` expire after that many seconds."""
+        if size is None:
+            size = len(value)
+        size += ENTRY_OVERHEAD
+        self.remove(key)
+        if size > self.budget:
+            return
+        expires = ttl is not None and time.time() + ttl or None
+        entry = [None, None, key, value, size, expires]
+        self._link(entry)
+        self.entries[key] = entry
+        self.bytes += size
+        while self.bytes > self.budget:
+            self.remove(self.root[NEXT][KEY])
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._unlink(entry)
+            self.bytes -= entry[SIZE]
+
+    def clear(self):
+        self.entries.clear()
+        self.root[:] = [self.root, self.root, None, None, 0, None]
+        self.bytes = 0
+
+    def get_or_create(self, key, create, size=len, ttl=None):
+        """Return a deferred firing with the cached value for `key`, calling
+        `create`, which may return a deferred, to produce it when missing.
+        `size` is called on the new value to get its size.
+
+        Concurrent misses for the same key share a single call to `create`.
+        """
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            return defer.succeed(value)
+        if key in self.pending:
+            waiter = defer.Deferred()
+            self.pending[key].append(waiter)
+            return waiter
+
+        waiters = self.pending[key] = []
+        def created(value):
+            del self.pending[key]
+            self.put(key, value, size(value), ttl)
+            for waiter in waiters:
+                waiter.callback(value)
+            return value
+        def failed(failure):
+            # Nothing's cached, the next request tries again
+            del self.pending[key]
+            for waiter in waiters:
+                waiter.errback(failure)
+            return failure
+        return defer.maybeDeferred(create).addCallbacks(created, failed)
+
+    @property
+    def hit_ratio(self):
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'bytes': self.bytes,
+                'budget': self.budget, 'hits': self.hits,
+                'misses': self.misses, 'hit_ratio': self.hit_ratio}
+
+    def report(self):
+        log.info("%d cached fragments holding %d of %d bytes, %.1f%% hit "
+                 "ratio", len(self.entries), self.bytes, self.budget,
+                 self.hit_ratio * 100)
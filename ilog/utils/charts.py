@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.charts
+    ~~~~~~~~~~~~~~~~~
+
+    Activity charts, a year's calendar and a weekday by hour heatmap.
+
+    A :class:`Chart` is laid out once and then drawn either to SVG or, when
+    PIL is available, to PNG, see :data:`RENDERERS`.  Its :meth:`digest`
+    covers everything that's drawn, it addresses the rendered chart.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from datetime import date, timedelta
+from hashlib import sha1
+from StringIO import StringIO
+from xml.sax.saxutils import escape
+
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    try:
+        import Image, ImageDraw
+    except ImportError:
+        Image = ImageDraw = None
+
+#: Bump when the way charts look changes, so they're drawn again
+CHART_VERSION = 1
+CELL = 11
+STEP = CELL + 2
+LEFT = 30
+TOP = 15
+BACKGROUND = '#ffffff'
+TEXT_COLOUR = '#767676'
+FONT_SIZE = 9
+#: From no activity to the most active
+COLOURS = ('#ebedf0', '#c6e48b', '#7bc96f', '#239a3b', '#196127')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep',
+          'Oct', 'Nov', 'Dec')
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+
+class Chart(object):
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        #: (x, y, level, title)
+        self.cells = []
+        #: (x, y, text), y being the text's baseline
+        self.labels = []
+
+    def cell(self, x, y, level, title):
+        self.cells.append((x, y, level, title))
+
+    def label(self, x, y, text):
+        self.labels.append((x, y, text))
+
+    def digest(self, format):
+        return sha1(repr((CHART_VERSION, format, self.width, self.height,
+                          self.cells, self.labels))).hexdigest()
+
+
+def leveller(values):
+    top = max(values or [0])
+    def level(value):
+        if not value or not top:
+            return 0
+        return min(-(-value * (len(COLOURS) - 1) // top), len(COLOURS) - 1)
+    return level
+
+
+def calendar_chart(year, counts):
+    """Lay out a calendar of `year`, `counts` holding the events per day."""
+    first = date(year, 1, 1)
+    offset = first.weekday()
+    days = (date(year + 1, 1, 1) - first).days
+    weeks = (offset + days + 6) // 7
+    chart = Chart(LEFT + weeks * STEP, TOP + 7 * STEP)
+    level = leveller(counts.values())
+    for index in range(days):
+        day = first + timedelta(days=index)
+        week, weekday = divmod(offset + index, 7)
+        events = counts.get(day, 0)
+        chart.cell(LEFT + week * STEP, TOP + weekday * STEP, level(events),
+                   u'%s: %d events' % (day.isoformat(), events))
+        if day.day == 1:
+            chart.label(LEFT + week * STEP, TOP - 4, MONTHS[day.month - 1])
+    for weekday in (0, 2, 4):
+        chart.label(0, TOP + weekday * STEP + CELL - 2, WEEKDAYS[weekday])
+    return chart
+
+
+def heatmap_chart(counts):
+    """Lay out a weekday by hour heatmap, `counts` holding the events per
+    ``(weekday, hour)``."""
+    chart = Chart(LEFT + 24 * STEP, TOP + 7 * STEP)
+    level = leveller(counts.values())
+    for weekday, name in enumerate(WEEKDAYS):
+        for hour in range(24):
+            events = counts.get((weekday, hour), 0)
+            chart.cell(LEFT + hour * STEP, TOP + weekday * STEP,
+                       level(events),
+                       u'%s %02d:00: %d events' % (name, hour, events))
+        chart.label(0, TOP + weekday * STEP + CELL - 2, name)
+    for hour in range(0, 24, 3):
+        chart.label(LEFT + hour * STEP, TOP - 4, u'%02d' % hour)
+    return chart
+
+
+def to_svg(chart):
+    parts = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d"'
+             ' font-family="sans-serif" font-size="%d">' % (
+                chart.width, chart.height, FONT_SIZE)]
+    for x, y, text in chart.labels:
+        parts.append('<text x="%d" y="%d" fill="%s">%s</text>' % (
+            x, y, TEXT_COLOUR, escape(text)))
+    for x, y, level, title in chart.cells:
+        parts.append('<rect x="%d" y="%d" width="%d" height="%d" fill="%s">'
+                     '<title>%s</title></rect>' % (x, y, CELL, CELL,
+                                                   COLOURS[level],
+                                                   escape(title)))
+    parts.append('</svg>')
+    return u''.join(parts).encode('utf-8')
+
+
+def to_png(chart):
+    image = Image.new('RGB', (chart.width, chart.height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for x, y, level, title in chart.cells:
+        draw.rectangle([x, y, x + CELL - 1, y + CELL - 1],
+                       fill=COLOURS[level])
+    for x, y, text in chart.labels:
+        # PIL places text by its top
+        draw.text((x, y - FONT_SIZE), text.encode('ascii', 'replace'),
+                  fill=TEXT_COLOUR)
+    output = StringIO()
+    image.save(output, 'PNG')
+    return output.getvalue()
+
+
+#: Format to content type and renderer
+RENDERERS = {'svg': ('image/svg+xml', to_svg)}
+if Image is not None:
+    RENDERERS['png'] = ('image/png', to_png)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.completion
+    ~~~~~~~~~~~~~~~~~~~~~
+
+    In-memory prefix indexes used to autocomplete nicks and channel names.
+
+    Each network gets one sorted array of keys per kind which is searched with
+    :mod:`bisect`, much more compact than a node based trie when we're talking
+    about millions of nicks.  Matches are ranked by the last time the nick or
+    channel was seen active.
+
+    A one or two letters prefix matches a good part of the keys, so the top
+    matches of those prefixes are kept ranked as activity comes in, and the
+    longer prefixes rank at most :data:`MAX_SCAN` matching keys.
+
+    The indexes are kept current by the ingest of the process they're in,
+    and caught up every :data:`REFRESH_INTERVAL` seconds with the nicks,
+    channels and activity other processes logged.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import heapq
+import logging
+import threading
+from bisect import bisect_left, insort
+from calendar import timegm
+from itertools import groupby, islice
+from time import time
+from ilog.utils.text import fold_token
+
+log = logging.getLogger(__name__)
+
+NICKS, CHANNELS = 'nick', 'channel'
+#: Prefixes up to this long have their top matches kept ranked
+SHORT_PREFIX = 2
+#: How many of those top matches are kept, the most that can be asked for
+TOP_SIZE = 50
+#: How many keys matching a longer prefix are ranked at most
+MAX_SCAN = 5000
+#: How often, in seconds, the indexes catch up with what other processes
+#: logged
+REFRESH_INTERVAL = 60
+
+
+def completion_key(name):
+    return fold_token(unicode(name))
+
+
+def _to_epoch(stamp):
+    if stamp is None:
+        return 0
+    return timegm(stamp.utctimetuple())
+
+
+class PrefixIndex(object):
+    """Sorted array of keys with their display names and last activity."""
+
+    def __init__(self):
+        self.keys = []
+        self.names = {}
+        self.activity = {}
+        # short prefix -> its TOP_SIZE most active keys, most active first
+        self.top = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, name):
+        return completion_key(name) in self.names
+
+    def bulk_load(self, names):
+        for name in names:
+            self.names[completion_key(name)] = name
+        self.keys = sorted(self.names)
+
+    def add(self, name):
+        key = completion_key(name)
+        if key not in self.names:
+            insort(self.keys, key)
+            self.update_top(key)
+        self.names[key] = name
+        return key
+
+    def touch(self, key, stamp, rank=True):
+        """Record activity on `key`.  Pass `rank` as ``False`` when touching
+        many keys at once, and call :meth:`rank_prefixes` afterwards."""
+        if stamp > self.activity.get(key, 0):
+            self.activity[key] = stamp
+            if rank:
+                self.update_top(key)
+
+    def rank(self, key):
+        return (self.activity.get(key, 0), key)
+
+    def update_top(self, key):
+        # Activity only ever grows, so a key can only get into a top when
+        # it's touched or added
+        rank = self.rank
+        for length in xrange(1, min(len(key), SHORT_PREFIX) + 1):
+            prefix = key[:length]
+            top = self.top.get(prefix, [])
+            if key not in top:
+                if len(top) >= TOP_SIZE and rank(key) <= rank(top[-1]):
+                    continue
+                top = top + [key]
+            # A new list, it's read from other threads
+            self.top[prefix] = sorted(top, key=rank, reverse=True)[:TOP_SIZE]
+
+    def rank_prefixes(self):
+        """Rank the short prefixes' top matches from scratch."""
+        top = {}
+        for length in xrange(1, SHORT_PREFIX + 1):
+            keys = (key for key in self.keys if len(key) >= length)
+            for prefix, matches in groupby(keys, lambda key: key[:length]):
+                top[prefix] = heapq.nlargest(TOP_SIZE, matches, key=self.rank)
+        self.top = top
+
+    def iter_prefix(self, prefix):
+        prefix = completion_key(prefix)
+        keys = self.keys
+        idx = bisect_left(keys, prefix)
+        while idx < len(keys) and keys[idx].startswith(prefix):
+            yield keys[idx]
+            idx += 1
+
+    def complete(self, prefix, limit=10):
+        key = completion_key(prefix)
+        limit = min(limit, TOP_SIZE)
+        if len(key) <= SHORT_PREFIX:
+            matches = self.top.get(key, [])[:limit]
+        else:
+            matches = heapq.nlargest(limit,
+                                     islice(self.iter_prefix(key), MAX_SCAN),
+                                     key=self.rank)
+        activity = self.activity
+        return [(self.names[key], activity.get(key, 0)) for key in matches]
+
+
+class CompletionIndexes(object):
+    """Per network :class:`PrefixIndex`\es for nicks and channels.
+
+    The indexes are bulk loaded at startup by :meth:`load`, kept current
+    by the ingest mapper extensions in :mod:`ilog.database` and caught up
+    with other processes by :meth:`refresh`.
+    """
+
+    def __init__(self):
+        self.networks = {}
+        # id -> (network name, key, name), the name as it was given, as
+        # different names can fold to the same key
+        self.identities = {}
+        self.channels = {}
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        # What was loaded so far
+        self.last_identity_id = self.last_channel_id = 0
+        self.last_hour = None
+        self.loaded = None
+
+    def get_index(self, network_name, kind):
+        try:
+            indexes = self.networks[network_name]
+        except KeyError:
+            indexes = self.networks[network_name] = {
+                NICKS: PrefixIndex(), CHANNELS: PrefixIndex()
+            }
+        return indexes[kind]
+
+    def load(self, executor):
+        """Load the identities and channels and their last activity.  Only
+        what's newer than the previous load is read."""
+        from ilog.database import db, Channel, ChannelHour, Identity, NickHour
+
+        first = self.loaded is None
+        started = time()
+        identities, channels = {}, {}
+        query = db.select([Identity.id, Identity.network_name, Identity.nick],
+                          Identity.id > self.last_identity_id)
+        for identity_id, network_name, nick in executor.execute(query):
+            identities.setdefault(network_name, {})[identity_id] = nick
+
+        query = db.select([Channel.id, Channel.network_name,
+                           Channel.prefix, Channel.name],
+                          Channel.id > self.last_channel_id)
+        for channel_id, network_name, prefix, name in executor.execute(query):
+            channels.setdefault(network_name, {})[channel_id] = \
+                                                    (prefix or u'') + name
+
+        self.lock.acquire()
+        try:
+            for network_name, names in identities.iteritems():
+                self._add_all(self.identities, network_name, NICKS, names,
+                              first)
+                self.last_identity_id = max(self.last_identity_id,
+                                            max(names))
+            for network_name, names in channels.iteritems():
+                self._add_all(self.channels, network_name, CHANNELS, names,
+                              first)
+                self.last_channel_id = max(self.last_channel_id, max(names))
+        finally:
+            self.lock.release()
+
+        # Last activity is seeded from the hourly rollups, the primary keys'
+        # leading columns, rather than from the events, and is exact again
+        # once the nick or channel is next seen.  The last hour loaded is
+        # read again, it was still being counted.
+        last_hour = self.last_hour
+        for table, key, ids, kind in (
+                (NickHour, NickHour.identity_id, self.identities, NICKS),
+                (ChannelHour, ChannelHour.channel_id, self.channels,
+                 CHANNELS)):
+            query = db.select([key, db.func.max(table.hour)],
+                              group_by=[key])
+            if self.last_hour is not None:
+                query = query.where(table.hour >= self.last_hour)
+            for object_id, hour in executor.execute(query):
+                self._touch(ids, kind, object_id, _to_epoch(hour),
+                            rank=not first)
+                if last_hour is None or hour > last_hour:
+                    last_hour = hour
+        self.last_hour = last_hour
+
+        if first:
+            for indexes in self.networks.itervalues():
+                for index in indexes.itervalues():
+                    index.rank_prefixes()
+            log.info("Loaded completion indexes for %d identities and %d "
+                     "channels on %d networks", len(self.identities),
+                     len(self.channels), len(self.networks))
+        self.loaded = started
+
+    def _add_all(self, ids, network_name, kind, names, bulk):
+        index = self.get_index(network_name, kind)
+        if bulk:
+            index.bulk_load(names.values())
+        for object_id, name in names.iteritems():
+            key = bulk and completion_key(name) or index.add(name)
+            ids[object_id] = (network_name, key, name)
+
+    def stale(self):
+        return self.loaded is None or \
+                                time() - self.loaded >= REFRESH_INTERVAL
+
+    def refresh(self, executor):
+        """Load what was logged since the last load, if that's older than
+        :data:`REFRESH_INTERVAL` seconds."""
+        if not self.stale():
+            return
+        self.load_lock.acquire()
+        try:
+            if self.stale():
+                self.load(executor)
+        finally:
+            self.load_lock.release()
+
+    def _touch(self, ids, kind, object_id, stamp, rank=True):
+        try:
+            network_name, key, name = ids[object_id]
+        except KeyError:
+            return
+        self.get_index(network_name, kind).touch(key, stamp, rank)
+
+    def add_identity(self, identity_id, network_name, nick):
+        self.lock.acquire()
+        try:
+            key = self.get_index(network_name, NICKS).add(nick)
+            self.identities[identity_id] = (network_name, key, nick)
+        finally:
+            self.lock.release()
+
+    def add_channel(self, channel_id, network_name, name):
+        self.lock.acquire()
+        try:
+            key = self.get_index(network_name, CHANNELS).add(name)
+            self.channels[channel_id] = (network_name, key, name)
+        finally:
+            self.lock.release()
+
+    def add_event(self, channel_id, identity_id, stamp):
+        stamp = _to_epoch(stamp)
+        self._touch(self.identities, NICKS, identity_id, stamp)
+        self._touch(self.channels, CHANNELS, channel_id, stamp)
+
+    def get_name(self, ids, object_id):
+        try:
+            return ids[object_id][2]
+        except KeyError:
+            return None
+
+    def get_nick(self, identity_id):
+        return self.get_name(self.identities, identity_id)
+
+    def get_channel_name(self, channel_id):
+        return self.get_name(self.channels, channel_id)
+
+    def complete(self, network_name, kind, prefix, limit=10):
+        if network_name not in self.networks:
+            return []
+        return self.get_index(network_name, kind).complete(prefix, limit)
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.counts
+    ~~~~~~~~~~~~~~~~~
+
+    Event counts for pagination totals.
+
+    Counting a span of a channel's events with ``count()`` walks all of
+    them.  The :class:`~ilog.database.ChannelDay` rows already hold how many
+    events each UTC day has, so a closed span is counted by summing those,
+    the partial days at its edges, which a local day has in most timezones,
+    through the events' positions, see :func:`~ilog.utils.days.day_segments`.
+    Closed spans never change, their counts are remembered.  Only the open
+    span, the current day, is counted exactly.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import timedelta
+
+from ilog.utils.days import day_segments
+from ilog.utils.tz import day_bounds
+
+log = logging.getLogger(__name__)
+
+#: How many closed spans' counts to keep around, they never change
+COUNT_CACHE_SIZE = 50000
+_closed_counts = {}
+
+
+def exact_count(connection, channel_id, start, end):
+    from ilog.database import db, Event
+
+    events = Event.__table__
+    return connection.execute(db.select(
+        [db.func.count(events.c.id)],
+        db.and_(events.c.channel_id == channel_id,
+                events.c.stamp >= start, events.c.stamp < end)
+    )).scalar()
+
+
+def whole_days(start, end):
+    """Return the first UTC day fully between `start` and `end` and the day
+    after the last one."""
+    first = start.date()
+    if day_bounds(first)[0] < start:
+        first += timedelta(days=1)
+    return first, end.date()
+
+
+def days_total(connection, first, last, channel_ids=None):
+    """Sum the events of the days from `first` up to, not including,
+    `last`, either bound may be ``None``."""
+    from ilog.database import db, ChannelDay
+
+    table = ChannelDay.__table__
+    query = db.select([db.func.sum(table.c.events)])
+    if channel_ids is not None:
+        query = query.where(table.c.channel_id.in_(channel_ids))
+    if first is not None:
+        query = query.where(table.c.day >= first)
+    if last is not None:
+        query = query.where(table.c.day < last)
+    total = connection.execute(query).scalar()
+    if total is None:
+        return None
+    # Some databases sum to decimals
+    return int(total)
+
+
+def span_count(connection, channel_id, start, end):
+    """Count a channel's events between `start` and `end` from its days'
+    totals."""
+    first, last = whole_days(start, end)
+    if first >= last:
+        edges = [(start, end)]
+        total = 0
+    else:
+        lower, upper = day_bounds(first)[0], day_bounds(last)[0]
+        edges = [(start, lower), (upper, end)]
+        total = days_total(connection, first, last, [channel_id]) or 0
+    for edge_start, edge_end in edges:
+        if edge_start < edge_end:
+            total += sum(events for day, first_position, events in
+                         day_segments(connection, channel_id, edge_start,
+                                      edge_end))
+    return total
+
+
+def count_events(connection, channel_id, start, end, closed):
+    """Count a channel's events between `start` and `end`, exactly unless
+    the span is `closed`."""
+    if not closed:
+        return exact_count(connection, channel_id, start, end)
+    key = (channel_id, start, end)
+    try:
+        return _closed_counts[key]
+    except KeyError:
+        pass
+    total = span_count(connection, channel_id, start, end)
+    if len(_closed_counts) >= COUNT_CACHE_SIZE:
+        _closed_counts.clear()
+    _closed_counts[key] = total
+    return total
+
+
+def estimate_events(connection, channel_ids=None, start=None, end=None):
+    """Roughly count the events between `start` and `end`, on the channels
+    `channel_ids` or on all of them, from the days' totals alone.  Partial
+    days at the edges are counted whole.  Returns ``None`` when the days
+    weren't numbered yet."""
+    first = last = None
+    if start is not None:
+        first = start.date()
+    if end is not None:
+        last = end.date()
+        if day_bounds(last)[0] < end:
+            last += timedelta(days=1)
+    return days_total(connection, first, last, channel_ids)
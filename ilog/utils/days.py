@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.days
+    ~~~~~~~~~~~~~~~
+
+    Per channel and (UTC) day event sequences.
+
+    Each event gets, as it's ingested, its position within its channel's
+    day, :attr:`~ilog.database.Event.seq`, and the day's
+    :class:`~ilog.database.ChannelDay` row keeps how many events it has.
+    This resolves an event's permalink to the page of the day it's on with
+    a couple of index lookups, instead of counting the events before it.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import timedelta
+
+from ilog.utils.tz import EPOCH, day_bounds, local_epochs, utc_naive
+
+log = logging.getLogger(__name__)
+
+
+def utc_day(stamp):
+    return utc_naive(stamp).date()
+
+
+def next_sequence(connection, channel_id, day):
+    """Count one more event on a channel's day and return its position."""
+    from ilog.database import db, ChannelDay
+
+    table = ChannelDay.__table__
+    where = db.and_(table.c.channel_id == channel_id, table.c.day == day)
+    update = table.update(where, values={table.c.events: table.c.events + 1})
+    if not connection.execute(update).rowcount:
+        if db.insert_if_absent(connection, table, channel_id=channel_id,
+                               day=day, events=1) is not None:
+            return 1
+        # A concurrent ingest started the day meanwhile
+        connection.execute(update)
+    return connection.execute(db.select([table.c.events], where)).scalar()
+
+
+def record_event(connection, channel_id, day, seq, event_id):
+    from ilog.database import db, ChannelDay
+
+    table = ChannelDay.__table__
+    values = {table.c.last_event_id: event_id}
+    if seq == 1:
+        values[table.c.first_event_id] = event_id
+    connection.execute(table.update(
+        db.and_(table.c.channel_id == channel_id, table.c.day == day),
+        values=values
+    ))
+
+
+def backfill(engine, batch_size=1000):
+    """Number the already logged events and rebuild the channel days.  The
+    logger must not be running meanwhile.
+
+    A database logged to by a version without event positions first gets
+    its ``events.seq`` column and index, which is otherwise done on start.
+    """
+    from ilog.database import db, ChannelDay, Event, upgrade_database
+
+    events, days = Event.__table__, ChannelDay.__table__
+    # ALTER TABLE events ADD COLUMN seq, creating channel_days and the index
+    upgrade_database(engine)
+    counts = {}
+    last_id = 0
+    while True:
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.channel_id, events.c.stamp],
+                events.c.id > last_id, order_by=[events.c.id],
+                limit=batch_size
+            )).fetchall()
+            if not rows:
+                transaction.commit()
+                break
+            sequences = []
+            for event_id, channel_id, stamp in rows:
+                if stamp is None:
+                    continue
+                count = counts.setdefault((channel_id, utc_day(stamp)),
+                                          [0, event_id, event_id])
+                count[0] += 1
+                count[2] = event_id
+                sequences.append({'event_id': event_id, 'seq': count[0]})
+            if sequences:
+                connection.execute(events.update(
+                    events.c.id == db.bindparam('event_id'),
+                    values={events.c.seq: db.bindparam('seq')}
+                ), sequences)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        last_id = rows[-1][0]
+        log.info("Numbered events up to %d", last_id)
+
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        connection.execute(days.delete())
+        if counts:
+            connection.execute(days.insert(), [
+                {'channel_id': channel_id, 'day': day, 'events': total,
+                 'first_event_id': first_id, 'last_event_id': final_id}
+                for (channel_id, day), (total, first_id, final_id)
+                in counts.iteritems()
+            ])
+        transaction.commit()
+    except:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+    return len(counts)
+
+
+def first_sequence(connection, channel_id, start, end):
+    """Return the position within its day of the first event on a channel
+    between `start` and `end`, which must be within the same UTC day."""
+    from ilog.database import db, Event
+
+    events = Event.__table__
+    return connection.execute(db.select(
+        [events.c.seq],
+        db.and_(events.c.channel_id == channel_id,
+                events.c.stamp >= start, events.c.stamp < end),
+        order_by=[events.c.stamp, events.c.id], limit=1
+    )).scalar()
+
+
+def day_segments(connection, channel_id, start, end):
+    """Split the span from `start` to `end` on the UTC days it covers,
+    returning ``(day, first position, events)`` for the days with events.
+    """
+    from ilog.database import db, ChannelDay
+
+    table = ChannelDay.__table__
+    segments = []
+    day = start.date()
+    while True:
+        day_start, day_end = day_bounds(day)
+        if day_start >= end:
+            break
+        lower, upper = max(start, day_start), min(end, day_end)
+        total = connection.execute(db.select(
+            [table.c.events],
+            db.and_(table.c.channel_id == channel_id, table.c.day == day)
+        )).scalar()
+        if total:
+            first = 1
+            if lower > day_start:
+                first = first_sequence(connection, channel_id, lower, upper)
+            if first is not None:
+                last = total
+                if upper < day_end:
+                    after = first_sequence(connection, channel_id, upper,
+                                           day_end)
+                    if after is not None:
+                        last = after - 1
+                if last >= first:
+                    segments.append((day, first, last - first + 1))
+        day += timedelta(days=1)
+    return segments
+
+
+def segment_position(segments, stamp, seq):
+    """Return the position, from ``0``, within the span `segments` were
+    taken on of the event at position `seq` of its day, or ``None``."""
+    offset = 0
+    for day, first, count in segments:
+        if day == utc_day(stamp):
+            if first <= seq < first + count:
+                return offset + seq - first
+            return None
+        offset += count
+    return None
+
+
+def event_at(connection, channel_id, day, seq):
+    """Return the id of the event at position `seq` of a channel's UTC
+    `day`, or ``None``."""
+    from ilog.database import db, Event
+
+    events = Event.__table__
+    day_start, day_end = day_bounds(day)
+    return connection.execute(db.select(
+        [events.c.id],
+        db.and_(events.c.channel_id == channel_id, events.c.seq == seq,
+                events.c.stamp >= day_start, events.c.stamp < day_end)
+    )).scalar()
+
+
+def day_summary(connection, channel_id, day, zone=None):
+    """Return how many events a channel's `day`, in `zone`, has and the id
+    of its last one, ``(0, None)`` for a day without events.  Read off the
+    channel days and the events' positions, the day's events aren't
+    counted."""
+    from ilog.database import db, ChannelDay
+
+    if zone is None:
+        table = ChannelDay.__table__
+        row = connection.execute(db.select(
+            [table.c.events, table.c.last_event_id],
+            db.and_(table.c.channel_id == channel_id, table.c.day == day)
+        )).fetchone()
+        if row is None:
+            return 0, None
+        return tuple(row)
+
+    start, end = day_bounds(day, zone)
+    segments = day_segments(connection, channel_id, start, end)
+    if not segments:
+        return 0, None
+    last_day, first, count = segments[-1]
+    return (sum(segment[2] for segment in segments),
+            event_at(connection, channel_id, last_day, first + count - 1))
+
+
+def resolve_permalink(connection, channel_id, event_id, per_page, zone=None):
+    """Find the page of its day, in `zone`, an event is on.  Returns the
+    local day and the id of the event the page comes after, ``0`` for the
+    first page, or ``None`` when the event is unknown or wasn't numbered.
+    """
+    from ilog.database import db, Event
+
+    events = Event.__table__
+    row = connection.execute(db.select(
+        [events.c.stamp, events.c.seq],
+        db.and_(events.c.id == event_id, events.c.channel_id == channel_id)
+    )).fetchone()
+    if row is None or row[1] is None:
+        return None
+    stamp, seq = row
+    local_day = (EPOCH + timedelta(
+                        seconds=local_epochs([stamp], zone)[0])).date()
+    start, end = day_bounds(local_day, zone)
+
+    segments = day_segments(connection, channel_id, start, end)
+    position = segment_position(segments, stamp, seq)
+    if position is None:
+        return None
+
+    page = position // per_page
+    if page == 0:
+        return local_day, 0
+    # The page comes after the last event of the previous one
+    target = page * per_page - 1
+    for day, first, count in segments:
+        if target < count:
+            return local_day, event_at(connection, channel_id, day,
+                                       first + target)
+        target -= count
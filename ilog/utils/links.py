@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.links
+    ~~~~~~~~~~~~~~~~
+
+    Storage and queries for the URL index, which maps events to the
+    deduplicated URLs pasted on them.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from ilog.utils.text import find_urls
+
+log = logging.getLogger(__name__)
+
+
+def get_url_id(connection, url):
+    from ilog.database import db, URL
+
+    table = URL.__table__
+    query = db.select([table.c.id], table.c.url == url)
+    url_id = connection.execute(query).scalar()
+    if url_id is None:
+        result = db.insert_if_absent(connection, table, url=url)
+        if result is None:
+            # Inserted meanwhile by a concurrent ingest
+            return connection.execute(query).scalar()
+        url_id = result.last_inserted_ids()[0]
+    return url_id
+
+
+def store_event_urls(connection, event_id, channel_id, message):
+    from ilog.database import EventURL
+
+    urls = find_urls(message)
+    if urls:
+        connection.execute(EventURL.__table__.insert(), [
+            {'event_id': event_id, 'channel_id': channel_id,
+             'url_id': get_url_id(connection, url)} for url in urls
+        ])
+    return len(urls)
+
+
+def channel_links(session, channel_id, before=None, limit=50):
+    """Return ``(event_id, stamp, nick, url)`` rows for the links pasted on a
+    channel, newest first.  Pass the last event id seen as `before` to fetch
+    the next page."""
+    from ilog.database import db, Event, EventURL, Identity, URL
+
+    query = db.select(
+        [EventURL.event_id, Event.stamp, Identity.nick, URL.url],
+        db.and_(EventURL.channel_id == channel_id,
+                Event.id == EventURL.event_id,
+                URL.id == EventURL.url_id,
+                Identity.id == Event.identity_id),
+        order_by=[EventURL.event_id.desc()], limit=limit
+    )
+    if before is not None:
+        query = query.where(EventURL.event_id < before)
+    return session.execute(query).fetchall()
+
+
+def url_posters(session, url, limit=50):
+    """Return ``(event_id, channel_id, stamp, nick)`` rows for the events
+    where `url` was pasted, oldest first."""
+    from ilog.database import db, Event, EventURL, Identity, URL
+
+    query = db.select(
+        [EventURL.event_id, EventURL.channel_id, Event.stamp, Identity.nick],
+        db.and_(URL.url == url,
+                EventURL.url_id == URL.id,
+                Event.id == EventURL.event_id,
+                Identity.id == Event.identity_id),
+        order_by=[EventURL.event_id], limit=limit
+    )
+    return session.execute(query).fetchall()
+
+
+def backfill(engine, start_id=0, batch_size=1000):
+    """Index the URLs of the already logged events, `batch_size` events per
+    transaction.  Existing associations on each batch are replaced, so it's
+    safe to re-run or to resume from `start_id`."""
+    from ilog.database import db, Event, EventURL
+
+    events, event_urls = Event.__table__, EventURL.__table__
+    last_id, indexed = start_id, 0
+    while True:
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.channel_id, events.c.message],
+                events.c.id > last_id, order_by=[events.c.id],
+                limit=batch_size
+            )).fetchall()
+            if not rows:
+                transaction.commit()
+                break
+            connection.execute(event_urls.delete(db.and_(
+                event_urls.c.event_id > last_id,
+                event_urls.c.event_id <= rows[-1][0]
+            )))
+            for event_id, channel_id, message in rows:
+                indexed += store_event_urls(connection, event_id, channel_id,
+                                            message)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        last_id = rows[-1][0]
+        log.info("Indexed URLs up to event %d, %d URLs so far",
+                 last_id, indexed)
+    return indexed
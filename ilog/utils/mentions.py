@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.mentions
+    ~~~~~~~~~~~~~~~~~~~
+
+    Detects which known channel members are mentioned on a message.
+
+    Instead of trying every member's nick against the message, the message is
+    split once into nick shaped tokens which are then looked up in the
+    channel's member table, so the cost only depends on the message length.
+
+    Every process inserting events gets its matcher from :func:`get_matcher`,
+    loaded on first use and caught up every :data:`REFRESH_INTERVAL` seconds
+    with the identities and channel members other processes logged.
+    :func:`backfill` indexes the mentions of already logged events.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+import logging
+import threading
+from time import time
+from ilog.utils.text import fold_token
+
+log = logging.getLogger(__name__)
+
+#: How often, in seconds, a matcher catches up with what other processes
+#: logged
+REFRESH_INTERVAL = 60
+
+_nick_token_re = re.compile(r'[\w\[\]\\`^{}|-]+', re.UNICODE)
+
+
+def mention_key(nick):
+    return fold_token(unicode(nick))
+
+
+class MentionMatcher(object):
+
+    def __init__(self):
+        self.nicks = {}     # identity id -> nick key
+        self.members = {}   # channel id -> {nick key: identity id}
+        self.lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        # What was loaded so far
+        self.last_identity_id = self.last_event_id = 0
+        self.loaded = None
+
+    def load(self, executor, last_event_id=None):
+        """Load the identities and the channel members, who spoke on the
+        channel up to the event `last_event_id`, the last one by default.
+        Only what's newer than the previous load is read."""
+        from ilog.database import db, Event, Identity
+
+        first = self.loaded is None
+        if last_event_id is None:
+            last_event_id = executor.execute(
+                db.select([db.func.max(Event.id)])).scalar() or 0
+
+        query = db.select([Identity.id, Identity.nick],
+                          Identity.id > self.last_identity_id)
+        nicks = dict((identity_id, mention_key(nick))
+                     for identity_id, nick in executor.execute(query))
+        self.nicks.update(nicks)
+
+        members = {}
+        query = db.select([Event.channel_id, Event.identity_id],
+                          db.and_(Event.id > self.last_event_id,
+                                  Event.id <= last_event_id), distinct=True)
+        for channel_id, identity_id in executor.execute(query):
+            if identity_id in self.nicks:
+                members.setdefault(channel_id, {})[self.nicks[identity_id]] = \
+                                                                identity_id
+
+        self.lock.acquire()
+        try:
+            for channel_id, channel_members in members.iteritems():
+                self.members.setdefault(channel_id, {}).update(channel_members)
+        finally:
+            self.lock.release()
+        if nicks:
+            self.last_identity_id = max(self.last_identity_id, max(nicks))
+        self.last_event_id = max(self.last_event_id, last_event_id)
+        self.loaded = time()
+        if first:
+            log.info("Loaded mention matcher with %d identities on %d "
+                     "channels", len(self.nicks), len(self.members))
+
+    def refresh(self, executor):
+        """Load what was logged since the last load, if that's older than
+        :data:`REFRESH_INTERVAL` seconds."""
+        if self.loaded is not None and \
+                                time() - self.loaded < REFRESH_INTERVAL:
+            return
+        self.load_lock.acquire()
+        try:
+            if self.loaded is None or time() - self.loaded >= REFRESH_INTERVAL:
+                self.load(executor)
+        finally:
+            self.load_lock.release()
+
+    def add_identity(self, identity_id, nick):
+        self.nicks[identity_id] = mention_key(nick)
+
+    def add_member(self, channel_id, identity_id):
+        try:
+            key = self.nicks[identity_id]
+        except KeyError:
+            return
+        members = self.members.get(channel_id)
+        if members is None:
+            self.lock.acquire()
+            try:
+                members = self.members.setdefault(channel_id, {})
+            finally:
+                self.lock.release()
+        members[key] = identity_id
+
+    def find(self, channel_id, message, exclude=None):
+        """Return the set of member identity ids mentioned on `message`."""
+        members = self.members.get(channel_id)
+        if not members or not message:
+            return set()
+        found = set()
+        for token in _nick_token_re.findall(message):
+            identity_id = members.get(fold_token(token))
+            if identity_id is not None and identity_id != exclude:
+                found.add(identity_id)
+        return found
+
+
+def get_matcher(executor):
+    """Return the process' matcher, ``app.mentions``, loading or refreshing
+    it through `executor` when needed."""
+    from ilog import application as app
+
+    matcher = getattr(app, 'mentions', None)
+    if matcher is None:
+        matcher = app.mentions = MentionMatcher()
+    matcher.refresh(executor)
+    return matcher
+
+
+def store_mentions(connection, matcher, event_id, channel_id, identity_id,
+                   message):
+    from ilog.database import Mention
+
+    mentioned = matcher.find(channel_id, message, exclude=identity_id)
+    if mentioned:
+        connection.execute(Mention.__table__.insert(), [
+            {'identity_id': mentioned_id, 'event_id': event_id}
+            for mentioned_id in mentioned
+        ])
+    return len(mentioned)
+
+
+def backfill(engine, start_id=0, batch_size=1000):
+    """Index the mentions of the already logged events, `batch_size` events
+    per transaction.  Events are matched against the channel members known
+    by their time, as on ingest.  Existing mentions on each batch are
+    replaced, so it's safe to re-run or to resume from `start_id`."""
+    from ilog.database import db, Event, Mention
+
+    events, mentions = Event.__table__, Mention.__table__
+    matcher = MentionMatcher()
+    connection = engine.connect()
+    try:
+        matcher.load(connection, start_id)
+    finally:
+        connection.close()
+
+    last_id, indexed = start_id, 0
+    while True:
+        connection = engine.connect()
+        transaction = connection.begin()
+        try:
+            # Identities logged meanwhile
+            matcher.load(connection, last_id)
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.channel_id, events.c.identity_id,
+                 events.c.message],
+                events.c.id > last_id, order_by=[events.c.id],
+                limit=batch_size
+            )).fetchall()
+            if not rows:
+                transaction.commit()
+                break
+            connection.execute(mentions.delete(db.and_(
+                mentions.c.event_id > last_id,
+                mentions.c.event_id <= rows[-1][0]
+            )))
+            for event_id, channel_id, identity_id, message in rows:
+                matcher.add_member(channel_id, identity_id)
+                indexed += store_mentions(connection, matcher, event_id,
+                                          channel_id, identity_id, message)
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+        finally:
+            connection.close()
+        last_id = rows[-1][0]
+        log.info("Indexed mentions up to event %d, %d mentions so far",
+                 last_id, indexed)
+    return indexed
+
+
+def mention_timeline(session, identity_id, before=None, limit=50,
+                     text=False):
+    """Return the events mentioning `identity_id`, newest first.  Pass the
+    last event id seen as `before` to fetch the next page.  The messages are
+    only loaded along when `text` is set."""
+    from ilog.database import db, Event, Mention
+
+    query = session.query(Event).join((Mention, Mention.event_id == Event.id))\
+                                .filter(Mention.identity_id == identity_id)
+    if text:
+        query = db.with_text(query)
+    if before is not None:
+        query = query.filter(Mention.event_id < before)
+    return query.order_by(Mention.event_id.desc()).limit(limit).all()
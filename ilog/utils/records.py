@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.records
+    ~~~~~~~~~~~~~~~~~~
+
+    Lightweight read path for rendering events.
+
+    Building mapped :class:`~ilog.database.Event` instances for thousands
+    of rows spends more time in the ORM's bookkeeping than in the query.
+    :func:`fetch_events` selects only the columns rendering needs through
+    SQLAlchemy's core and wraps each row in an :class:`EventRecord`.  Nicks
+    come from the in-memory completion indexes, ``app.completion``, the
+    identities these don't know being looked up in a single query.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from ilog import application as app
+
+
+class EventRecord(object):
+    __slots__ = ('id', 'stamp', 'type', 'identity_id', 'message', 'nick')
+
+    def __init__(self, id, stamp, type, identity_id, message, nick=None):
+        self.id = id
+        self.stamp = stamp
+        self.type = type
+        self.identity_id = identity_id
+        self.message = message
+        self.nick = nick
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.id)
+
+
+def event_query(channel_id, start, end, after_id=0, limit=None):
+    from ilog.database import db, Event
+
+    events = Event.__table__
+    return db.select(
+        [events.c.id, events.c.stamp, events.c.type, events.c.identity_id,
+         events.c.message],
+        db.and_(events.c.channel_id == channel_id,
+                events.c.stamp >= start, events.c.stamp < end,
+                events.c.id > after_id),
+        order_by=[events.c.id], limit=limit
+    )
+
+
+def resolve_nicks(executor, records, nicks=None):
+    """Fill in the records' nicks.  `nicks`, identity id to nick, can be
+    passed along from one batch of records to the next."""
+    from ilog.database import db, Identity
+
+    if nicks is None:
+        nicks = {}
+    completion = getattr(app, 'completion', None)
+    missing = set()
+    for record in records:
+        identity_id = record.identity_id
+        if identity_id is None:
+            continue
+        try:
+            record.nick = nicks[identity_id]
+            continue
+        except KeyError:
+            pass
+        nick = completion is not None and completion.get_nick(identity_id) \
+                                                                    or None
+        if nick is None:
+            missing.add(identity_id)
+        else:
+            record.nick = nicks[identity_id] = nick
+    if missing:
+        identities = Identity.__table__
+        nicks.update(executor.execute(db.select(
+            [identities.c.id, identities.c.nick],
+            identities.c.id.in_(list(missing))
+        )).fetchall())
+        for record in records:
+            if record.identity_id in missing:
+                record.nick = nicks.get(record.identity_id)
+    return records
+
+
+def fetch_events(executor, channel_id, start, end, after_id=0, limit=None,
+                 nicks=None):
+    """Return the events of a channel between `start` and `end` after the
+    event `after_id` as :class:`EventRecord`\s, in order.  `executor` is a
+    connection or a session."""
+    rows = executor.execute(event_query(channel_id, start, end, after_id,
+                                        limit))
+    return resolve_nicks(executor, [EventRecord(*row) for row in rows],
+                         nicks)
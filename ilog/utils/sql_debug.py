@@ -10,16 +10,20 @@ import sys
 import logging
 import threading
 
+from collections import deque
 from time import time, strftime
 from sqlalchemy.interfaces import ConnectionProxy
-from nevow import inevow, loaders, livepage, tags as T, util
+from nevow import livepage, tags as T, util
 from nevow.livepage import set, assign, append, js, document, eol
 from twisted.internet import task, defer, threads
 from twisted.python import failure
-from ilog import utils
+from ilog.utils import templates
 
 log = logging.getLogger(__name__)
 
+#: How many queries are kept around to catch up new clients with
+QUERY_HISTORY = 200
+
 def find_calling_context(skip=3):
     """Finds the calling context."""
     frame = sys._getframe(skip)
@@ -57,17 +61,20 @@ def get_pretty_time(start, end=time()):
 
 class DatabaseConnectionDebugProxy(threading.Thread, livepage.LivePage, ConnectionProxy):
     addSlash = True
-    docFactory = loaders.xmlfile(utils.get_template('sql_debug.html'))
-    messagePattern = inevow.IQ(docFactory).patternGenerator('message')
+    docFactory = templates.get_loader('sql_debug.html')
 
     def __init__(self, group=None, target=None, name=None, *args, **kwargs):
         threading.Thread.__init__(self, group, target, name, args, kwargs)
         self.start()
         livepage.LivePage.__init__(self)
         ConnectionProxy.__init__(self)
-        self.queries = []
+        self.queries = deque(maxlen=QUERY_HISTORY)
         self.clients = []
 
+    @property
+    def messagePattern(self):
+        return templates.get('sql_debug.html').patterns('message')
+
     def cursor_execute(self, execute, cursor, statement, parameters,
                        context, executemany):
         start = time()
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.templates
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Template registry.
+
+    Every template is parsed and precompiled once, at startup, and its
+    pattern generators are kept around, so rendering never touches the disk.
+    In debug mode templates are parsed again when they change on disk.
+
+    Parse and render times are kept per template and logged periodically.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import time
+import logging
+from os.path import getmtime, join, relpath
+
+from nevow import flat, inevow, loaders
+from nevow.flat import flatsax
+from twisted.internet import task
+from zope.interface import implements
+
+from ilog.utils import TEMPLATES_DIR, get_template
+
+log = logging.getLogger(__name__)
+
+TEMPLATE_EXTENSIONS = ('.html', '.xml')
+REPORT_INTERVAL = 15 * 60
+
+
+class Template(object):
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.mtime = None
+        self.factory = None
+        self.generators = {}
+        self.parse_time = 0.0
+        self.renders = 0
+        self.render_time = 0.0
+
+    def parse(self):
+        start = time.time()
+        mtime = getmtime(self.path)
+        fileobj = open(self.path)
+        try:
+            doc = flatsax.parse(fileobj)
+        finally:
+            fileobj.close()
+        factory = loaders.stan(doc)
+        # Precompiled now rather than on the first request
+        factory.load()
+        self.factory, self.mtime, self.generators = factory, mtime, {}
+        self.parse_time = time.time() - start
+
+    @property
+    def stale(self):
+        return getmtime(self.path) != self.mtime
+
+    def patterns(self, pattern):
+        """Return the generator of `pattern`'s copies."""
+        try:
+            return self.generators[pattern]
+        except KeyError:
+            generator = self.generators[pattern] = \
+                            inevow.IQ(self.factory).patternGenerator(pattern)
+            return generator
+
+    def record_render(self, seconds):
+        self.renders += 1
+        self.render_time += seconds
+
+    def flatten(self, stan):
+        start = time.time()
+        try:
+            return flat.flatten(stan)
+        finally:
+            self.record_render(time.time() - start)
+
+
+class TemplateLoader(object):
+    """Document factory always loading the registry's current version of a
+    template."""
+    implements(inevow.IDocFactory)
+
+    pattern = None
+
+    def __init__(self, registry, name):
+        self.registry = registry
+        self.name = name
+
+    def load(self, ctx=None, preprocessors=()):
+        return self.registry.get(self.name).factory.load(ctx, preprocessors)
+
+
+class TemplateRegistry(object):
+
+    def __init__(self, directory=TEMPLATES_DIR, debug=False):
+        self.directory = directory
+        self.debug = debug
+        self.templates = {}
+        self.reporter = task.LoopingCall(self.report)
+
+    def names(self):
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(TEMPLATE_EXTENSIONS):
+                    path = relpath(join(dirpath, filename), self.directory)
+                    yield path.replace(os.sep, '/')
+
+    def load_all(self):
+        start = time.time()
+        for name in self.names():
+            self.get(name)
+        log.info("Parsed %d templates in %.3f s", len(self.templates),
+                 time.time() - start)
+
+    def get(self, name):
+        template = self.templates.get(name)
+        if template is None:
+            template = Template(name, get_template(name))
+            template.parse()
+            self.templates[name] = template
+            log.debug("Parsed template %s in %.3f ms", name,
+                      template.parse_time * 1000)
+        elif self.debug and template.stale:
+            log.debug("Template %s changed, parsing it again", name)
+            template.parse()
+        return template
+
+    def loader(self, name):
+        return TemplateLoader(self, name)
+
+    def start(self):
+        self.reporter.start(REPORT_INTERVAL, now=False)
+
+    def stop(self):
+        if self.reporter.running:
+            self.reporter.stop()
+
+    def stats(self):
+        return dict((name, {'parse_time': template.parse_time,
+                            'renders': template.renders,
+                            'render_time': template.render_time})
+                    for name, template in self.templates.iteritems())
+
+    def report(self):
+        for name, template in sorted(self.templates.iteritems()):
+            average = template.renders and \
+                        template.render_time / template.renders or 0
+            log.info("Template %s: parsed in %.3f ms, %d renders averaging "
+                     "%.3f ms", name, template.parse_time * 1000,
+                     template.renders, average * 1000)
+
+
+registry = TemplateRegistry()
+
+
+def get(name):
+    return registry.get(name)
+
+
+def get_loader(name):
+    return registry.loader(name)
@@ -14,6 +14,27 @@ from ilog.utils.translit_tab import LONG_TABLE, SHORT_TABLE, SINGLE_TABLE
 _punctuation_re = re.compile(r'[\t !"#$%&\'()*\-/<=>?@\[\\\]^_`{|},.]+')
 _string_inc_re = re.compile(r'(\d+)$')
 _placeholder_re = re.compile(r'%(\w+)%')
+_url_re = re.compile(r'(?:(?:https?|ftp)://|www\.)[^\s<>"]+', re.IGNORECASE)
+_url_trailing_chars = u'.,;:!?\'")]}>'
+_whitespace_re = re.compile(r'\s+', re.UNICODE)
+
+CHANNEL_PREFIXES = u'#&+!'
+
+# The translitcodec tables leave cyrillic alone, fold it to its usual latin
+# spelling so that nicks written in cyrillic can be searched in ASCII.
+_cyrillic = (u'абвгдеёжзийклмнопрстуфхцчшщъыьэюяєіїґў',
+             [u'a', u'b', u'v', u'g', u'd', u'e', u'e', u'zh', u'z', u'i',
+              u'y', u'k', u'l', u'm', u'n', u'o', u'p', u'r', u's', u't',
+              u'u', u'f', u'kh', u'ts', u'ch', u'sh', u'shch', u'', u'y', u'',
+              u'e', u'yu', u'ya', u'ye', u'i', u'yi', u'g', u'u'])
+FOLD_TABLE = dict((ord(char), latin) for char, latin in zip(*_cyrillic))
+FOLD_TABLE.update((ord(char.upper()), latin)
+                  for char, latin in zip(*_cyrillic))
+del _cyrillic
+
+#: Maximum number of folded tokens kept by :func:`fold_token`
+FOLD_CACHE_SIZE = 100000
+_fold_cache = {}
 
 def gen_slug(text, delim=u'-'):
     result = []
@@ -33,3 +54,44 @@ def transliterate(string, table='long'):
         'single':   SINGLE_TABLE
     }[table]
     return unicodedata.normalize('NFKC', unicode(string)).translate(table)
+
+def find_urls(text):
+    """Return the URLs found on `text`, in order and without duplicates."""
+    if not text:
+        return []
+    found = []
+    for url in _url_re.findall(text):
+        url = url.rstrip(_url_trailing_chars)
+        if url.count(u'(') > url.count(u')') and text.find(url + u')') != -1:
+            # Wikipedia style links end with a parenthesis of their own
+            url += u')'
+        if url not in found:
+            found.append(url)
+    return found
+
+def fold_token(token):
+    """Fold a single token for searching, NFKC normalized, transliterated and
+    lower cased.  Results are cached since the same nicks and words keep
+    coming back."""
+    try:
+        return _fold_cache[token]
+    except KeyError:
+        folded = transliterate(token).translate(FOLD_TABLE).lower()
+        if len(_fold_cache) >= FOLD_CACHE_SIZE:
+            _fold_cache.clear()
+        _fold_cache[token] = folded
+        return folded
+
+def fold(text):
+    """Fold `text` token by token, see :func:`fold_token`.  Use the same
+    folding when indexing and when querying."""
+    if not text:
+        return u''
+    return u' '.join(fold_token(token)
+                     for token in _whitespace_re.split(text) if token)
+
+def split_channel_name(name):
+    """Split a channel name into its prefix and name, ``u'##foo'`` becomes
+    ``(u'##', u'foo')``."""
+    bare = name.lstrip(CHANNEL_PREFIXES)
+    return name[:len(name) - len(bare)], bare
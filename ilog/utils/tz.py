@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.utils.tz
+    ~~~~~~~~~~~~~
+
+    Timezone helpers.  Stamps are stored in UTC and shown in the user's
+    timezone, which needs `pytz`; without it everything is shown in UTC.
+
+    Converting a page of stamps one datetime at a time is slow, so each zone's
+    UTC offset transitions are turned once into a :class:`Transitions` table
+    of epoch seconds which then converts a whole batch of stamps in a single
+    pass.  Local day bounds come from the same table.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from bisect import bisect_right
+from datetime import datetime, timedelta
+
+try:
+    import pytz
+except ImportError:
+    pytz = None
+
+UTC = 'UTC'
+EPOCH = datetime(1970, 1, 1)
+DAY_SECONDS = 24 * 60 * 60
+
+_transitions = {}
+
+
+def get_timezone(name):
+    """Return the timezone called `name`, ``None`` standing for UTC."""
+    if pytz is None or not name or name == UTC:
+        return None
+    try:
+        return pytz.timezone(name)
+    except (pytz.UnknownTimeZoneError, ValueError):
+        return None
+
+
+def timezone_name(zone):
+    return zone is None and UTC or zone.zone
+
+
+def utc_naive(stamp):
+    """Drop the timezone of an aware `stamp`, converting it to UTC first."""
+    if stamp.tzinfo is None:
+        return stamp
+    return stamp.replace(tzinfo=None) - stamp.utcoffset()
+
+
+def epoch_seconds(stamp):
+    delta = utc_naive(stamp) - EPOCH
+    return delta.days * DAY_SECONDS + delta.seconds
+
+
+def _seconds(offset):
+    return offset.days * DAY_SECONDS + offset.seconds
+
+
+class Transitions(object):
+    """A zone's UTC offsets, `offsets[i]` applying from `times[i]`, both in
+    seconds."""
+
+    def __init__(self, zone):
+        if zone is None:
+            self.times, self.offsets = [None], [0]
+        elif hasattr(zone, '_utc_transition_times'):
+            # pytz's DstTzInfo, the first transition is at datetime.min
+            self.times = [epoch_seconds(time)
+                          for time in zone._utc_transition_times]
+            self.offsets = [_seconds(info[0])
+                            for info in zone._transition_info]
+        else:
+            self.times = [None]
+            self.offsets = [_seconds(zone.utcoffset(EPOCH))]
+
+    def offset_at(self, seconds):
+        return self.offsets[max(bisect_right(self.times, seconds) - 1, 0)]
+
+    def offsets_for(self, epochs):
+        """Return the offsets for a batch of epoch seconds.  Batches are
+        expected in ascending order, as events are, in which case the table
+        is walked only once."""
+        times, offsets = self.times, self.offsets
+        if len(times) == 1:
+            return [offsets[0]] * len(epochs)
+        last = len(times) - 1
+        result = []
+        index = 0
+        if epochs:
+            index = max(bisect_right(times, epochs[0]) - 1, 0)
+        for seconds in epochs:
+            if seconds < times[index]:
+                index = max(bisect_right(times, seconds) - 1, 0)
+            while index < last and times[index + 1] <= seconds:
+                index += 1
+            result.append(offsets[index])
+        return result
+
+    def to_utc(self, local):
+        """Convert a naive local datetime to a naive UTC datetime."""
+        seconds = epoch_seconds(local)
+        guess = seconds - self.offset_at(seconds)
+        return EPOCH + timedelta(seconds=seconds - self.offset_at(guess))
+
+
+def get_transitions(zone):
+    name = timezone_name(zone)
+    try:
+        return _transitions[name]
+    except KeyError:
+        table = _transitions[name] = Transitions(zone)
+        return table
+
+
+def local_epochs(stamps, zone):
+    """Convert naive UTC `stamps` to local epoch seconds in `zone`."""
+    epochs = [epoch_seconds(stamp) for stamp in stamps]
+    if zone is None:
+        return epochs
+    offsets = get_transitions(zone).offsets_for(epochs)
+    return [seconds + offset for seconds, offset in zip(epochs, offsets)]
+
+
+def format_times(stamps, zone):
+    """Format naive UTC `stamps` as local ``HH:MM:SS`` strings."""
+    times = []
+    for seconds in local_epochs(stamps, zone):
+        minutes, second = divmod(seconds % DAY_SECONDS, 60)
+        hour, minute = divmod(minutes, 60)
+        times.append('%02d:%02d:%02d' % (hour, minute, second))
+    return times
+
+
+def day_bounds(day, zone=None):
+    """Return the naive UTC datetimes between which `day` spans in
+    `zone`."""
+    start = datetime(day.year, day.month, day.day)
+    end = start + timedelta(days=1)
+    if zone is None:
+        return start, end
+    table = get_transitions(zone)
+    return table.to_utc(start), table.to_utc(end)
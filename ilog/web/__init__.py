@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web
+    ~~~~~~~~
+
+    The ILog web site.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+
+def build_site():
+    from ilog.web.browser import NetworksPage
+    from ilog.web.completion import CompletionPage
+    from ilog.web.assets import AssetsPage, favicon
+    from ilog.web.api import APIRoot
+    from ilog.web.crawlers import RobotsPage
+    from ilog.web.sitemaps import SitemapIndexPage, SitemapsPage
+    from ilog.web.workers import DrainingSite
+
+    root = NetworksPage()
+    root.putChild('complete', CompletionPage())
+    root.putChild('api', APIRoot())
+    root.putChild('static', AssetsPage())
+    root.putChild('favicon.ico', favicon())
+    root.putChild('robots.txt', RobotsPage())
+    root.putChild('sitemap.xml', SitemapIndexPage())
+    root.putChild('sitemap', SitemapsPage())
+    return DrainingSite(root)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.api
+    ~~~~~~~~~~~~
+
+    Versioned JSON API, ``/api/v1/<collection>``, for networks, channels,
+    identities and events.
+
+    Collections are paged with opaque keyset cursors, ``?cursor=``, taken
+    from the previous page's ``next``.  ``?fields=`` selects which fields to
+    return, events' ``message`` can be left out for instance.  Pages are
+    encoded compactly, the field names once and then a list of values per
+    row::
+
+        {"fields": ["id", "nick"], "rows": [[1, "ufs"]], "next": "WzFd"}
+
+    Rows are read as plain result tuples, no ORM objects are built.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from nevow import inevow, rend
+from twisted.internet.threads import deferToThread
+
+from ilog import application as app
+from ilog.database import db, Channel, Event, Identity, Network
+from ilog.web import crawlers
+from ilog.web.base import JSONPage, get_arg, json
+
+log = logging.getLogger(__name__)
+
+API_VERSION = 'v1'
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+class APIError(Exception):
+
+    def __init__(self, message, code=400):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+def encode_cursor(key):
+    return urlsafe_b64encode(json.dumps(key, separators=(',', ':')))\
+                                                                .rstrip('=')
+
+
+def decode_cursor(cursor, types=None):
+    """Decode a cursor, which must be an instance of `types` when given."""
+    try:
+        cursor = str(cursor)
+        value = json.loads(urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError):
+        raise APIError("Invalid cursor")
+    if types is not None and (not isinstance(value, types) or
+                              isinstance(value, bool)):
+        raise APIError("Invalid cursor")
+    return value
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+class Collection(object):
+    """A collection's fields, their columns, and the column its rows are
+    keyed and ordered by."""
+
+    #: Field name to column, in the order the fields are returned
+    fields = ()
+    key = None
+    #: The types the key's values, and so the cursors, may have
+    key_types = (int, long)
+    #: Query arguments filtering the collection, name to (column, type), a
+    #: type of ``None`` standing for text
+    filters = {}
+
+    def from_obj(self):
+        return None
+
+    def get_fields(self, request):
+        names = get_arg(request, 'fields')
+        if not names:
+            return [name for name, column in self.fields]
+        available = dict(self.fields)
+        fields = [name.strip() for name in names.split(',') if name.strip()]
+        unknown = [name for name in fields if name not in available]
+        if unknown:
+            raise APIError("Unknown fields: %s" % ', '.join(unknown))
+        return fields
+
+    def build_query(self, request, fields, limit):
+        available = dict(self.fields)
+        # The key is always selected, it's needed to build the next cursor
+        columns = [self.key.label('key')] + [available[name]
+                                             for name in fields]
+        query = db.select(columns, from_obj=self.from_obj())
+        for name, (column, type) in self.filters.iteritems():
+            if name in request.args:
+                value = get_arg(request, name, type=type)
+                if value is None:
+                    raise APIError("Invalid value for %s" % name)
+                query = query.where(column == value)
+        cursor = get_arg(request, 'cursor')
+        if cursor:
+            query = query.where(self.key > decode_cursor(cursor,
+                                                         self.key_types))
+        # One row more tells whether there's a next page
+        return query.order_by(self.key).limit(limit + 1)
+
+    def fetch(self, query):
+        """Runs on a thread."""
+        return app.database_engine.execute(query).fetchall()
+
+
+class NetworksCollection(Collection):
+    table = Network.__table__
+    key = table.c.name
+    key_types = (unicode,)
+    fields = (('name', table.c.name), ('address', table.c.address),
+              ('port', table.c.port))
+
+
+class ChannelsCollection(Collection):
+    table = Channel.__table__
+    key = table.c.id
+    fields = (('id', table.c.id), ('network', table.c.network_name),
+              ('prefix', table.c.prefix), ('name', table.c.name),
+              ('topic', table.c.topic),
+              ('topic_changed_on', table.c.changed_on),
+              ('topic_changed_by', table.c.changed_by_id))
+    filters = {'network': (table.c.network_name, None)}
+
+
+class IdentitiesCollection(Collection):
+    table = Identity.__table__
+    key = table.c.id
+    fields = (('id', table.c.id), ('network', table.c.network_name),
+              ('nick', table.c.nick), ('realname', table.c.realname),
+              ('ident', table.c.ident))
+    filters = {'network': (table.c.network_name, None)}
+
+
+class EventsCollection(Collection):
+    table = Event.__table__
+    identities = Identity.__table__
+    key = table.c.id
+    fields = (('id', table.c.id), ('channel', table.c.channel_id),
+              ('stamp', table.c.stamp), ('type', table.c.type),
+              ('identity', table.c.identity_id),
+              ('nick', identities.c.nick), ('message', table.c.message))
+    filters = {'channel': (table.c.channel_id, int),
+               'identity': (table.c.identity_id, int)}
+
+    def from_obj(self):
+        return [self.table.outerjoin(
+            self.identities, self.identities.c.id == self.table.c.identity_id
+        )]
+
+COLLECTIONS = {
+    'networks': NetworksCollection(),
+    'channels': ChannelsCollection(),
+    'identities': IdentitiesCollection(),
+    'events': EventsCollection(),
+}
+
+
+class CollectionPage(JSONPage):
+
+    def __init__(self, collection):
+        JSONPage.__init__(self)
+        self.collection = collection
+
+    def render_json(self, request):
+        if crawlers.throttled(request, 'api'):
+            return {'error': 'Too many requests'}
+        try:
+            fields = self.collection.get_fields(request)
+            limit = min(max(get_arg(request, 'limit', DEFAULT_LIMIT, int), 1),
+                        MAX_LIMIT)
+            query = self.collection.build_query(request, fields, limit)
+        except APIError, error:
+            request.setResponseCode(error.code)
+            return {'error': str(error)}
+        return deferToThread(self.collection.fetch, query).addCallback(
+                                                self.encode, fields, limit)
+
+    def encode(self, rows, fields, limit):
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1][0])
+        return {
+            'fields': fields,
+            # The first value of every row is the key
+            'rows': [[encode_value(value) for value in row[1:]]
+                     for row in rows],
+            'next': next_cursor
+        }
+
+
+class APIPage(rend.Page):
+
+    def childFactory(self, ctx, segment):
+        if crawlers.is_crawler(inevow.IRequest(ctx)):
+            return crawlers.CrawlersRefusedPage()
+        if segment == 'sync':
+            from ilog.web.sync import SyncPage
+            return SyncPage()
+        collection = COLLECTIONS.get(segment)
+        if collection is not None:
+            return CollectionPage(collection)
+
+
+class APIRoot(rend.Page):
+
+    def __init__(self):
+        rend.Page.__init__(self)
+        self.putChild(API_VERSION, APIPage())
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.assets
+    ~~~~~~~~~~~~~~~
+
+    Static assets.
+
+    ``setup.py build_assets`` copies every asset to a name holding a hash of
+    its contents, next to a gzip compressed copy, and records the names in a
+    manifest.  Those files never change, so they're served with immutable
+    caching headers; :func:`asset_url` is how pages refer to them.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import logging
+import mimetypes
+from os.path import dirname, exists, getsize, isfile, join, normpath
+
+from nevow import inevow, rend
+from twisted.web import http
+
+from ilog.utils import FAVICON_ICO, JS_DIR
+from ilog.web import caching
+from ilog.web.base import FileProducer, json
+
+log = logging.getLogger(__name__)
+
+STATIC_DIR = dirname(JS_DIR)
+BUILD_DIR = join(STATIC_DIR, 'build')
+MANIFEST = join(BUILD_DIR, 'manifest.json')
+STATIC_URL = '/static/'
+#: For the assets which aren't fingerprinted, like the favicon
+PLAIN_MAX_AGE = 60 * 60 * 24
+
+_manifest = _fingerprinted = None
+
+
+def get_manifest():
+    global _manifest, _fingerprinted
+    if _manifest is None:
+        manifest = {}
+        if exists(MANIFEST):
+            fileobj = open(MANIFEST)
+            try:
+                manifest = json.load(fileobj)
+            finally:
+                fileobj.close()
+        else:
+            log.warning("No assets manifest, run 'setup.py build_assets'")
+        _fingerprinted = frozenset(manifest.itervalues())
+        _manifest = manifest
+    return _manifest
+
+
+def is_fingerprinted(name):
+    get_manifest()
+    return name in _fingerprinted
+
+
+def asset_url(name):
+    """Return the URL of the asset `name`, ie, ``style/ilog.css``."""
+    return STATIC_URL + get_manifest().get(name, name)
+
+
+class AssetFile(rend.Page):
+
+    def __init__(self, path, immutable=True):
+        rend.Page.__init__(self)
+        self.path = path
+        self.immutable = immutable
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        content_type, encoding = mimetypes.guess_type(self.path)
+        request.setHeader('content-type',
+                          content_type or 'application/octet-stream')
+        request.setHeader('vary', 'Accept-Encoding')
+        if self.immutable:
+            request.setHeader('cache-control', 'public, max-age=%d, '
+                              'immutable' % caching.CLOSED_MAX_AGE)
+        else:
+            request.setHeader('cache-control',
+                              'public, max-age=%d' % PLAIN_MAX_AGE)
+
+        path = self.path
+        if caching.accepts_gzip(request) and exists(path + '.gz'):
+            path += '.gz'
+            request.setHeader('content-encoding', 'gzip')
+        if request.setETag(caching.file_etag(path)) is http.CACHED:
+            return ''
+        request.setHeader('content-length', str(getsize(path)))
+        if request.method == 'HEAD':
+            return ''
+        fileobj = open(path, 'rb')
+        return FileProducer(request, fileobj).start().addCallback(
+                                                            lambda _: '')
+
+
+class AssetsPage(rend.Page):
+
+    def locateChild(self, ctx, segments):
+        name = '/'.join(segments)
+        fingerprinted = is_fingerprinted(name)
+        if fingerprinted:
+            path = normpath(join(BUILD_DIR, *segments))
+        else:
+            # Not built, or still referred to by its plain name
+            path = normpath(join(STATIC_DIR, *segments))
+        if not path.startswith(STATIC_DIR + os.sep) or not isfile(path):
+            return rend.NotFound
+        return AssetFile(path, fingerprinted), ()
+
+
+def favicon():
+    return AssetFile(FAVICON_ICO, immutable=False)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.base
+    ~~~~~~~~~~~~~
+
+    Base pages shared by the ILog web resources.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import zlib
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from nevow import inevow, rend
+from twisted.internet import defer
+from twisted.internet.interfaces import IPullProducer, IPushProducer
+from twisted.internet.threads import deferToThread
+from zope.interface import implements
+
+from ilog.web.caching import accepts_gzip
+
+log = logging.getLogger(__name__)
+
+READ_SIZE = 64 * 1024
+
+
+def get_arg(request, name, default=None, type=None):
+    try:
+        value = request.args[name][0]
+    except (KeyError, IndexError):
+        return default
+    if type is not None:
+        try:
+            return type(value)
+        except ValueError:
+            return default
+    return value.decode('utf-8', 'replace')
+
+
+def gzip_string(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class JSONPage(rend.Page):
+    """Page which serializes whatever :meth:`render_json` returns, which may
+    also be a deferred.  Responses of pages setting :attr:`compress` are
+    gzip compressed for the clients accepting it."""
+
+    content_type = 'application/json; charset=utf-8'
+    compress = False
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', self.content_type)
+        d = defer.maybeDeferred(self.render_json, request)
+        d.addCallback(json.dumps, separators=(',', ':'))
+        if self.compress:
+            d.addCallback(self.compress_response, request)
+        return d
+
+    def compress_response(self, data, request):
+        request.setHeader('vary', 'Accept-Encoding')
+        if not accepts_gzip(request):
+            return data
+        request.setHeader('content-encoding', 'gzip')
+        return gzip_string(data)
+
+    def render_json(self, request):
+        raise NotImplementedError
+
+
+class FileProducer(object):
+    """Pull producer writing a file to a request, :meth:`start` returns a
+    deferred fired once the whole file was written or the client left."""
+    implements(IPullProducer)
+
+    def __init__(self, request, fileobj, read_size=READ_SIZE):
+        self.request = request
+        self.fileobj = fileobj
+        self.read_size = read_size
+        self.deferred = defer.Deferred()
+
+    def start(self):
+        self.request.registerProducer(self, False)
+        return self.deferred
+
+    def resumeProducing(self):
+        if self.fileobj is None:
+            return
+        data = self.fileobj.read(self.read_size)
+        if data:
+            self.request.write(data)
+        else:
+            self.stopProducing()
+
+    def stopProducing(self):
+        if self.fileobj is None:
+            return
+        self.fileobj.close()
+        self.fileobj = None
+        self.request.unregisterProducer()
+        self.deferred.callback(None)
+
+
+class IteratorProducer(object):
+    """Writes a blocking iterator of chunks to a request, advancing it on
+    the thread pool whenever the transport is ready for more."""
+    implements(IPushProducer)
+
+    def __init__(self, request, chunks):
+        self.request = request
+        self.chunks = chunks
+        self.deferred = defer.Deferred()
+        self.paused = self.busy = self.done = False
+
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.produce()
+        return self.deferred
+
+    def produce(self):
+        if self.paused or self.busy or self.done:
+            return
+        self.busy = True
+        deferToThread(next, self.chunks, None).addCallbacks(self.write,
+                                                            self.failed)
+
+    def write(self, chunk):
+        self.busy = False
+        if self.done:
+            # Stopped while this chunk was being produced
+            self.close()
+        elif chunk is None:
+            self.finish()
+        else:
+            self.request.write(chunk)
+            self.produce()
+
+    def failed(self, failure):
+        self.busy = False
+        log.error("Streaming failed: %s", failure.getTraceback())
+        # The client must not take a truncated response for a complete one
+        self.request.transport.loseConnection()
+        self.finish()
+
+    def finish(self):
+        if self.done:
+            return
+        self.done = True
+        self.close()
+        self.request.unregisterProducer()
+        self.deferred.callback('')
+
+    def close(self):
+        if not self.busy:
+            deferToThread(self.chunks.close)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.produce()
+
+    def stopProducing(self):
+        self.finish()
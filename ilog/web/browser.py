@@ -0,0 +1,586 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.browser
+    ~~~~~~~~~~~~~~~~
+
+    The log browser, networks → channels → days → a day's log.
+
+    A day's log can hold tens of thousands of events, so it's never built as
+    a whole.  The page's template is rendered once around a marker, whatever
+    comes before it is sent straight away and the events follow in chunks of
+    :data:`CHUNK_SIZE`, each fetched with a keyset query, so the time to the
+    first byte doesn't depend on the size of the day.  Chunks are rendered on
+    the thread pool only as fast as the client reads them, so a slow client
+    doesn't get the whole day buffered for it.
+
+    A day can also be browsed a page at a time, ``?per_page=&after=``, in the
+    timezone given by ``tz``.  Rendered pages are kept in the fragment cache,
+    ``app.fragments``.  Their ``page X of Y`` totals come from
+    :mod:`ilog.utils.counts`, which counts the events of closed days without
+    walking them.
+
+    Crawlers are only served days from their snapshots and pages and
+    listings from the caches, see :mod:`ilog.web.crawlers`.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import time
+import logging
+from datetime import datetime, timedelta
+from urllib import quote
+
+from nevow import flat, inevow, rend, tags as T
+from twisted.internet import defer
+from twisted.internet.threads import deferToThread
+
+from ilog.database import db, Channel, ChannelDay, Event, Network
+from ilog.export import text_line
+from ilog.utils import templates
+from ilog.utils.counts import count_events
+from ilog.utils.days import day_segments, day_summary, resolve_permalink, \
+                            segment_position
+from ilog.utils.records import fetch_events
+from ilog.utils.text import split_channel_name
+from ilog.utils.tz import day_bounds, format_times, get_timezone, \
+                          timezone_name
+from ilog import application as app
+from ilog.web import caching, crawlers
+from ilog.web.base import IteratorProducer, get_arg
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 500
+DAY_FORMAT = '%Y-%m-%d'
+HTML, TEXT = 'html', 'text'
+TEXT_SUFFIX = '.txt'
+CONTENT_TYPES = {HTML: 'text/html; charset=utf-8',
+                 TEXT: 'text/plain; charset=utf-8'}
+
+#: Same default as ``User.items_per_page``
+DEFAULT_PER_PAGE = 15
+MAX_PER_PAGE = CHUNK_SIZE
+#: How long a page of the current day may be served from the fragment cache
+OPEN_FRAGMENT_TTL = 60
+#: How long crawlers are served the copy of a listing rendered for the last
+#: visitor
+LISTING_TTL = 5 * 60
+
+DOCTYPE = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN"\n'
+           '  "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n')
+EVENTS_MARKER = '<!-- ilog:events -->'
+
+
+def channel_segment(prefix, name):
+    return quote(((prefix or u'') + name).encode('utf-8'), safe='')
+
+
+def split_channel_segment(segment):
+    return split_channel_name(segment.decode('utf-8', 'replace'))
+
+
+def parse_day(segment):
+    try:
+        return datetime.strptime(segment, DAY_FORMAT).date()
+    except ValueError:
+        return None
+
+
+class ListingPage(rend.Page):
+    addSlash = True
+    # Rendered to a string, which can be cached
+    buffered = True
+    docFactory = templates.get_loader('browser/listing.html')
+    title = u'ILog'
+
+    def render_title(self, ctx, data):
+        return ctx.tag.clear()[self.title]
+
+    def render_item(self, ctx, (href, label)):
+        ctx.fillSlots('href', href)
+        ctx.fillSlots('label', label)
+        return ctx.tag
+
+    def render(self, ctx):
+        template = templates.get(self.docFactory.name)
+        start = time.time()
+        def rendered(result):
+            template.record_render(time.time() - start)
+            return result
+        return defer.maybeDeferred(rend.Page.renderHTTP, self, ctx)\
+                                                    .addCallback(rendered)
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', 'text/html; charset=utf-8')
+        fragments = getattr(app, 'fragments', None)
+        key = ('listing', request.path)
+        if crawlers.is_crawler(request):
+            # Never from live queries, only what visitors had rendered
+            listing = fragments is not None and fragments.get(key) or None
+            if listing is None:
+                return crawlers.unavailable(request)
+            return listing
+        if fragments is None:
+            return self.render(ctx)
+        def rendered(listing):
+            fragments.put(key, listing, ttl=LISTING_TTL)
+            return listing
+        return self.render(ctx).addCallback(rendered)
+
+
+class NetworksPage(ListingPage):
+    title = u'Networks'
+
+    @db.sqla_session_inline_callbacks
+    def data_items(self, ctx, data, sa_session=None):
+        query = sa_session.query(Network.name).order_by(Network.name)
+        names = yield deferToThread(query.all)
+        defer.returnValue([(quote(name.encode('utf-8'), safe='') + '/', name)
+                           for (name,) in names])
+
+    @db.sqla_session_inline_callbacks
+    def childFactory(self, ctx, segment, sa_session=None):
+        name = segment.decode('utf-8', 'replace')
+        network = yield deferToThread(sa_session.query(Network).get, name)
+        if network is not None:
+            defer.returnValue(NetworkPage(network.name))
+
+
+class NetworkPage(ListingPage):
+
+    def __init__(self, network_name):
+        ListingPage.__init__(self)
+        self.network_name = network_name
+        self.title = network_name
+
+    @db.sqla_session_inline_callbacks
+    def data_items(self, ctx, data, sa_session=None):
+        query = sa_session.query(Channel.prefix, Channel.name)\
+                          .filter(Channel.network_name == self.network_name)\
+                          .order_by(Channel.name)
+        channels = yield deferToThread(query.all)
+        defer.returnValue([
+            (channel_segment(prefix, name) + '/', (prefix or u'') + name)
+            for prefix, name in channels
+        ])
+
+    @db.sqla_session_inline_callbacks
+    def childFactory(self, ctx, segment, sa_session=None):
+        prefix, name = split_channel_segment(segment)
+        query = sa_session.query(Channel).filter_by(
+            network_name=self.network_name, prefix=prefix or None, name=name
+        )
+        channel = yield deferToThread(query.first)
+        if channel is not None:
+            defer.returnValue(ChannelPage(channel))
+
+
+class ChannelPage(ListingPage):
+
+    def __init__(self, channel):
+        ListingPage.__init__(self)
+        self.channel = channel
+        self.title = u'%s%s on %s' % (channel.prefix or u'', channel.name,
+                                      channel.network_name)
+
+    @db.sqla_session_inline_callbacks
+    def data_items(self, ctx, data, sa_session=None):
+        # The channel's days and their counts are kept up as events are
+        # logged, there's no need to group its events
+        query = sa_session.query(ChannelDay.day, ChannelDay.events)\
+                          .filter(ChannelDay.channel_id == self.channel.id)\
+                          .order_by(ChannelDay.day.desc())
+        days = yield deferToThread(query.all)
+        defer.returnValue([(str(day), u'%s (%d events)' % (day, events))
+                           for day, events in days])
+
+    def childFactory(self, ctx, segment):
+        if segment in ('event', 'live', 'export', 'activity') and \
+                            crawlers.is_crawler(inevow.IRequest(ctx)):
+            return crawlers.CrawlersRefusedPage()
+        if segment == 'event':
+            return PermalinksPage(self.channel)
+        elif segment == 'live':
+            from ilog.web.live import LiveTailPage
+            return LiveTailPage(self.channel.id)
+        elif segment == 'export':
+            from ilog.web.exports import ExportPage
+            return ExportPage(self.channel)
+        elif segment == 'activity':
+            from ilog.web.charts import ActivityPage
+            return ActivityPage(self.channel)
+        format = HTML
+        if segment.endswith(TEXT_SUFFIX):
+            segment, format = segment[:-len(TEXT_SUFFIX)], TEXT
+        day = parse_day(segment)
+        if day is not None:
+            return DayPage(self.channel, day, format)
+
+
+class PermalinksPage(rend.Page):
+
+    def __init__(self, channel):
+        rend.Page.__init__(self)
+        self.channel = channel
+
+    def childFactory(self, ctx, segment):
+        try:
+            return PermalinkPage(self.channel, int(segment))
+        except ValueError:
+            return None
+
+
+class PermalinkPage(rend.Page):
+    """``<channel>/event/<id>`` redirects to the page of the day the event
+    is on, see :func:`ilog.utils.days.resolve_permalink`."""
+
+    def __init__(self, channel, event_id):
+        rend.Page.__init__(self)
+        self.channel = channel
+        self.event_id = event_id
+
+    def resolve(self, per_page, zone):
+        connection = app.database_engine.connect()
+        try:
+            return resolve_permalink(connection, self.channel.id,
+                                     self.event_id, per_page, zone)
+        finally:
+            connection.close()
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        if crawlers.throttled(request, 'render'):
+            return ''
+        per_page = get_arg(request, 'per_page', DEFAULT_PER_PAGE, int)
+        per_page = min(max(per_page, 1), MAX_PER_PAGE)
+        zone = get_timezone(get_arg(request, 'tz'))
+
+        def resolved(result):
+            # The event at the page's start may be gone or not numbered
+            if result is None or result[1] is None:
+                request.setResponseCode(404)
+                return 'No such event'
+            day, after_id = result
+            # Relative to <channel>/event/<id>
+            request.redirect('../%s?after=%d&per_page=%d&tz=%s#e%d' % (
+                day.strftime(DAY_FORMAT), after_id, per_page,
+                quote(timezone_name(zone)), self.event_id
+            ))
+            return ''
+        return deferToThread(self.resolve, per_page, zone).addCallback(
+                                                                    resolved)
+
+
+class DayLog(object):
+    """Renders a day's log in pieces, see :meth:`parts` and :meth:`render`.
+    """
+
+    template_name = 'browser/day.html'
+    #: Appended to the previous and next days' links
+    link_suffix = ''
+
+    def __init__(self, channel, day, zone=None):
+        self.channel = channel
+        self.day = day
+        self.zone = zone
+        self.start, self.end = day_bounds(day, zone)
+
+    @property
+    def title(self):
+        return u'%s%s on %s, %s' % (self.channel.prefix or u'',
+                                    self.channel.name,
+                                    self.channel.network_name,
+                                    self.day.strftime(DAY_FORMAT))
+
+    @property
+    def template(self):
+        return templates.get(self.template_name)
+
+    @property
+    def closed(self):
+        return caching.is_closed(self.end)
+
+    def parts(self, format=HTML):
+        """Return the page's markup before and after the events."""
+        if format == TEXT:
+            return (u'%s\n\n' % self.title).encode('utf-8'), ''
+        template = self.template
+        pattern = template.patterns('page')()
+        pattern.fillSlots('title', self.title)
+        pattern.fillSlots('previous',
+                          (self.day - timedelta(days=1)).strftime(DAY_FORMAT) +
+                          self.link_suffix)
+        pattern.fillSlots('next',
+                          (self.day + timedelta(days=1)).strftime(DAY_FORMAT) +
+                          self.link_suffix)
+        pattern.fillSlots('events', T.xml(EVENTS_MARKER))
+        head, tail = template.flatten(pattern).split(EVENTS_MARKER)
+        return DOCTYPE + head, tail
+
+    def render(self, rows, format=HTML):
+        if format == TEXT:
+            return self.render_text(rows)
+        return self.render_events(rows)
+
+    def format_times(self, rows):
+        # A whole chunk is converted to the day's timezone at once
+        return format_times([event.stamp for event in rows], self.zone)
+
+    def render_events(self, rows):
+        template = self.template
+        patterns = template.patterns('event')
+        return template.flatten([
+            patterns().fillSlots('id', event.id)
+                      .fillSlots('type', event.type or u'')
+                      .fillSlots('stamp', stamp)
+                      .fillSlots('nick', event.nick or u'')
+                      .fillSlots('message', event.message or u'')
+            for event, stamp in zip(rows, self.format_times(rows))
+        ])
+
+    def render_text(self, rows):
+        return u''.join([
+            text_line(stamp, event.type, event.nick, event.message)
+            for event, stamp in zip(rows, self.format_times(rows))
+        ]).encode('utf-8')
+
+    def summary(self):
+        """Return the day's events count and last event id, runs on a
+        thread."""
+        connection = app.database_engine.connect()
+        try:
+            return day_summary(connection, self.channel.id, self.day,
+                               self.zone)
+        finally:
+            connection.close()
+
+    @defer.inlineCallbacks
+    def get_etag(self, closed):
+        """Return the day's ETag, built from its events count and last event
+        id as the channel days have them, the day's events aren't counted.
+        Closed days' ETags are computed only once."""
+        zone_name = timezone_name(self.zone)
+        etag = caching.get_closed_etag(self.channel.id, self.day, zone_name)
+        if etag is not None:
+            defer.returnValue(etag)
+        events, last_event_id = yield deferToThread(self.summary)
+        etag = caching.day_etag(self.channel.id, self.day, events,
+                                last_event_id)
+        if closed:
+            caching.remember_closed_etag(self.channel.id, self.day, zone_name,
+                                         etag)
+        defer.returnValue(etag)
+
+    def fetch(self, executor, after_id, limit=CHUNK_SIZE, nicks=None):
+        return fetch_events(executor, self.channel.id, self.start, self.end,
+                            after_id, limit, nicks)
+
+    def iter_chunks(self, session=None):
+        """Blocking version of :meth:`fetch_chunk`, for use off the reactor
+        thread.  Without a `session` each chunk is read in a session of its
+        own, no connection being held in between."""
+        last_id = 0
+        nicks = {}
+        while True:
+            if session is None:
+                chunk_session = db.session()
+                try:
+                    rows = self.fetch(chunk_session, last_id, nicks=nicks)
+                finally:
+                    chunk_session.close()
+            else:
+                rows = self.fetch(session, last_id, nicks=nicks)
+            if rows:
+                yield rows
+            if len(rows) < CHUNK_SIZE:
+                break
+            last_id = rows[-1].id
+
+    @db.sqla_session_inline_callbacks
+    def fetch_chunk(self, after_id, limit=CHUNK_SIZE, nicks=None,
+                    sa_session=None):
+        rows = yield deferToThread(self.fetch, sa_session, after_id, limit,
+                                   nicks)
+        defer.returnValue(rows)
+
+    def iter_output(self, format=HTML):
+        """Blocking iterator over the whole day's output, for use off the
+        reactor thread.  It advances at the client's pace, so no database
+        connection is held between chunks."""
+        head, tail = self.parts(format)
+        yield head
+        for rows in self.iter_chunks():
+            yield self.render(rows, format)
+        if tail:
+            yield tail
+
+    def stream(self, request, format=HTML):
+        """Write the whole day to `request`, rendering each chunk on the
+        thread pool only once the client took the previous one."""
+        return IteratorProducer(request, self.iter_output(format)).start()
+
+    def position(self, connection, event_id):
+        """Return an event's position within the day, from ``0``."""
+        events = Event.__table__
+        row = connection.execute(db.select(
+            [events.c.stamp, events.c.seq],
+            db.and_(events.c.id == event_id,
+                    events.c.channel_id == self.channel.id)
+        )).fetchone()
+        if row is None or row[1] is None:
+            return None
+        segments = day_segments(connection, self.channel.id, self.start,
+                                self.end)
+        return segment_position(segments, row[0], row[1])
+
+    def count_pages(self, after_id, per_page):
+        """Return the number of the page after the event `after_id` and how
+        many pages the day has, runs on a thread."""
+        connection = app.database_engine.connect()
+        try:
+            events = count_events(connection, self.channel.id, self.start,
+                                  self.end, self.closed)
+            page = 1
+            if after_id:
+                position = self.position(connection, after_id)
+                if position is not None:
+                    page = (position + 1) // per_page + 1
+        finally:
+            connection.close()
+        return page, max((events + per_page - 1) // per_page, page)
+
+    def render_page(self, after_id, per_page):
+        """Render a page of events, the returned deferred fires with the
+        events' markup, the cursor of the next page, if any, the page's
+        number and the number of pages."""
+        def rendered((rows, (page, pages))):
+            next_id = None
+            if len(rows) == per_page:
+                next_id = rows[-1].id
+            return self.render_events(rows), next_id, page, pages
+        return defer.gatherResults([
+            self.fetch_chunk(after_id, per_page),
+            deferToThread(self.count_pages, after_id, per_page)
+        ]).addCallback(rendered)
+
+    def page_key(self, etag, after_id, per_page):
+        return (self.channel.id, self.day, after_id, timezone_name(self.zone),
+                per_page, etag)
+
+    def cached_page(self, after_id, per_page):
+        """Return a page of a closed day if it's in the fragment cache, or
+        ``None``, without querying anything."""
+        fragments = getattr(app, 'fragments', None)
+        etag = caching.get_closed_etag(self.channel.id, self.day,
+                                       timezone_name(self.zone))
+        if fragments is None or etag is None:
+            return None
+        page = fragments.get(self.page_key(etag, after_id, per_page))
+        return page is not None and (etag, page) or None
+
+    def get_page(self, etag, after_id, per_page):
+        """Like :meth:`render_page` but through the fragment cache.  The
+        day's `etag` is part of the key so that pages of the current day are
+        not served anymore once it gets new events."""
+        fragments = getattr(app, 'fragments', None)
+        if fragments is None:
+            return self.render_page(after_id, per_page)
+        key = self.page_key(etag, after_id, per_page)
+        return fragments.get_or_create(
+            key, lambda: self.render_page(after_id, per_page),
+            size=lambda (markup, next_id, page, pages): len(markup),
+            ttl=not self.closed and OPEN_FRAGMENT_TTL or None
+        )
+
+
+class DayPage(rend.Page):
+
+    def __init__(self, channel, day, format=HTML):
+        rend.Page.__init__(self)
+        self.day_log = DayLog(channel, day)
+        self.format = format
+
+    @defer.inlineCallbacks
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', CONTENT_TYPES[self.format])
+        request.setHeader('vary', 'Accept-Encoding')
+        # Whether the day is closed is decided before counting its events so
+        # that a late event can't end up hidden behind a closed day's ETag
+        paged = self.format == HTML and ('after' in request.args or
+                                         'per_page' in request.args)
+        zone = paged and get_timezone(get_arg(request, 'tz')) or None
+        if zone is not None:
+            # The day spans from midnight to midnight in the viewer's zone
+            self.day_log = DayLog(self.day_log.channel, self.day_log.day,
+                                  zone)
+        closed = self.day_log.closed
+
+        snapshots = getattr(app, 'snapshots', None)
+        if closed and snapshots is not None and not paged:
+            served = yield snapshots.serve(request, self.day_log.channel.id,
+                                           self.day_log.day, self.format)
+            if served:
+                defer.returnValue('')
+
+        if crawlers.is_crawler(request):
+            defer.returnValue(self.render_cached(request, paged, closed,
+                                                 zone))
+
+        # The ETag is read off the channel days, a 304 costs no token
+        day_etag = yield self.day_log.get_etag(closed)
+        if not paged:
+            etag = caching.variant_etag(day_etag, self.format)
+            if not caching.set_cache_headers(request, etag, closed) and \
+                    not crawlers.throttled(request, 'render'):
+                yield self.day_log.stream(request, self.format)
+            defer.returnValue('')
+
+        after_id, per_page = self.page_args(request)
+        if caching.set_cache_headers(request, self.page_etag(
+                            day_etag, after_id, per_page, zone), closed):
+            defer.returnValue('')
+        if crawlers.throttled(request, 'render'):
+            defer.returnValue('')
+        page = yield self.day_log.get_page(day_etag, after_id, per_page)
+        defer.returnValue(self.assemble(page, per_page, zone))
+
+    def page_args(self, request):
+        after_id = max(get_arg(request, 'after', 0, int), 0)
+        per_page = get_arg(request, 'per_page', DEFAULT_PER_PAGE, int)
+        return after_id, min(max(per_page, 1), MAX_PER_PAGE)
+
+    def page_etag(self, day_etag, after_id, per_page, zone):
+        return caching.variant_etag(day_etag, 'page', str(after_id),
+                                    str(per_page), timezone_name(zone))
+
+    def render_cached(self, request, paged, closed, zone):
+        """Serve a crawler what's at hand, without querying anything."""
+        if paged and closed:
+            after_id, per_page = self.page_args(request)
+            cached = self.day_log.cached_page(after_id, per_page)
+            if cached is not None:
+                day_etag, page = cached
+                if caching.set_cache_headers(request, self.page_etag(
+                                day_etag, after_id, per_page, zone), closed):
+                    return ''
+                return self.assemble(page, per_page, zone)
+        return crawlers.unavailable(request)
+
+    def assemble(self, (markup, next_id, page, pages), per_page, zone):
+        head, tail = self.day_log.parts(HTML)
+        return ''.join([head, markup,
+                        self.pager(next_id, page, pages, per_page, zone),
+                        tail])
+
+    def pager(self, next_id, page, pages, per_page, zone):
+        more = u''
+        if next_id is not None:
+            href = '?after=%d&per_page=%d&tz=%s' % (
+                next_id, per_page, quote(timezone_name(zone)))
+            more = [u' | ', T.a(href=href)[u'more \xbb']]
+        return flat.flatten(T.tr(_class='pager')[
+            T.td(colspan=3)[u'page %d of %d' % (page, pages), more]
+        ])
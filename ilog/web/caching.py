@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.caching
+    ~~~~~~~~~~~~~~~~
+
+    HTTP caching helpers.
+
+    Once a channel's day is over its log never changes again, so closed days
+    get a strong ETag and a far-future ``Cache-Control`` letting browsers and
+    reverse proxies keep them.  The current day is only revalidated.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+from datetime import datetime, timedelta
+from hashlib import sha1
+from twisted.web import http
+
+#: How long after midnight (UTC) a day is still considered open, for the
+#: events which arrive late.
+CLOSE_GRACE = timedelta(minutes=10)
+CLOSED_MAX_AGE = 60 * 60 * 24 * 365
+OPEN_MAX_AGE = 0
+
+#: How many closed days' ETags to keep around, they never change
+ETAG_CACHE_SIZE = 50000
+_closed_etags = {}
+
+
+def is_closed(day_end, now=None):
+    """Whether a day ending at `day_end`, UTC, is closed."""
+    return day_end + CLOSE_GRACE <= (now or datetime.utcnow())
+
+
+def is_closed_day(day, now=None):
+    return is_closed(datetime(day.year, day.month, day.day) +
+                     timedelta(days=1), now)
+
+
+def day_etag(channel_id, day, events, last_event_id):
+    return '"%s"' % sha1('%s:%s:%s:%s' % (
+        channel_id, day.isoformat(), events, last_event_id or 0)).hexdigest()
+
+
+def variant_etag(etag, *variants):
+    """Derive the ETag of another representation of the same content."""
+    return '"%s"' % '-'.join((etag.strip('"'),) + variants)
+
+
+def file_etag(path):
+    stat = os.stat(path)
+    return '"%x-%x"' % (int(stat.st_mtime), stat.st_size)
+
+
+def accepts_gzip(request):
+    for coding in (request.getHeader('accept-encoding') or '').split(','):
+        params = coding.strip().split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def get_closed_etag(channel_id, day, zone_name):
+    return _closed_etags.get((channel_id, day, zone_name))
+
+
+def remember_closed_etag(channel_id, day, zone_name, etag):
+    if len(_closed_etags) >= ETAG_CACHE_SIZE:
+        _closed_etags.clear()
+    _closed_etags[(channel_id, day, zone_name)] = etag
+
+
+def set_cache_headers(request, etag, closed):
+    """Set the caching headers of a response and return ``True`` if the
+    client's copy is still valid, in which case a 304 was already set and
+    nothing else should be sent."""
+    if closed:
+        request.setHeader('cache-control', 'public, max-age=%d' %
+                          CLOSED_MAX_AGE)
+    else:
+        request.setHeader('cache-control',
+                          'public, max-age=%d, must-revalidate' % OPEN_MAX_AGE)
+    return request.setETag(etag) is http.CACHED
@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.charts
+    ~~~~~~~~~~~~~~~
+
+    A channel's activity charts, ``<channel>/activity/<year>/calendar.svg``
+    and ``heatmap.svg``, or ``.png`` when PIL is available.  ``?nick=``
+    charts a nick's activity on the channel instead and ``?tz=`` sets the
+    timezone.  Only the years the channel has events on and the nicks known
+    to its network are charted, the rest are ``404``.
+
+    Charts are built from the activity rollups only, see
+    :mod:`ilog.utils.activity`, and :class:`ChartStore` keeps them on disk
+    by their content's digest, along with which digest each chart has, so
+    that every worker and the next run find them.  A past year's chart is
+    rendered once, the current year's at most once every
+    :data:`OPEN_CHART_TTL` seconds, and not written again when nothing
+    changed meanwhile.  As charts may share a digest, the files no chart
+    has anymore are only removed by a periodic sweep.  Serving a known chart
+    costs nothing, laying one out takes a token from the client's
+    ``activity`` bucket, see :func:`ilog.web.crawlers.throttled`, and
+    crawlers aren't served charts at all.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import logging
+from datetime import MAXYEAR, MINYEAR
+from hashlib import sha1
+from os.path import dirname, exists, getmtime, getsize, isdir, join
+from time import time
+
+from nevow import inevow, rend
+from twisted.internet import defer, task
+from twisted.internet.threads import deferToThread
+from twisted.python.failure import Failure
+
+from ilog import application as app
+from ilog.utils import activity, charts
+from ilog.utils.tz import get_timezone, timezone_name
+from ilog.web import caching, crawlers
+from ilog.web.base import FileProducer, get_arg
+
+log = logging.getLogger(__name__)
+
+#: How long the current year's charts are served before being looked at
+#: again
+OPEN_CHART_TTL = 60
+#: How many charts' digests to keep around in memory
+DIGEST_CACHE_SIZE = 10000
+#: How often, in seconds, the files no chart has anymore are removed
+SWEEP_INTERVAL = 60 * 60
+#: How old, in seconds, an unused file must be to be removed, so that one
+#: just written isn't before its chart's digest is
+SWEEP_GRACE = 10 * 60
+KEYS_DIRECTORY = 'keys'
+CHART_KINDS = ('calendar', 'heatmap')
+
+
+class ChartStore(object):
+    """Rendered charts on disk, addressed by their digest.  Each chart's
+    digest and expiry are kept in a file of their own, named after the
+    chart's key, under :data:`KEYS_DIRECTORY`."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        #: Chart key to (digest, expiry), ``None`` never expiring
+        self.digests = {}
+        self.pending = {}
+        self.sweeper = task.LoopingCall(self.sweep)
+
+    def start(self):
+        self.sweeper.start(SWEEP_INTERVAL, now=False)
+
+    def stop(self):
+        if self.sweeper.running:
+            self.sweeper.stop()
+
+    def path(self, digest, format):
+        return join(self.directory, digest[:2], '%s.%s' % (digest, format))
+
+    def key_path(self, key):
+        name = sha1(repr(key)).hexdigest()
+        return join(self.directory, KEYS_DIRECTORY, name[:2], name)
+
+    def read_entry(self, key):
+        try:
+            digest, expires = open(self.key_path(key)).read().split()
+        except (IOError, ValueError):
+            return None
+        return digest, expires != '-' and float(expires) or None
+
+    def write_entry(self, key, digest, expires):
+        path = self.key_path(key)
+        if not isdir(dirname(path)):
+            os.makedirs(dirname(path))
+        write_file(path, '%s %s\n' % (digest, expires is None and '-' or
+                                      repr(expires)))
+
+    def lookup(self, key, format):
+        """Return a known, unexpired, chart's digest and path, or ``None``.
+        """
+        entry = self.digests.get(key)
+        if entry is None or not exists(self.path(entry[0], format)):
+            # Rendered by another worker or run, or since by another one
+            entry = self.read_entry(key)
+            if entry is None:
+                return None
+            self.remember(key, entry)
+        digest, expires = entry
+        path = self.path(digest, format)
+        if (expires is None or expires > time()) and exists(path):
+            return digest, path
+        return None
+
+    def remember(self, key, entry):
+        if len(self.digests) >= DIGEST_CACHE_SIZE:
+            self.digests.clear()
+        self.digests[key] = entry
+
+    def get(self, key, build, format, closed):
+        """Return a deferred firing with a chart's digest and path.  `build`
+        lays the chart out, it's called on a thread when the chart isn't
+        known or expired."""
+        known = self.lookup(key, format)
+        if known is not None:
+            return defer.succeed(known)
+        if key in self.pending:
+            waiter = defer.Deferred()
+            self.pending[key].append(waiter)
+            return waiter
+
+        self.pending[key] = []
+        def done(result):
+            for waiter in self.pending.pop(key):
+                if isinstance(result, Failure):
+                    waiter.errback(result)
+                else:
+                    waiter.callback(result)
+            return result
+        return deferToThread(self.render, key, build, format, closed)\
+                                                            .addBoth(done)
+
+    def render(self, key, build, format, closed):
+        """Runs on a thread."""
+        chart = build()
+        digest = chart.digest(format)
+        path = self.path(digest, format)
+        if not exists(path):
+            if not isdir(dirname(path)):
+                os.makedirs(dirname(path))
+            write_file(path, charts.RENDERERS[format][1](chart))
+        entry = (digest, not closed and time() + OPEN_CHART_TTL or None)
+        self.write_entry(key, *entry)
+        self.remember(key, entry)
+        return digest, path
+
+    def sweep(self):
+        def failed(failure):
+            # Don't let an error stop the looping call
+            log.error("Failed to sweep the charts: %s",
+                      failure.getTraceback())
+        return deferToThread(self.remove_unused).addErrback(failed)
+
+    def remove_unused(self):
+        """Remove the chart files no chart's digest points to anymore, the
+        current year's superseded ones.  Runs on a thread."""
+        used = set()
+        for root, directories, files in os.walk(join(self.directory,
+                                                     KEYS_DIRECTORY)):
+            for name in files:
+                try:
+                    used.add(open(join(root, name)).read().split()[0])
+                except (IOError, IndexError):
+                    continue
+        deadline = time() - SWEEP_GRACE
+        removed = 0
+        for root, directories, files in os.walk(self.directory):
+            if root == self.directory and KEYS_DIRECTORY in directories:
+                directories.remove(KEYS_DIRECTORY)
+            for name in files:
+                path = join(root, name)
+                if name.split('.', 1)[0] in used:
+                    continue
+                try:
+                    if getmtime(path) < deadline:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        if removed:
+            log.info("Removed %d unused chart files", removed)
+        return removed
+
+
+def write_file(path, data):
+    """Write `path` atomically, workers may be writing it too."""
+    temporary = '%s.%d.tmp' % (path, os.getpid())
+    output = open(temporary, 'wb')
+    try:
+        output.write(data)
+    finally:
+        output.close()
+    os.rename(temporary, path)
+
+
+class ActivityPage(rend.Page):
+
+    def __init__(self, channel):
+        rend.Page.__init__(self)
+        self.channel = channel
+
+    def locateChild(self, ctx, segments):
+        if len(segments) != 2 or '.' not in segments[1]:
+            return None, ()
+        try:
+            year = int(segments[0])
+        except ValueError:
+            return None, ()
+        if not MINYEAR < year < MAXYEAR:
+            return None, ()
+        kind, format = segments[1].split('.', 1)
+        if kind not in CHART_KINDS or format not in charts.RENDERERS:
+            return None, ()
+        return ChartPage(self.channel, year, kind, format), ()
+
+
+class ChartPage(rend.Page):
+
+    def __init__(self, channel, year, kind, format):
+        rend.Page.__init__(self)
+        self.channel = channel
+        self.year = year
+        self.kind = kind
+        self.format = format
+
+    def resolve(self, nick):
+        """Return whether the channel has events around the chart's year and
+        the ids of `nick`'s identities, ``None`` for an unknown nick, runs on
+        a thread."""
+        connection = app.database_engine.connect()
+        try:
+            years = activity.channel_years(connection, self.channel.id)
+            if years is None or not years[0] <= self.year <= years[1]:
+                return False, None
+            if nick is None:
+                return True, None
+            return True, activity.find_identities(
+                connection, self.channel.network_name, nick) or None
+        finally:
+            connection.close()
+
+    def build(self, identity_ids, zone):
+        """Lay the chart out from the rollups, runs on a thread."""
+        connection = app.database_engine.connect()
+        try:
+            if self.kind == 'calendar':
+                return charts.calendar_chart(self.year, activity.daily_counts(
+                    connection, self.channel.id, self.year, zone, identity_ids
+                ))
+            return charts.heatmap_chart(activity.weekly_counts(
+                connection, self.channel.id, self.year, zone, identity_ids
+            ))
+        finally:
+            connection.close()
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        store = getattr(app, 'charts', None)
+        if store is None:
+            request.setResponseCode(404)
+            return 'Charts are not available'
+        nick = get_arg(request, 'nick')
+        zone = get_timezone(get_arg(request, 'tz'))
+        # Only charts of the channel's years and known nicks are ever stored
+        key = (self.channel.id, self.year, self.kind, nick,
+               timezone_name(zone), self.format)
+
+        def serve((digest, path), closed):
+            request.setHeader('content-type',
+                              charts.RENDERERS[self.format][0])
+            if caching.set_cache_headers(request, '"%s"' % digest, closed):
+                return ''
+            request.setHeader('content-length', str(getsize(path)))
+            if request.method == 'HEAD':
+                return ''
+            return FileProducer(request, open(path, 'rb')).start()\
+                                                .addCallback(lambda _: '')
+
+        closed = caching.is_closed(activity.year_bounds(self.year, zone)[1])
+        known = store.lookup(key, self.format)
+        if known is not None:
+            return serve(known, closed)
+        if crawlers.throttled(request, 'activity'):
+            return ''
+
+        def resolved((charted, identity_ids)):
+            if not charted:
+                request.setResponseCode(404)
+                return 'No activity that year'
+            if nick is not None and identity_ids is None:
+                request.setResponseCode(404)
+                return 'No such nick'
+            return store.get(key, lambda: self.build(identity_ids, zone),
+                             self.format, closed).addCallback(serve, closed)
+        return deferToThread(self.resolve, nick).addCallback(resolved)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.completion
+    ~~~~~~~~~~~~~~~~~~~
+
+    JSON autocomplete endpoint for nicks and channel names, served straight
+    from :attr:`application.completion`, caught up with what other
+    processes logged when due.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+
+from twisted.internet.threads import deferToThread
+
+from ilog import application as app
+from ilog.utils.completion import CHANNELS, NICKS
+from ilog.web.base import JSONPage, get_arg
+
+log = logging.getLogger(__name__)
+
+MAX_LIMIT = 50
+
+
+def refresh_indexes(completion):
+    """Catch the indexes up with other processes, runs on a thread."""
+    connection = app.database_engine.connect()
+    try:
+        completion.refresh(connection)
+    finally:
+        connection.close()
+
+
+class CompletionPage(JSONPage):
+
+    def render_json(self, request):
+        network = get_arg(request, 'network', u'')
+        prefix = get_arg(request, 'q', u'')
+        kind = get_arg(request, 'kind', NICKS)
+        if kind not in (NICKS, CHANNELS):
+            kind = NICKS
+        limit = min(max(get_arg(request, 'limit', 10, int), 1), MAX_LIMIT)
+
+        completion = app.completion
+        if not completion.stale():
+            return self.matches(completion, network, kind, prefix, limit)
+        def failed(failure):
+            # Stale matches are better than none
+            log.error("Failed to refresh the completion indexes: %s",
+                      failure.getTraceback())
+        return deferToThread(refresh_indexes, completion).addErrback(failed)\
+            .addCallback(lambda _: self.matches(completion, network, kind,
+                                                prefix, limit))
+
+    def matches(self, completion, network, kind, prefix, limit):
+        matches = []
+        if prefix:
+            matches = completion.complete(network, kind, prefix, limit)
+        return {
+            'network': network,
+            'kind': kind,
+            'q': prefix,
+            'matches': [{'name': name, 'last_active': last_active}
+                        for name, last_active in matches]
+        }
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.crawlers
+    ~~~~~~~~~~~~~~~~~
+
+    Keeping crawlers and heavy clients from overloading the site.
+
+    Crawlers, recognized by their user agent with :func:`is_crawler`, are
+    only served what's already rendered: day snapshots, cached pages and
+    listings.  Whatever would need querying the events gets a ``503`` with
+    a ``Retry-After`` instead.  They find the days through the sitemaps, see
+    :mod:`ilog.web.sitemaps`, and ``robots.txt`` keeps them off the rest.
+
+    Everybody else goes through per client token buckets on the endpoints
+    which can't be served from a cache, see :func:`throttled`.  Behind a
+    reverse proxy, listed in the ``trusted_proxies`` of the ``web`` section,
+    clients are told apart by its ``X-Forwarded-For`` header, see
+    :func:`client_ip`.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import re
+import logging
+from time import time
+
+from nevow import inevow, rend, url
+
+log = logging.getLogger(__name__)
+
+CRAWLER_RE = re.compile(
+    r'bot\b|crawl|spider|slurp|archiver|googlebot|bingbot|yandex|baidu|'
+    r'duckduckgo|teoma|ia_archiver|facebookexternalhit',
+    re.IGNORECASE
+)
+#: How many user agents' verdicts to keep around
+AGENT_CACHE_SIZE = 10000
+#: When crawlers should come back for what's not rendered yet, the
+#: snapshots are written every five minutes
+RETRY_AFTER = 5 * 60
+#: Bucket name to (tokens per second, burst)
+LIMITS = {
+    'render': (1.0, 30),
+    'api': (5.0, 100),
+    'export': (1 / 60.0, 3),
+    'activity': (0.2, 20),
+}
+#: How many clients' buckets to keep, the full ones are dropped first
+MAX_CLIENTS = 50000
+
+ROBOTS = """User-agent: *
+Disallow: /api/
+Disallow: /*/*/activity/
+Disallow: /*/*/event/
+Disallow: /*/*/export
+Disallow: /*/*/live
+Sitemap: %ssitemap.xml
+"""
+
+_agents = {}
+#: The reverse proxies whose ``X-Forwarded-For`` header is trusted
+trusted_proxies = frozenset()
+
+
+def is_crawler(request):
+    agent = request.getHeader('user-agent') or ''
+    try:
+        return _agents[agent]
+    except KeyError:
+        if len(_agents) >= AGENT_CACHE_SIZE:
+            _agents.clear()
+        crawler = _agents[agent] = CRAWLER_RE.search(agent) is not None
+        return crawler
+
+
+def unavailable(request, retry_after=RETRY_AFTER):
+    """Turn a crawler away until the content is rendered."""
+    request.setResponseCode(503)
+    request.setHeader('retry-after', str(retry_after))
+    request.setHeader('content-type', 'text/plain; charset=utf-8')
+    return 'Not rendered yet, please come back later'
+
+
+class TokenBucket(object):
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time()
+
+    def refill(self, now):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now=None):
+        """Take a token, returns how many seconds to wait for one instead
+        when there's none left."""
+        self.refill(now or time())
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst, max_clients=MAX_CLIENTS):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self.buckets = {}
+
+    def take(self, client):
+        bucket = self.buckets.get(client)
+        if bucket is None:
+            if len(self.buckets) >= self.max_clients:
+                self.prune()
+            bucket = self.buckets[client] = TokenBucket(self.rate, self.burst)
+        return bucket.take()
+
+    def prune(self):
+        now = time()
+        for client, bucket in self.buckets.items():
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[client]
+        if len(self.buckets) >= self.max_clients:
+            # Everybody's busy, start over rather than grow for ever
+            log.warning("Too many clients rate limited, forgetting them")
+            self.buckets.clear()
+
+
+limiters = dict((name, RateLimiter(rate, burst))
+                for name, (rate, burst) in LIMITS.iteritems())
+
+
+def set_trusted_proxies(addresses):
+    """Trust the ``X-Forwarded-For`` header of the comma separated
+    `addresses`."""
+    global trusted_proxies
+    trusted_proxies = frozenset(address.strip() for address in
+                                (addresses or '').split(',')
+                                if address.strip())
+
+
+def client_ip(request):
+    """Return the client's address.  When the request came from a trusted
+    proxy it's the last ``X-Forwarded-For`` address not of one, the ones
+    before it being whatever the client sent."""
+    address = request.getClientIP()
+    if address not in trusted_proxies:
+        return address
+    forwarded = request.getHeader('x-forwarded-for') or ''
+    for hop in reversed(forwarded.split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        address = hop
+        if address not in trusted_proxies:
+            break
+    return address
+
+
+def throttled(request, name):
+    """Take a token from the client's `name` bucket and return ``True`` if
+    there was none, a ``429`` being set on the request."""
+    wait = limiters[name].take(client_ip(request))
+    if not wait:
+        return False
+    request.setResponseCode(429)
+    request.setHeader('retry-after', str(int(wait) + 1))
+    # Replacing the cache headers of a page throttled after its ETag check
+    request.setHeader('cache-control', 'no-store')
+    return True
+
+
+class CrawlersRefusedPage(rend.Page):
+    """Stands for the pages crawlers aren't served, see ``robots.txt``."""
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setResponseCode(403)
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        return 'Not for crawlers, see /robots.txt'
+
+
+class RobotsPage(rend.Page):
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', 'text/plain; charset=utf-8')
+        return ROBOTS % url.URL.fromContext(ctx).click('/')
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.exports
+    ~~~~~~~~~~~~~~~~
+
+    Channel history downloads.
+
+    The export is produced by :func:`ilog.export.iter_export` on the thread
+    pool, one chunk at a time, and only while the client's connection keeps
+    up, so a whole channel's history can be downloaded without the web
+    process holding more than a chunk of it.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+
+from nevow import inevow, rend
+
+from ilog.export import FORMATS, TEXT, iter_export
+from ilog.web import caching, crawlers
+from ilog.web.base import IteratorProducer
+from ilog.web.browser import parse_day, day_bounds
+
+log = logging.getLogger(__name__)
+
+
+class ExportPage(rend.Page):
+
+    def __init__(self, channel):
+        rend.Page.__init__(self)
+        self.channel = channel
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        if crawlers.throttled(request, 'export'):
+            return ''
+        format = request.args.get('format', [TEXT])[0]
+        if format not in FORMATS:
+            format = TEXT
+        start = parse_day(request.args.get('from', [''])[0])
+        end = parse_day(request.args.get('to', [''])[0])
+        if start is not None:
+            start = day_bounds(start)[0]
+        if end is not None:
+            end = day_bounds(end)[1]
+
+        content_type, extension = FORMATS[format]
+        filename = '%s-%s%s.%s' % (self.channel.network_name,
+                                   self.channel.prefix or '',
+                                   self.channel.name, extension)
+        request.setHeader('content-type', content_type)
+        request.setHeader('content-disposition',
+                          'attachment; filename="%s"' %
+                          filename.encode('utf-8').replace('"', ''))
+        request.setHeader('vary', 'Accept-Encoding')
+        compress = caching.accepts_gzip(request)
+        if compress:
+            request.setHeader('content-encoding', 'gzip')
+        if request.method == 'HEAD':
+            return ''
+
+        chunks = iter_export(self.channel.id, format, start, end, compress)
+        return IteratorProducer(request, chunks).start()
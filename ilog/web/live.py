@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.live
+    ~~~~~~~~~~~~~
+
+    Live channel tails.
+
+    :class:`LiveHub` polls the database for the events committed since its
+    last look, every :data:`POLL_INTERVAL` seconds, so every web process
+    tails whatever process logged them.  Ids that were skipped, those of
+    transactions still running, are looked at again for a while, as they may
+    still be committed.  Per channel, the hub keeps a bounded buffer of the
+    latest events already encoded, so each event is encoded once no matter
+    how many clients are tailing.  Clients either use server-sent events,
+    resuming from ``Last-Event-ID``, or long-poll with a ``cursor`` argument.
+    Both are positions within the buffer, which numbers events in the order
+    they're published, not by id, so that those committed late are still
+    delivered.
+
+    Clients which can't keep up are dropped instead of having events pile up
+    for them: the transport pauses their producer once its write buffer is
+    full and that's taken as the signal.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from collections import deque
+from random import getrandbits
+from time import time
+
+from nevow import inevow, rend
+from twisted.internet import defer, reactor, task
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.threads import deferToThread
+from zope.interface import implements
+
+from ilog import application as app
+from ilog.utils.records import EventRecord, resolve_nicks
+from ilog.web.base import JSONPage, get_arg, json
+
+log = logging.getLogger(__name__)
+
+BUFFER_SIZE = 500
+HEARTBEAT_INTERVAL = 20
+POLL_INTERVAL = 1
+#: Most events read per poll
+POLL_LIMIT = 1000
+#: How long, in seconds, skipped ids are waited for
+GAP_TIMEOUT = 30
+#: Most skipped ids waited for
+MAX_GAPS = 1000
+LONG_POLL_TIMEOUT = 25
+RETRY_MILLISECONDS = 3000
+
+
+class ChannelBroadcast(object):
+
+    def __init__(self, size=BUFFER_SIZE):
+        self.events = deque(maxlen=size)    # (sequence, payload, SSE frame)
+        self.clients = set()
+        self.waiters = []
+        self.sequence = 0
+        # Tells apart the sequences of other processes and runs
+        self.generation = '%08x' % getrandbits(32)
+
+    def format_cursor(self, sequence):
+        return '%s-%d' % (self.generation, sequence)
+
+    def parse_cursor(self, cursor):
+        """Return the sequence `cursor` stands for, ``None`` if it isn't one
+        of this buffer's."""
+        generation, _, sequence = (cursor or '').partition('-')
+        if generation != self.generation:
+            return None
+        try:
+            return int(sequence)
+        except ValueError:
+            return None
+
+    def publish(self, payload):
+        self.sequence += 1
+        event = (self.sequence, payload, 'id: %s\ndata: %s\n\n' % (
+            self.format_cursor(self.sequence),
+            json.dumps(payload, separators=(',', ':'))
+        ))
+        self.events.append(event)
+        for client in list(self.clients):
+            client.send(event[2])
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter.callback([event])
+
+    def since(self, cursor):
+        """Return the buffered events after `cursor` and whether events were
+        missed because they aren't buffered anymore."""
+        if cursor is None:
+            return [], False
+        sequence = self.parse_cursor(cursor)
+        if sequence is None:
+            # Numbered elsewhere, whatever is buffered may be new
+            return list(self.events), True
+        missed = bool(self.events) and sequence < self.events[0][0] - 1
+        return [event for event in self.events if event[0] > sequence], missed
+
+    @property
+    def cursor(self):
+        return self.format_cursor(self.sequence)
+
+    def wait(self):
+        waiter = defer.Deferred()
+        self.waiters.append(waiter)
+        timeout = reactor.callLater(LONG_POLL_TIMEOUT, self.timeout, waiter)
+        def cancel_timeout(result):
+            if timeout.active():
+                timeout.cancel()
+            return result
+        return waiter.addBoth(cancel_timeout)
+
+    def timeout(self, waiter):
+        if waiter in self.waiters:
+            self.waiters.remove(waiter)
+            waiter.callback([])
+
+
+class LiveHub(object):
+
+    def __init__(self):
+        self.channels = {}
+        self.heartbeat = task.LoopingCall(self.send_heartbeat)
+        self.poller = task.LoopingCall(self.poll)
+        self.cursor = None
+        # skipped event id -> when it was skipped
+        self.gaps = {}
+
+    def start(self):
+        self.heartbeat.start(HEARTBEAT_INTERVAL, now=False)
+        self.poller.start(POLL_INTERVAL, now=True)
+
+    def stop(self):
+        for call in (self.heartbeat, self.poller):
+            if call.running:
+                call.stop()
+
+    def poll(self):
+        def failed(failure):
+            # Don't let an error stop the looping call
+            log.error("Failed to poll events: %s", failure.getTraceback())
+        return deferToThread(self.read_events).addCallbacks(self.publish_all,
+                                                            failed)
+
+    def read_events(self):
+        """Return the events committed since the last poll, runs on a
+        thread."""
+        from ilog.database import db, Event
+
+        events = Event.__table__
+        connection = app.database_engine.connect()
+        try:
+            if self.cursor is None:
+                # Tail from now on
+                self.cursor = connection.execute(
+                    db.select([db.func.max(events.c.id)])).scalar() or 0
+                return []
+            clause = events.c.id > self.cursor
+            if self.gaps:
+                clause = db.or_(clause, events.c.id.in_(self.gaps.keys()))
+            rows = connection.execute(db.select(
+                [events.c.id, events.c.channel_id, events.c.stamp,
+                 events.c.type, events.c.identity_id, events.c.message],
+                clause, order_by=[events.c.id], limit=POLL_LIMIT
+            )).fetchall()
+            records = resolve_nicks(connection, [
+                EventRecord(row.id, row.stamp, row.type, row.identity_id,
+                            row.message) for row in rows
+            ])
+        finally:
+            connection.close()
+
+        now = time()
+        for event_id, skipped in self.gaps.items():
+            if now - skipped > GAP_TIMEOUT:
+                del self.gaps[event_id]
+        for row in rows:
+            self.gaps.pop(row.id, None)
+            if row.id > self.cursor:
+                for event_id in xrange(self.cursor + 1, row.id):
+                    if len(self.gaps) >= MAX_GAPS:
+                        break
+                    self.gaps[event_id] = now
+                self.cursor = row.id
+        return [(row.channel_id, record)
+                for row, record in zip(rows, records)]
+
+    def publish_all(self, events):
+        for channel_id, event in events:
+            self.publish(channel_id, {
+                'id': event.id,
+                'stamp': event.stamp and event.stamp.isoformat(),
+                'type': event.type,
+                'nick': event.nick,
+                'message': event.message
+            })
+
+    def get_channel(self, channel_id):
+        try:
+            return self.channels[channel_id]
+        except KeyError:
+            broadcast = self.channels[channel_id] = ChannelBroadcast()
+            return broadcast
+
+    def publish(self, channel_id, payload):
+        self.get_channel(channel_id).publish(payload)
+
+    def send_heartbeat(self):
+        for broadcast in self.channels.itervalues():
+            for client in list(broadcast.clients):
+                client.send(': ping\n\n')
+
+
+class EventStreamClient(object):
+    implements(IPushProducer)
+
+    def __init__(self, broadcast, request):
+        self.broadcast = broadcast
+        self.request = request
+        self.deferred = defer.Deferred()
+
+    def start(self, cursor):
+        request = self.request
+        request.setHeader('content-type', 'text/event-stream')
+        request.setHeader('cache-control', 'no-cache')
+        request.registerProducer(self, True)
+        request.notifyFinish().addBoth(lambda _: self.stopProducing())
+
+        events, missed = self.broadcast.since(cursor)
+        backlog = ['retry: %d\n\n' % RETRY_MILLISECONDS]
+        if missed:
+            backlog.append('event: gap\ndata: {}\n\n')
+        backlog.extend(frame for sequence, payload, frame in events)
+        request.write(''.join(backlog))
+        self.broadcast.clients.add(self)
+        return self.deferred
+
+    def send(self, frame):
+        self.request.write(frame)
+
+    def pauseProducing(self):
+        # The transport's buffer is full, this client can't keep up
+        log.debug("Dropping slow live tail client %s",
+                  self.request.getClientIP())
+        transport = self.request.transport
+        self.stopProducing()
+        transport.loseConnection()
+
+    def resumeProducing(self):
+        pass
+
+    def stopProducing(self):
+        if self.broadcast is None:
+            return
+        self.broadcast.clients.discard(self)
+        self.broadcast = None
+        self.request.unregisterProducer()
+        self.deferred.callback('')
+
+
+class LongPollPage(JSONPage):
+
+    def __init__(self, broadcast):
+        JSONPage.__init__(self)
+        self.broadcast = broadcast
+
+    def render_json(self, request):
+        request.setHeader('cache-control', 'no-cache')
+        cursor = get_arg(request, 'cursor')
+        if not cursor:
+            # Just tell the client where to start polling from
+            return {'events': [], 'missed': False,
+                    'cursor': self.broadcast.cursor}
+        events, missed = self.broadcast.since(cursor)
+        if events or missed:
+            return self.response(events, missed, cursor)
+        return self.broadcast.wait().addCallback(self.response, False, cursor)
+
+    def response(self, events, missed, cursor):
+        if events:
+            cursor = self.broadcast.format_cursor(events[-1][0])
+        elif self.broadcast.parse_cursor(cursor) is None:
+            cursor = self.broadcast.cursor
+        return {'events': [payload for sequence, payload, frame in events],
+                'missed': missed, 'cursor': cursor}
+
+
+class LiveTailPage(rend.Page):
+
+    def __init__(self, channel_id):
+        rend.Page.__init__(self)
+        self.channel_id = channel_id
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        broadcast = app.live.get_channel(self.channel_id)
+        if 'cursor' in request.args or 'poll' in request.args:
+            return LongPollPage(broadcast).renderHTTP(ctx)
+        cursor = request.getHeader('last-event-id')
+        return EventStreamClient(broadcast, request).start(cursor)
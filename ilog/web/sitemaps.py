@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.sitemaps
+    ~~~~~~~~~~~~~~~~~
+
+    Sitemaps of the closed channel days, ``/sitemap.xml`` indexing one
+    sitemap per month, ``/sitemap/<YYYY-MM>.xml``.  Months with more than
+    :data:`SITEMAP_URLS` days are split in pages, the following ones being
+    ``/sitemap/<YYYY-MM>-<page>.xml``, to keep under the protocol's limits
+    of 50,000 URLs and 50MB per sitemap.
+
+    Days are listed once closed, when they can be served to crawlers from
+    their snapshots, with the date they closed on as their last change.  A
+    month's sitemap is built from the :class:`~ilog.database.ChannelDay`
+    rows, never from the events, and once the month is over it doesn't
+    change anymore: crawlers only fetch again the months whose last change
+    in the index is newer than their copy.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import logging
+from datetime import date, datetime, timedelta
+from urllib import quote
+from xml.sax.saxutils import escape
+
+from nevow import inevow, rend, url
+from twisted.internet.threads import deferToThread
+
+from ilog import application as app
+from ilog.database import db, Channel, ChannelDay
+from ilog.web import caching
+from ilog.web.browser import DAY_FORMAT, channel_segment
+
+log = logging.getLogger(__name__)
+
+MONTH_FORMAT = '%Y-%m'
+#: How long the index and the current month's sitemap are cached
+SITEMAP_TTL = 5 * 60
+CONTENT_TYPE = 'application/xml; charset=utf-8'
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+SITEMAPS_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+#: Most URLs per sitemap
+SITEMAP_URLS = 40000
+
+
+def month_of(day):
+    return date(day.year, day.month, 1)
+
+
+def next_month(month):
+    return month_of(month + timedelta(days=31))
+
+
+def parse_month(segment):
+    """Return the month and page of a month's sitemap name, or ``None``."""
+    name, page = segment, 1
+    if name.count('-') == 2:
+        name, page = name.rsplit('-', 1)
+        if not page.isdigit():
+            return None
+        page = int(page)
+    try:
+        month = datetime.strptime(name, MONTH_FORMAT).date()
+    except ValueError:
+        return None
+    # Each sitemap has a single name
+    if sitemap_name(month, page) != segment:
+        return None
+    return month, page
+
+
+def sitemap_name(month, page):
+    name = month.strftime(MONTH_FORMAT)
+    if page > 1:
+        name += '-%d' % page
+    return name
+
+
+def last_closed_day():
+    day = datetime.utcnow().date()
+    while not caching.is_closed_day(day):
+        day -= timedelta(days=1)
+    return day
+
+
+def closed_on(day):
+    """The date a day's log stopped changing."""
+    return (day + timedelta(days=1)).isoformat()
+
+
+def read_months(connection):
+    """Return the months with closed days, the last of them and how many
+    channel days they have, in order."""
+    table = ChannelDay.__table__
+    months = {}
+    for day, days in connection.execute(db.select(
+            [table.c.day, db.func.count(table.c.channel_id)],
+            table.c.day <= last_closed_day(), group_by=[table.c.day])):
+        month = month_of(day)
+        last_day, total = months.get(month, (day, 0))
+        months[month] = (max(last_day, day), total + days)
+    return [(month, last_day, total) for month, (last_day, total)
+            in sorted(months.iteritems())]
+
+
+def read_month(connection, month, page=1):
+    """Return a page of the closed days of `month` and the channels they're
+    of."""
+    days, channels = ChannelDay.__table__, Channel.__table__
+    return connection.execute(db.select(
+        [channels.c.network_name, channels.c.prefix, channels.c.name,
+         days.c.day],
+        db.and_(days.c.day >= month, days.c.day < next_month(month),
+                days.c.day <= last_closed_day()),
+        from_obj=[days.join(channels, channels.c.id == days.c.channel_id)],
+        order_by=[days.c.day, days.c.channel_id],
+        offset=(page - 1) * SITEMAP_URLS, limit=SITEMAP_URLS
+    )).fetchall()
+
+
+def render_index(base, months):
+    parts = [XML_HEADER, '<sitemapindex xmlns="%s">\n' % SITEMAPS_NS]
+    for month, last_day, total in months:
+        pages = (total + SITEMAP_URLS - 1) // SITEMAP_URLS
+        for page in xrange(1, pages + 1):
+            parts.append('<sitemap><loc>%ssitemap/%s.xml</loc>'
+                         '<lastmod>%s</lastmod></sitemap>\n' % (
+                            escape(base), sitemap_name(month, page),
+                            closed_on(last_day)))
+    parts.append('</sitemapindex>\n')
+    return ''.join(parts)
+
+
+def render_month(base, rows):
+    parts = [XML_HEADER, '<urlset xmlns="%s">\n' % SITEMAPS_NS]
+    for network_name, prefix, name, day in rows:
+        location = '%s%s/%s/%s' % (base,
+                                   quote(network_name.encode('utf-8'),
+                                         safe=''),
+                                   channel_segment(prefix, name),
+                                   day.strftime(DAY_FORMAT))
+        parts.append('<url><loc>%s</loc><lastmod>%s</lastmod></url>\n' % (
+            escape(location), closed_on(day)))
+    parts.append('</urlset>\n')
+    return ''.join(parts)
+
+
+def build_index(base):
+    """Runs on a thread."""
+    connection = app.database_engine.connect()
+    try:
+        return render_index(base, read_months(connection))
+    finally:
+        connection.close()
+
+
+def build_month(base, month, page=1):
+    """Runs on a thread."""
+    connection = app.database_engine.connect()
+    try:
+        return render_month(base, read_month(connection, month, page))
+    finally:
+        connection.close()
+
+
+def cached(key, create, ttl):
+    fragments = getattr(app, 'fragments', None)
+    if fragments is None:
+        return create()
+    return fragments.get_or_create(key, create, ttl=ttl)
+
+
+class SitemapIndexPage(rend.Page):
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', CONTENT_TYPE)
+        base = str(url.URL.fromContext(ctx).click('/'))
+        return cached(('sitemap', base),
+                      lambda: deferToThread(build_index, base), SITEMAP_TTL)
+
+
+class MonthSitemapPage(rend.Page):
+
+    def __init__(self, month, page=1):
+        rend.Page.__init__(self)
+        self.month = month
+        self.page = page
+
+    def renderHTTP(self, ctx):
+        request = inevow.IRequest(ctx)
+        request.setHeader('content-type', CONTENT_TYPE)
+        base = str(url.URL.fromContext(ctx).click('/'))
+        # Past months don't change anymore
+        closed = caching.is_closed_day(next_month(self.month) -
+                                       timedelta(days=1))
+        return cached(('sitemap', base, self.month, self.page),
+                      lambda: deferToThread(build_month, base, self.month,
+                                            self.page),
+                      not closed and SITEMAP_TTL or None)
+
+
+class SitemapsPage(rend.Page):
+
+    def childFactory(self, ctx, segment):
+        if not segment.endswith('.xml'):
+            return None
+        parsed = parse_month(segment[:-len('.xml')])
+        if parsed is not None:
+            return MonthSitemapPage(*parsed)
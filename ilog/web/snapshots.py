@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.snapshots
+    ~~~~~~~~~~~~~~~~~~
+
+    Pre-rendered snapshots of closed channel days.
+
+    Rendering a day is the most expensive thing the web site does and for a
+    closed day it's always the same, so :class:`SnapshotStore` renders every
+    closed day once, in the background, to gzip compressed HTML and plain
+    text files.  Those are later streamed straight from disk, either as they
+    are to clients accepting gzip or decompressed on the fly to the others.
+    Only the current day is rendered live.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import gzip
+import logging
+from os.path import dirname, exists, getsize, isdir, join
+
+from twisted.internet import defer, task
+from twisted.internet.threads import deferToThread
+
+from ilog.database import db, Channel, ChannelDay
+from ilog.web import caching
+from ilog.web.base import FileProducer
+from ilog.web.browser import DAY_FORMAT, HTML, TEXT, DayLog
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_INTERVAL = 5 * 60
+EXTENSIONS = {HTML: '.html.gz', TEXT: '.txt.gz'}
+
+
+class SnapshotStore(object):
+
+    def __init__(self, directory, interval=SNAPSHOT_INTERVAL):
+        self.directory = directory
+        self.state_file = join(directory, 'last-event-id')
+        self.last_event_id = 0
+        # (channel id, day) -> last event id, of the days written past
+        # last_event_id
+        self.written = {}
+        if exists(self.state_file):
+            self.last_event_id = int(open(self.state_file).read().strip()
+                                     or 0)
+        self.call = task.LoopingCall(self.run)
+        self.interval = interval
+
+    def path(self, channel_id, day, format):
+        return join(self.directory, str(channel_id), day.strftime('%Y'),
+                    day.strftime(DAY_FORMAT) + EXTENSIONS[format])
+
+    def start(self):
+        if not isdir(self.directory):
+            os.makedirs(self.directory)
+        self.call.start(self.interval, now=True)
+
+    def stop(self):
+        if self.call.running:
+            self.call.stop()
+
+    def run(self):
+        def failed(failure):
+            # Don't let an error stop the looping call
+            log.error("Failed to write snapshots: %s", failure.getTraceback())
+        return deferToThread(self.write_pending).addErrback(failed)
+
+    def write_pending(self):
+        """Snapshot the closed days which got events since the last run,
+        found through their :class:`~ilog.database.ChannelDay` rows, the
+        same UTC days :class:`DayLog` renders.  Runs on a thread."""
+        days = ChannelDay.__table__
+        session = db.session()
+        try:
+            rows = session.execute(db.select(
+                [days.c.channel_id, days.c.day, days.c.last_event_id],
+                days.c.last_event_id > self.last_event_id
+            )).fetchall()
+            resume_id = max([self.last_event_id] +
+                            [last_id for channel_id, day, last_id in rows])
+            written = 0
+            for channel_id, day, last_id in rows:
+                if not caching.is_closed_day(day):
+                    # Looked at again on the next runs, until it's closed
+                    resume_id = min(resume_id, last_id - 1)
+                    continue
+                if self.written.get((channel_id, day)) == last_id:
+                    continue
+                channel = session.query(Channel).get(channel_id)
+                self.write_day(session, channel, day)
+                self.written[(channel_id, day)] = last_id
+                written += 1
+        finally:
+            session.close()
+        # The days written since the resume point come back until then
+        for key, last_id in self.written.items():
+            if last_id <= resume_id:
+                del self.written[key]
+
+        if resume_id != self.last_event_id:
+            self.last_event_id = resume_id
+            state = open(self.state_file + '.tmp', 'w')
+            try:
+                state.write(str(resume_id))
+            finally:
+                state.close()
+            os.rename(self.state_file + '.tmp', self.state_file)
+        if written:
+            log.info("Wrote %d day snapshots", written)
+        return written
+
+    def write_day(self, session, channel, day):
+        day_log = DayLog(channel, day)
+        files = {}
+        try:
+            for format in (HTML, TEXT):
+                path = self.path(channel.id, day, format)
+                if not isdir(dirname(path)):
+                    os.makedirs(dirname(path))
+                files[format] = gzip.open(path + '.tmp', 'wb')
+                files[format].write(day_log.parts(format)[0])
+            for rows in day_log.iter_chunks(session):
+                for format, fileobj in files.iteritems():
+                    fileobj.write(day_log.render(rows, format))
+            for format, fileobj in files.iteritems():
+                fileobj.write(day_log.parts(format)[1])
+        finally:
+            for fileobj in files.itervalues():
+                fileobj.close()
+        for format in files:
+            path = self.path(channel.id, day, format)
+            os.rename(path + '.tmp', path)
+
+    def serve(self, request, channel_id, day, format):
+        """Serve a day's snapshot, the returned deferred fires with ``False``
+        when there's no snapshot for the day."""
+        path = self.path(channel_id, day, format)
+        if not exists(path):
+            return defer.succeed(False)
+
+        gzipped = caching.accepts_gzip(request)
+        etag = caching.variant_etag(caching.file_etag(path), format,
+                                    gzipped and 'gzip' or 'identity')
+        if caching.set_cache_headers(request, etag, True):
+            return defer.succeed(True)
+
+        if gzipped:
+            request.setHeader('content-encoding', 'gzip')
+            request.setHeader('content-length', str(getsize(path)))
+            fileobj = open(path, 'rb')
+        else:
+            fileobj = gzip.open(path, 'rb')
+        if request.method == 'HEAD':
+            fileobj.close()
+            return defer.succeed(True)
+        return FileProducer(request, fileobj).start().addCallback(
+                                                            lambda _: True)
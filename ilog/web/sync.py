@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.sync
+    ~~~~~~~~~~~~~
+
+    Incremental sync for mirrors and clients keeping a local copy of the
+    logs, ``/api/v1/sync?cursor=``.
+
+    A response holds, in batches, the channels and identities created or
+    changed and the events logged after the cursor, plus the cursor to ask
+    for the next batch with.  Channels and identities come before the events
+    referring to them.  The cursor holds the last ids seen of events,
+    channels, identities and :class:`~ilog.database.Change` rows, so syncing
+    can be resumed at any time and starting without a cursor copies
+    everything.  ``more`` says whether there's more to fetch right away.
+
+    Ids aren't committed in order: a row may show up after one with a
+    higher id was synced.  The ids skipped over are kept in the cursor too,
+    and looked for again for :data:`GAP_TIMEOUT` seconds, like the live
+    tails do, see :mod:`ilog.web.live`.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+from time import time
+
+from twisted.internet.threads import deferToThread
+
+from ilog import application as app
+from ilog.database import db, Change
+from ilog.web.api import (APIError, COLLECTIONS, decode_cursor, encode_cursor,
+                          encode_value)
+from ilog.web import crawlers
+from ilog.web.base import JSONPage, get_arg
+
+DEFAULT_BATCH = 1000
+MAX_BATCH = 5000
+#: How long, in seconds, skipped ids are looked for again
+GAP_TIMEOUT = 60
+#: Most skipped ids a cursor keeps per table
+MAX_GAPS = 100
+
+
+def is_integer(value):
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def decode_sync_cursor(cursor):
+    """Return the last ids seen and the ``[id, when skipped]`` pairs of the
+    ids skipped over, of events, channels, identities and changes."""
+    if not cursor:
+        return [0, 0, 0, 0], [[], [], [], []]
+    position = decode_cursor(cursor, list)
+    # Cursors handed out before skipped ids were kept have none
+    gaps = [[], [], [], []]
+    if len(position) == 5:
+        position, gaps = position[:4], position[4]
+    if len(position) != 4 or not all(is_integer(value)
+                                     for value in position):
+        raise APIError("Invalid cursor")
+    if not isinstance(gaps, list) or len(gaps) != 4 or not all(
+            isinstance(skipped, list) and len(skipped) <= MAX_GAPS and all(
+                isinstance(gap, list) and len(gap) == 2 and
+                is_integer(gap[0]) and is_integer(gap[1]) for gap in skipped
+            ) for skipped in gaps):
+        raise APIError("Invalid cursor")
+    return position, gaps
+
+
+class SyncBatch(object):
+    """Reads a batch of changes after a position, runs on a thread."""
+
+    def __init__(self, connection, limit):
+        self.connection = connection
+        self.limit = limit
+        self.more = False
+        self.now = int(time())
+
+    def read_after(self, query, key, after_id, gaps):
+        """Return the rows of `query`, keyed by `key`, after `after_id` or
+        among the skipped ids `gaps`, those skipped meanwhile first."""
+        clause = key > after_id
+        if gaps:
+            clause = db.or_(clause, key.in_([gap_id for gap_id, skipped
+                                             in gaps]))
+        rows = self.connection.execute(
+            query.where(clause).order_by(key).limit(self.limit + 1)
+        ).fetchall()
+        if len(rows) > self.limit:
+            self.more = True
+            rows = rows[:self.limit]
+        return rows
+
+    def track_gaps(self, rows, after_id, gaps):
+        """Return the last id seen and the ids still skipped over once
+        `rows` are synced."""
+        found = set(row[0] for row in rows)
+        pending = [[gap_id, skipped] for gap_id, skipped in gaps
+                   if gap_id not in found and
+                      self.now - skipped <= GAP_TIMEOUT]
+        last_id = after_id
+        for row in rows:
+            if row[0] > last_id:
+                pending.extend([gap_id, self.now] for gap_id in
+                               xrange(max(last_id + 1, row[0] - MAX_GAPS),
+                                      row[0]))
+                last_id = row[0]
+        return last_id, pending[-MAX_GAPS:]
+
+    def rows_after(self, collection, after_id, gaps):
+        key = collection.key
+        columns = [key.label('key')] + [column for name, column
+                                        in collection.fields]
+        return self.read_after(db.select(columns,
+                                         from_obj=collection.from_obj()),
+                               key, after_id, gaps)
+
+    def changed_rows(self, collection, ids, exclude):
+        ids = [object_id for object_id in ids if object_id not in exclude]
+        if not ids:
+            return []
+        columns = [collection.key.label('key')] + [
+            column for name, column in collection.fields
+        ]
+        return self.connection.execute(
+            db.select(columns).where(collection.key.in_(ids))
+                              .order_by(collection.key)
+        ).fetchall()
+
+    def encode(self, collection, rows):
+        return {
+            'fields': [name for name, column in collection.fields],
+            'rows': [[encode_value(value) for value in row[1:]]
+                     for row in rows]
+        }
+
+    def read(self, position, gaps):
+        event_id, channel_id, identity_id, change_id = position
+        event_gaps, channel_gaps, identity_gaps, change_gaps = gaps
+        channels = COLLECTIONS['channels']
+        identities = COLLECTIONS['identities']
+        events = COLLECTIONS['events']
+        changes = Change.__table__
+
+        new_channels = self.rows_after(channels, channel_id, channel_gaps)
+        new_identities = self.rows_after(identities, identity_id,
+                                         identity_gaps)
+        changed = self.read_after(
+            db.select([changes.c.id, changes.c.kind, changes.c.object_id]),
+            changes.c.id, change_id, change_gaps
+        )
+        last_channel, channel_gaps = self.track_gaps(new_channels,
+                                                     channel_id, channel_gaps)
+        last_identity, identity_gaps = self.track_gaps(
+            new_identities, identity_id, identity_gaps)
+        new_events = self.rows_after(events, event_id, event_gaps)
+        # Events stop before the first one referring to a channel or an
+        # identity which isn't part of the batch yet
+        names = [name for name, column in events.fields]
+        channel_index = names.index('channel') + 1
+        identity_index = names.index('identity') + 1
+        missing_channels = set(gap_id for gap_id, skipped in channel_gaps)
+        missing_identities = set(gap_id for gap_id, skipped in identity_gaps)
+        for index, row in enumerate(new_events):
+            if row[channel_index] > last_channel or \
+                    row[identity_index] > last_identity or \
+                    row[channel_index] in missing_channels or \
+                    row[identity_index] in missing_identities:
+                new_events = new_events[:index]
+                self.more = True
+                break
+        last_event, event_gaps = self.track_gaps(new_events, event_id,
+                                                 event_gaps)
+        last_change, change_gaps = self.track_gaps(changed, change_id,
+                                                   change_gaps)
+
+        channel_rows = new_channels + self.changed_rows(
+            channels, set(row[2] for row in changed if row[1] == u'channel'),
+            set(row[0] for row in new_channels)
+        )
+        identity_rows = new_identities + self.changed_rows(
+            identities, set(row[2] for row in changed
+                            if row[1] == u'identity'),
+            set(row[0] for row in new_identities)
+        )
+        return {
+            'channels': self.encode(channels, channel_rows),
+            'identities': self.encode(identities, identity_rows),
+            'events': self.encode(events, new_events),
+            'cursor': encode_cursor([
+                last_event, last_channel, last_identity, last_change,
+                [event_gaps, channel_gaps, identity_gaps, change_gaps]
+            ]),
+            'more': self.more
+        }
+
+
+def read_batch((position, gaps), limit):
+    connection = app.database_engine.connect()
+    try:
+        return SyncBatch(connection, limit).read(position, gaps)
+    finally:
+        connection.close()
+
+
+class SyncPage(JSONPage):
+    compress = True
+
+    def render_json(self, request):
+        request.setHeader('cache-control', 'no-cache')
+        if crawlers.throttled(request, 'api'):
+            return {'error': 'Too many requests'}
+        try:
+            position = decode_sync_cursor(get_arg(request, 'cursor'))
+        except APIError, error:
+            request.setResponseCode(error.code)
+            return {'error': str(error)}
+        limit = min(max(get_arg(request, 'limit', DEFAULT_BATCH, int), 1),
+                    MAX_BATCH)
+        return deferToThread(read_batch, position, limit)
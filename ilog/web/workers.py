@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""
+    ilog.web.workers
+    ~~~~~~~~~~~~~~~~
+
+    Multi-process web serving.
+
+    :class:`Supervisor` binds the listening socket and starts worker
+    processes which inherit it and accept on it, each running its own
+    reactor, so rendering isn't bound to a single core.  Workers which die
+    are started again, backing off if they keep dying.
+
+    On shutdown, workers are asked to drain: :class:`DrainingSite` stops
+    accepting, closes idle connections and waits for the requests in flight
+    to finish, for at most :data:`DRAIN_TIMEOUT` seconds.
+
+    A server, either a single process or a supervisor, can also be replaced
+    without downtime, see :func:`install_handoff`: on ``SIGUSR2`` it starts
+    a successor which inherits the listening socket, and only once the
+    successor has warmed its caches and is serving, does the old server
+    drain and exit.  New connections keep being accepted by one or the
+    other all along.
+
+    :copyright: © 2010 UfSoft.org - Pedro Algarvio <ufs@ufsoft.org>
+    :license: BSD, see LICENSE for more details.
+"""
+
+import os
+import sys
+import signal
+import socket
+import logging
+from time import time
+
+from nevow import appserver
+from twisted.internet import defer, error, protocol, reactor
+
+log = logging.getLogger(__name__)
+
+DRAIN_TIMEOUT = 30
+LISTEN_BACKLOG = 128
+RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+#: Workers living less than this are considered to be crashing at startup
+MIN_UPTIME = 10
+#: Runs a worker, the command line follows
+WORKER_SCRIPT = 'from ilog.bootstrap import daemon; daemon()'
+#: The listening socket and readiness pipe's descriptors in child processes
+LISTEN_FD = 3
+READY_FD = 4
+READY_MESSAGE = 'ready\n'
+#: Options handing out descriptors, which aren't passed on to a successor
+CHILD_OPTIONS = ('--listen-fd', '--ready-fd', '--worker-index')
+
+
+class TrackedChannel(appserver.NevowSite.protocol):
+    """HTTP channel known to its site, so that it can be drained."""
+
+    def connectionMade(self):
+        appserver.NevowSite.protocol.connectionMade(self)
+        self.factory.channels.add(self)
+
+    def requestDone(self, request):
+        appserver.NevowSite.protocol.requestDone(self, request)
+        if self.factory.draining and not self.requests:
+            self.transport.loseConnection()
+
+    def connectionLost(self, reason):
+        self.factory.channels.discard(self)
+        appserver.NevowSite.protocol.connectionLost(self, reason)
+        self.factory.check_drained()
+
+
+class DrainingSite(appserver.NevowSite):
+    protocol = TrackedChannel
+
+    def __init__(self, *args, **kwargs):
+        appserver.NevowSite.__init__(self, *args, **kwargs)
+        self.channels = set()
+        self.draining = False
+        self.waiters = []
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """Close the idle connections and return a deferred fired once the
+        busy ones are done, or after `timeout` seconds, closing them."""
+        self.draining = True
+        for channel in list(self.channels):
+            if not channel.requests:
+                channel.transport.loseConnection()
+        waiter = defer.Deferred()
+        self.waiters.append(waiter)
+        deadline = reactor.callLater(timeout, self.force_close)
+        def cancel_deadline(result):
+            if deadline.active():
+                deadline.cancel()
+            return result
+        waiter.addBoth(cancel_deadline)
+        self.check_drained()
+        return waiter
+
+    def check_drained(self):
+        if self.draining and not self.channels:
+            self.drained()
+
+    def drained(self):
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter.callback(None)
+
+    def force_close(self):
+        log.warning("Closing %d connections still busy after draining",
+                    len(self.channels))
+        for channel in list(self.channels):
+            transport = channel.transport
+            # Don't wait for slow clients to take what's still buffered
+            getattr(transport, 'abortConnection', transport.loseConnection)()
+        self.drained()
+
+
+def drain_on_shutdown(port, site, timeout=DRAIN_TIMEOUT):
+    def drain():
+        log.info("Draining %d connections", len(site.channels))
+        return defer.maybeDeferred(port.stopListening).addCallback(
+                                            lambda _: site.drain(timeout))
+    reactor.addSystemEventTrigger('before', 'shutdown', drain)
+
+
+def bind_socket(port, interface=''):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    return sock
+
+
+def inherit_socket(fd):
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    return sock
+
+
+def adopt_socket(fd, site):
+    """Start serving `site` on the inherited listening socket `fd`."""
+    port = reactor.adoptStreamPort(fd, socket.AF_INET, site)
+    # The reactor holds its own copy of the socket
+    os.close(fd)
+    return port
+
+
+def notify_ready(fd):
+    """Tell the parent process we're serving."""
+    if fd is None:
+        return
+    try:
+        os.write(fd, READY_MESSAGE)
+    except OSError, error:
+        # The parent is gone, nobody's waiting for us
+        log.debug("Failed to notify readiness: %s", error)
+    os.close(fd)
+
+
+class ChildProtocol(protocol.ProcessProtocol):
+    """A child process sharing our listening socket.  :attr:`ready` fires
+    when it says it's serving and fails if it ends before that."""
+
+    def __init__(self):
+        self.started = time()
+        self.ready = defer.Deferred()
+        self.ended = defer.Deferred()
+
+    def childDataReceived(self, childFD, data):
+        if childFD != READY_FD:
+            return protocol.ProcessProtocol.childDataReceived(self, childFD,
+                                                              data)
+        if data.startswith(READY_MESSAGE.strip()) and not self.ready.called:
+            self.ready.callback(self)
+
+    def outReceived(self, data):
+        sys.stdout.write(data)
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+    def processEnded(self, reason):
+        if not self.ready.called:
+            self.ready.errback(reason)
+        self.ended.callback(None)
+
+
+def spawn_child(child, arguments, sock, inherit_output=False):
+    if inherit_output:
+        # The child outlives us, it can't write through us
+        output = {0: 0, 1: 1, 2: 2}
+    else:
+        output = {0: 'w', 1: 'r', 2: 'r'}
+    output.update({LISTEN_FD: sock.fileno(), READY_FD: 'r'})
+    reactor.spawnProcess(child, sys.executable,
+                         [sys.executable, '-c', WORKER_SCRIPT] + arguments,
+                         env=os.environ, childFDs=output)
+    return child
+
+
+class WorkerProtocol(ChildProtocol):
+
+    def __init__(self, supervisor, index):
+        ChildProtocol.__init__(self)
+        self.supervisor = supervisor
+        self.index = index
+
+    def processEnded(self, reason):
+        ChildProtocol.processEnded(self, reason)
+        self.supervisor.worker_ended(self, reason)
+
+
+class Supervisor(object):
+
+    def __init__(self, port, workers, arguments, drain_timeout=DRAIN_TIMEOUT):
+        self.port = port
+        self.count = workers
+        # Command line arguments placed before the worker's own
+        self.arguments = arguments
+        self.drain_timeout = drain_timeout
+        self.workers = {}
+        self.delays = {}
+        self.stopping = False
+        self.socket = None
+
+    def start(self, sock=None):
+        """Start the workers, on `sock` or on a new socket, the returned
+        deferred fires once they're all serving and fails as soon as one of
+        them ends before that."""
+        self.socket = sock or bind_socket(self.port)
+        log.info("Listening on port %d with %d workers",
+                 self.socket.getsockname()[1], self.count)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        return defer.DeferredList([self.spawn(index).ready
+                                   for index in range(self.count)],
+                                  fireOnOneErrback=True, consumeErrors=True)\
+                    .addErrback(lambda failure: failure.value.subFailure)
+
+    def worker_arguments(self, index):
+        return self.arguments + [
+            'serve', '--listen-fd', str(LISTEN_FD), '--ready-fd',
+            str(READY_FD), '--worker-index', str(index)
+        ]
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = spawn_child(WorkerProtocol(self, index),
+                             self.worker_arguments(index), self.socket)
+        self.workers[index] = worker
+        log.info("Started worker %d, pid %d", index, worker.transport.pid)
+        return worker
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+        if self.stopping:
+            return
+        if time() - worker.started < MIN_UPTIME:
+            delay = min(self.delays.get(worker.index, RESTART_DELAY) * 2,
+                        MAX_RESTART_DELAY)
+        else:
+            delay = RESTART_DELAY
+        self.delays[worker.index] = delay
+        log.error("Worker %d died (%s), starting it again in %d seconds",
+                  worker.index, reason.value, delay)
+        reactor.callLater(delay, self.restart, worker.index)
+
+    def restart(self, index):
+        worker = self.spawn(index)
+        if worker is not None:
+            # Failing to start again is dealt with when the process ends
+            worker.ready.addErrback(lambda failure: None)
+
+    def signal_workers(self, signum):
+        for worker in self.workers.values():
+            try:
+                worker.transport.signalProcess(signum)
+            except (OSError, error.ProcessExitedAlready):
+                pass
+
+    def stop(self):
+        """Ask every worker to drain and return a deferred fired once they
+        are all gone, killing the ones which take too long."""
+        self.stopping = True
+        if self.socket is not None:
+            self.socket.close()
+        ended = [worker.ended for worker in self.workers.values()]
+        self.signal_workers(signal.SIGTERM)
+        # Workers get some more time than they give their clients
+        deadline = reactor.callLater(self.drain_timeout + 5,
+                                     self.signal_workers, signal.SIGKILL)
+        def cancel_deadline(result):
+            if deadline.active():
+                deadline.cancel()
+            return result
+        return defer.DeferredList(ended).addBoth(cancel_deadline)
+
+
+def successor_arguments(arguments):
+    """Our own command line without the descriptors we were given."""
+    result = []
+    arguments = iter(arguments)
+    for argument in arguments:
+        if argument in CHILD_OPTIONS:
+            arguments.next()
+        elif argument.split('=', 1)[0] not in CHILD_OPTIONS:
+            result.append(argument)
+    if 'serve' not in result:
+        result.append('serve')
+    return result
+
+
+def install_handoff(sock):
+    """Hand off the listening socket `sock` to a new server process on
+    ``SIGUSR2``, stopping once it's serving."""
+    handing_off = []
+
+    def handoff():
+        if handing_off:
+            return
+        handing_off.append(True)
+        log.info("Starting a new server to hand off to")
+        arguments = successor_arguments(sys.argv[1:]) + [
+            '--listen-fd', str(LISTEN_FD), '--ready-fd', str(READY_FD)
+        ]
+        successor = spawn_child(ChildProtocol(), arguments, sock,
+                                inherit_output=True)
+        def ready(_):
+            log.info("The new server, pid %d, is serving, stopping",
+                     successor.transport.pid)
+            reactor.stop()
+        def failed(failure):
+            log.error("The new server failed to start, keeping on serving: "
+                      "%s", failure.getErrorMessage())
+            del handing_off[:]
+        successor.ready.addCallbacks(ready, failed)
+
+    signal.signal(signal.SIGUSR2,
+                  lambda signum, frame: reactor.callFromThread(handoff))
@@ -9,7 +9,9 @@
 
 
 import csv
+import gzip
 import os
+from hashlib import md5
 from distutils import cmd
 from distutils.command.build import build as _build
 from distutils.command.clean import clean
@@ -94,13 +96,72 @@ class build_translit(cmd.Command):
             self.update_mapping(path=mapping_file, *table)
             print 'All done.'
 
+class build_assets(cmd.Command):
+    description = "Fingerprint and gzip compress the static assets"
+    user_options = []
+
+    #: Extensions of the assets worth compressing
+    compressible = ('.js', '.css', '.svg', '.ico', '.txt', '.html')
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def build_asset(self, path, build_dir, name):
+        data = open(path, 'rb').read()
+        base, ext = os.path.splitext(name)
+        hashed = '%s.%s%s' % (base, md5(data).hexdigest()[:12], ext)
+        target = os.path.join(build_dir, *hashed.split('/'))
+        if os.path.exists(target):
+            return hashed
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        open(target, 'wb').write(data)
+        if ext in self.compressible:
+            compressed = gzip.open(target + '.gz', 'wb', 9)
+            try:
+                compressed.write(data)
+            finally:
+                compressed.close()
+            if os.path.getsize(target + '.gz') >= len(data):
+                os.remove(target + '.gz')
+        return hashed
+
+    def run(self):
+        static_dir = os.path.join(os.path.dirname(ilog.__file__), 'static')
+        if not os.path.isdir(static_dir):
+            return
+        build_dir = os.path.join(static_dir, 'build')
+        manifest = {}
+        for kind in ('js', 'style', 'img'):
+            for dirpath, dirnames, filenames in os.walk(
+                                            os.path.join(static_dir, kind)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    name = os.path.relpath(path, static_dir)\
+                                                    .replace(os.sep, '/')
+                    manifest[name] = self.build_asset(path, build_dir, name)
+        if not os.path.isdir(build_dir):
+            os.makedirs(build_dir)
+        try:
+            import json
+        except ImportError:
+            import simplejson as json
+        json.dump(manifest, open(os.path.join(build_dir, 'manifest.json'),
+                                 'w'), indent=2, sort_keys=True)
+        print 'Built %d assets.' % len(manifest)
+
 class develop(_develop):
     def run(self):
         self.run_command('build_translit')
+        self.run_command('build_assets')
         _develop.run(self)
 
 class build(_build):
-    sub_commands = [('build_translit', None)] + _build.sub_commands
+    sub_commands = [('build_translit', None), ('build_assets', None)] + \
+                                                        _build.sub_commands
 
 class install(_install):
     def run(self):
@@ -113,6 +174,7 @@ class install(_install):
 cmdclass = {
     'build': build,
     'build_translit': build_translit,
+    'build_assets': build_assets,
     'develop': develop,
     'clean': clean,
     'install': install